@@ -0,0 +1,332 @@
+# Electrum - Lightweight Bitcoin Client
+# Copyright (c) 2011-2016 Thomas Voegtlin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Network core on an asyncio event loop, enabled with the config
+# option 'asyncio_network'.  Connections are made and read by tasks of
+# one loop, run in the network thread, instead of a thread per connect
+# and a select loop with a timeout.  The protocol logic is the one of
+# Network; only the I/O is replaced.
+
+import asyncio
+import collections
+import json
+import os
+import re
+import socket
+import ssl
+import sys
+import time
+import traceback
+
+from . import util
+from . import x509
+from . import pem
+from .interface import Interface, TcpConnection, ca_path, get_cached_ssl_context
+from .network import Network, MAINTENANCE_INTERVAL
+
+CONNECT_TIMEOUT = 10
+# the longest line read from a server, e.g. a chunk of headers
+STREAM_LIMIT = 2**23
+
+
+def connect_socket(host, port):
+    # blocking, through the proxy set up by Network.set_proxy
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(CONNECT_TIMEOUT)
+    s.connect((host, port))
+    return s
+
+
+async def open_streams(host, port, context, proxy, loop):
+    server_hostname = host if context else None
+    if proxy:
+        s = await loop.run_in_executor(None, connect_socket, host, port)
+        coro = asyncio.open_connection(sock=s, ssl=context, server_hostname=server_hostname,
+                                       limit=STREAM_LIMIT)
+    else:
+        coro = asyncio.open_connection(host, port, ssl=context, server_hostname=server_hostname,
+                                       limit=STREAM_LIMIT)
+    return await asyncio.wait_for(coro, CONNECT_TIMEOUT)
+
+
+async def open_connection(server, config_path, proxy, loop):
+    '''Returns (reader, writer) streams connected to server, or None.
+    Certificates are checked and pinned like in TcpConnection.'''
+    host, port, protocol = server.rsplit(':', 2)
+    port = int(port)
+    if protocol == 't':
+        return await open_streams(host, port, None, proxy, loop)
+    cert_path = os.path.join(config_path, 'certs', host)
+    temporary_path = cert_path + '.temp'
+    is_new = not os.path.exists(cert_path)
+    if is_new:
+        # try with CA first
+        context = get_cached_ssl_context(ca_path)
+        try:
+            reader, writer = await open_streams(host, port, context, proxy, loop)
+        except ssl.SSLError as e:
+            util.print_error(host, e)
+        else:
+            if TcpConnection.check_host_name(None, writer.get_extra_info('peercert'), host):
+                util.print_error(host, "SSL certificate signed by CA")
+                return reader, writer
+            writer.close()
+        # get server certificate
+        context = TcpConnection.get_ssl_context(cert_reqs=ssl.CERT_NONE, ca_certs=None)
+        try:
+            reader, writer = await open_streams(host, port, context, proxy, loop)
+        except ssl.SSLError as e:
+            util.print_error(host, "SSL error retrieving SSL certificate:", e)
+            return
+        dercert = writer.get_extra_info('ssl_object').getpeercert(True)
+        writer.close()
+        cert = ssl.DER_cert_to_PEM_cert(dercert)
+        # workaround android bug
+        cert = re.sub("([^\n])-----END CERTIFICATE-----","\\1\n-----END CERTIFICATE-----",cert)
+        with open(temporary_path, "w") as f:
+            f.write(cert)
+    if is_new:
+        context = TcpConnection.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED, ca_certs=temporary_path)
+    else:
+        context = get_cached_ssl_context(cert_path)
+    try:
+        streams = await open_streams(host, port, context, proxy, loop)
+    except ssl.SSLError as e:
+        util.print_error(host, "SSL error:", e)
+        if e.errno != 1:
+            return
+        if is_new:
+            rej = cert_path + '.rej'
+            if os.path.exists(rej):
+                os.unlink(rej)
+            os.rename(temporary_path, rej)
+            return
+        with open(cert_path) as f:
+            cert = f.read()
+        try:
+            x = x509.X509(pem.dePem(cert, 'CERTIFICATE'))
+        except:
+            traceback.print_exc(file=sys.stderr)
+            util.print_error(host, "wrong certificate")
+            return
+        try:
+            x.check_date()
+        except:
+            util.print_error(host, "certificate has expired:", cert_path)
+            os.unlink(cert_path)
+            return
+        util.print_error(host, "wrong certificate")
+        return
+    if is_new:
+        util.print_error(host, "saving certificate")
+        os.rename(temporary_path, cert_path)
+    return streams
+
+
+class StreamPipe:
+    '''The pipe of an AsyncInterface.  Messages are put here by its
+    reader task; requests are written to the transport, whose buffer is
+    drained by its writer task.'''
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.messages = collections.deque()
+        self.unsent = asyncio.Event()
+        self.recv_time = time.time()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def set_timeout(self, t):
+        pass
+
+    def idle_time(self):
+        return time.time() - self.recv_time
+
+    def get(self):
+        if not self.messages:
+            raise util.timeout
+        return self.messages.popleft()
+
+    def send_all(self, requests):
+        out = b''.join(map(lambda x: (json.dumps(x) + '\n').encode('utf8'), requests))
+        self.writer.write(out)
+        self.bytes_sent += len(out)
+        self.unsent.set()
+
+
+class AsyncInterface(Interface):
+
+    def __init__(self, server, reader, writer, loop):
+        Interface.__init__(self, server, None, StreamPipe(writer))
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.tasks = []
+
+    def fileno(self):
+        return self.writer.get_extra_info('socket').fileno()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.writer.close()
+
+    async def read_messages(self, on_message):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                self.pipe.recv_time = time.time()
+                self.pipe.bytes_received += len(line)
+                try:
+                    message = json.loads(line.decode('utf8'))
+                except ValueError:
+                    # skipped, like in SocketPipe
+                    continue
+                self.pipe.messages.append(message)
+                on_message(self)
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            self.print_error("read error:", e)
+        # closed remotely
+        self.pipe.messages.append(None)
+        on_message(self)
+
+    async def write_messages(self):
+        try:
+            while True:
+                await self.pipe.unsent.wait()
+                self.pipe.unsent.clear()
+                await self.writer.drain()
+        except OSError as e:
+            self.print_error("write error:", e)
+
+
+class AsyncNetwork(Network):
+    """A Network whose connections are handled by tasks of an asyncio
+    event loop, which runs in the network thread.  Methods of Network
+    that are called from other threads, like send(), wake it up."""
+
+    def __init__(self, config=None):
+        self.loop = asyncio.new_event_loop()
+        self.wakeup_event = None
+        self.tasks = set()
+        Network.__init__(self, config)
+
+    def create_task(self, coro):
+        # must be called in the loop
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def wakeup(self):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._wakeup)
+
+    def _wakeup(self):
+        if self.wakeup_event:
+            self.wakeup_event.set()
+
+    def connect(self, server):
+        self.loop.call_soon_threadsafe(self.create_task, self.connect_interface(server))
+
+    async def connect_interface(self, server):
+        try:
+            streams = await open_connection(server, self.config.path, self.proxy, self.loop)
+        except Exception as e:
+            self.print_error(server, "failed to connect", repr(e))
+            streams = None
+        if server not in self.connecting:
+            # the network was restarted meanwhile
+            if streams:
+                streams[1].close()
+            return
+        self.connecting.remove(server)
+        if streams:
+            self.print_error(server, "connected")
+            self.new_interface(server, streams)
+        else:
+            self.connection_down(server)
+        self.wakeup()
+
+    def create_interface(self, server, streams):
+        reader, writer = streams
+        interface = AsyncInterface(server, reader, writer, self.loop)
+        interface.tasks.append(self.create_task(interface.read_messages(self.on_message)))
+        interface.tasks.append(self.create_task(interface.write_messages()))
+        return interface
+
+    def on_message(self, interface):
+        # do not let a bad response stop the reader task
+        try:
+            if self.interfaces.get(interface.server) is interface:
+                self.process_responses(interface)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+        self.wakeup()
+
+    def send_requests(self):
+        for interface in list(self.interfaces.values()):
+            if interface.num_requests() and not interface.send_requests():
+                self.connection_down(interface.server)
+
+    async def main(self):
+        self.wakeup_event = asyncio.Event()
+        while self.is_running():
+            self.maintain_sockets()
+            self.maintain_requests()
+            self.run_jobs()    # Synchronizer and Verifier
+            self.run_pending_calls()
+            self.process_pending_sends()
+            self.send_requests()
+            self.flush_headers(due_only=True)
+            try:
+                await asyncio.wait_for(self.wakeup_event.wait(), MAINTENANCE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup_event.clear()
+
+    async def shutdown(self):
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.init_headers_file()
+        self.loop.run_until_complete(self.main())
+        self.stop_network()
+        self.flush_headers()
+        self.response_cache.close()
+        self.wakeup_channel.close()
+        self.loop.run_until_complete(self.shutdown())
+        self.loop.close()
+        if self.chunk_executor:
+            self.chunk_executor.shutdown()
+        self.event_bus.stop()
+        self.on_stop()
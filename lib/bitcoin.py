@@ -95,6 +95,15 @@ class NetworkConstants:
         cls.DEFAULT_SERVERS = read_json('servers_testnet.json', {})
         cls.CHECKPOINTS = read_json('checkpoints_testnet.json', [])
 
+    @classmethod
+    def set_regtest(cls):
+        # testnet rules, on a local chain like that of stub_server
+        cls.set_testnet()
+        cls.SEGWIT_HRP = "bcrt"
+        cls.GENESIS = "0f9188f13cb7b2c71f2a335e3a4fc328bf5beb436012afca590b1a11466e2206"
+        cls.DEFAULT_SERVERS = {}
+        cls.CHECKPOINTS = []
+
 
 NetworkConstants.set_mainnet()
 
@@ -21,7 +21,14 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import re
+import json
+import mmap
+import struct
+import hashlib
 import threading
+import time
+from collections import OrderedDict
 
 from . import util
 from . import bitcoin
@@ -29,6 +36,19 @@ from .bitcoin import *
 
 MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
 
+# bounds of the per-blockchain caches of derived header values
+HASH_CACHE_SIZE = 8 * 2016
+TARGET_CACHE_SIZE = 256
+
+# appended headers are written and synced to disk together, once this
+# many are pending, at the end of a chunk, or after this many seconds.
+# With a count of 1, every write is synced.
+HEADERS_FSYNC_COUNT = 2016
+HEADERS_FSYNC_DELAY = 1.0
+
+# files are copied in blocks of this size when a fork is swapped
+SWAP_BLOCK_SIZE = 2016 * 80
+
 def serialize_header(res):
     s = int_to_hex(res.get('version'), 4) \
         + rev_hex(res.get('prev_block_hash')) \
@@ -38,46 +58,224 @@ def serialize_header(res):
         + int_to_hex(int(res.get('nonce')), 4)
     return s
 
+# version, prev_block_hash, merkle_root, timestamp, bits, nonce
+HEADER_STRUCT = struct.Struct('<I32s32sIII')
+
 def deserialize_header(s, height):
-    hex_to_int = lambda s: int('0x' + bh2u(s[::-1]), 16)
+    version, prev_block_hash, merkle_root, timestamp, bits, nonce = HEADER_STRUCT.unpack_from(s)
     h = {}
-    h['version'] = hex_to_int(s[0:4])
-    h['prev_block_hash'] = hash_encode(s[4:36])
-    h['merkle_root'] = hash_encode(s[36:68])
-    h['timestamp'] = hex_to_int(s[68:72])
-    h['bits'] = hex_to_int(s[72:76])
-    h['nonce'] = hex_to_int(s[76:80])
+    h['version'] = version
+    h['prev_block_hash'] = hash_encode(prev_block_hash)
+    h['merkle_root'] = hash_encode(merkle_root)
+    h['timestamp'] = timestamp
+    h['bits'] = bits
+    h['nonce'] = nonce
     h['block_height'] = height
     return h
 
+def hash_raw_header(raw):
+    '''Double SHA256 of an 80-byte raw header, in internal byte order.
+    Accepts any buffer, including memoryview slices.'''
+    return hashlib.sha256(hashlib.sha256(raw).digest()).digest()
+
 def hash_header(header):
     if header is None:
         return '0' * 64
     if header.get('prev_block_hash') is None:
         header['prev_block_hash'] = '00'*32
-    return hash_encode(Hash(bfh(serialize_header(header))))
+    return hash_encode(hash_raw_header(bfh(serialize_header(header))))
+
+def bits_to_target(bits):
+    bitsN = (bits >> 24) & 0xff
+    if not (bitsN >= 0x03 and bitsN <= 0x1d):
+        raise BaseException("First part of bits should be in [0x03, 0x1d]")
+    bitsBase = bits & 0xffffff
+    if not (bitsBase >= 0x8000 and bitsBase <= 0x7fffff):
+        raise BaseException("Second part of bits should be in [0x8000, 0x7fffff]")
+    return bitsBase << (8 * (bitsN-3))
+
+def target_to_bits(target):
+    c = ("%064x" % target)[2:]
+    while c[:2] == '00' and len(c) > 6:
+        c = c[2:]
+    bitsN, bitsBase = len(c) // 2, int('0x' + c[:6], 16)
+    if bitsBase >= 0x800000:
+        bitsN += 1
+        bitsBase >>= 8
+    return bitsN << 24 | bitsBase
+
+def target_to_work(target):
+    '''Expected number of hashes for a header that meets target'''
+    return 2**256 // (target + 1)
+
+def retarget(first_timestamp, last_timestamp, last_bits):
+    '''Target of the next retarget period'''
+    target = bits_to_target(last_bits)
+    nActualTimespan = last_timestamp - first_timestamp
+    nTargetTimespan = 14 * 24 * 60 * 60
+    nActualTimespan = max(nActualTimespan, nTargetTimespan // 4)
+    nActualTimespan = min(nActualTimespan, nTargetTimespan * 4)
+    return min(MAX_TARGET, (target * nActualTimespan) // nTargetTimespan)
+
+def verify_raw_headers(data, prev_hash, target):
+    '''Verify consecutive 80-byte headers in data without deserializing
+    them.  prev_hash is the hex hash of the header preceding data.
+    Proof of work is not checked if target is None.  Raises on the
+    first invalid header, and returns the hex hash of the last one.'''
+    data = memoryview(data)
+    prev = hash_decode(prev_hash)
+    if target is not None:
+        bits = target_to_bits(target)
+    for i in range(len(data) // 80):
+        raw = data[i*80:(i+1)*80]
+        _hash = hash_raw_header(raw)
+        if raw[4:36] != prev:
+            raise BaseException("prev hash mismatch: %s vs %s" % (hash_encode(prev), hash_encode(raw[4:36].tobytes())))
+        if target is not None:
+            header_bits = HEADER_STRUCT.unpack_from(raw)[4]
+            if bits != header_bits:
+                raise BaseException("bits mismatch: %s vs %s" % (bits, header_bits))
+            if int.from_bytes(_hash, 'little') > target:
+                raise BaseException("insufficient proof of work: %s vs target %s" % (int.from_bytes(_hash, 'little'), target))
+        prev = _hash
+    return hash_encode(prev)
+
+
+class HeaderCache(object):
+    '''Bounded map from a height (or chunk index) to a value derived
+    from the headers.  Least recently used entries are evicted first.'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is not None:
+                self.data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def discard_from(self, key):
+        '''Drop every entry at or above key'''
+        with self.lock:
+            for k in [k for k in self.data if k >= key]:
+                del self.data[k]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+def copy_range(src_path, offset, length, dst):
+    '''Copy length bytes of a file from offset to the file object dst,
+    without holding more than one block in memory'''
+    with open(src_path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            block = f.read(min(length, SWAP_BLOCK_SIZE))
+            if not block:
+                break
+            dst.write(block)
+            length -= len(block)
+
+def swap_journal_path(config):
+    return os.path.join(util.get_headers_dir(config), 'forks', 'swap_journal')
+
+def write_swap_journal(config, journal):
+    path = swap_journal_path(config)
+    with open(path + '.tmp', 'w') as f:
+        f.write(json.dumps(journal))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+def complete_swap(config, journal):
+    '''Move the new tail of a fork swap into the parent file, and the
+    old tail of the parent, already copied to fork + '.swap', into the
+    fork file.  Each step can be repeated after a crash.'''
+    d = util.get_headers_dir(config)
+    parent_path = os.path.join(d, journal['parent'])
+    fork_path = os.path.join(d, journal['fork'])
+    if os.path.exists(fork_path + '.swap'):
+        with open(parent_path, 'rb+') as f:
+            f.seek(journal['offset'])
+            f.truncate()
+            copy_range(fork_path, 0, os.path.getsize(fork_path), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(fork_path + '.swap', fork_path)
+    os.remove(swap_journal_path(config))
+
+def recover_swap(config):
+    '''Complete a fork swap that was interrupted after its journal was
+    written, or drop the copy of one that was not'''
+    fdir = os.path.join(util.get_headers_dir(config), 'forks')
+    path = swap_journal_path(config)
+    if os.path.exists(path):
+        with open(path) as f:
+            journal = json.loads(f.read())
+        util.print_error("completing interrupted swap", journal)
+        complete_swap(config, journal)
+    for filename in os.listdir(fdir):
+        if filename.endswith('.swap') or filename.endswith('.tmp'):
+            os.remove(os.path.join(fdir, filename))
 
 
 blockchains = {}
 
 def read_blockchains(config):
-    blockchains[0] = Blockchain(config, 0, None)
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     if not os.path.exists(fdir):
         os.mkdir(fdir)
-    l = filter(lambda x: x.startswith('fork_'), os.listdir(fdir))
+    recover_swap(config)
+    blockchains[0] = Blockchain(config, 0, None)
+    l = filter(lambda x: re.match(r'fork_\d+_\d+$', x), os.listdir(fdir))
     l = sorted(l, key = lambda x: int(x.split('_')[1]))
     for filename in l:
         checkpoint = int(filename.split('_')[2])
         parent_id = int(filename.split('_')[1])
         b = Blockchain(config, checkpoint, parent_id)
         h = b.read_header(b.checkpoint)
-        if b.parent().can_connect(h, check_height=False):
+        if h is not None and b.parent().can_connect(h, check_height=False):
             blockchains[b.checkpoint] = b
         else:
             util.print_error("cannot connect", filename)
     return blockchains
 
+def drop_orphan_forks():
+    '''Remove the forks whose first header no longer connects to their
+    parent, with the forks above them, e.g. after the main chain was
+    replaced by a snapshot.  Returns their checkpoints.'''
+    dropped = []
+    for b in sorted(blockchains.values(), key=lambda b: b.checkpoint):
+        if b.parent_id is None:
+            continue
+        if b.parent_id not in dropped:
+            h = b.read_header(b.checkpoint)
+            if h is not None and b.parent().can_connect(h, check_height=False):
+                continue
+        util.print_error("dropping fork", b.path())
+        blockchains.pop(b.checkpoint)
+        with b.lock:
+            b.release_mmap()
+        os.remove(b.path())
+        if os.path.exists(b.chainwork_path()):
+            os.remove(b.chainwork_path())
+        dropped.append(b.checkpoint)
+    return dropped
+
 def check_header(header):
     if type(header) is not dict:
         return False
@@ -105,8 +303,27 @@ class Blockchain(util.PrintError):
         self.checkpoints = bitcoin.NetworkConstants.CHECKPOINTS
         self.parent_id = parent_id
         self.lock = threading.Lock()
+        # read-only map of the headers file, (re)created lazily
+        self._mmap = None
+        # block hashes by height and retarget values by chunk index,
+        # only for headers stored in this branch's own file
+        self.hash_cache = HeaderCache(HASH_CACHE_SIZE)
+        self.target_cache = HeaderCache(TARGET_CACHE_SIZE)
+        # appended headers not written to the file yet
+        self._pending = bytearray()
+        self._pending_since = None
+        self.fsync_count = config.get('headers_fsync_count', HEADERS_FSYNC_COUNT)
+        self.fsync_delay = config.get('headers_fsync_delay', HEADERS_FSYNC_DELAY)
         with self.lock:
+            self.truncate_torn_tail()
             self.update_size()
+        # cumulative work through the end of each chunk, for the chunks
+        # from checkpoint // 2016 on, persisted next to the headers.
+        # The target is the same for all headers in a chunk, so the
+        # work at any height follows from the chunk before it.
+        self._chainwork = []
+        self.chainwork_lock = threading.Lock()
+        self.load_chainwork()
 
     def parent(self):
         return blockchains[self.parent_id]
@@ -145,30 +362,165 @@ class Blockchain(util.PrintError):
             return self._size
 
     def update_size(self):
+        # the file may have been resized; drop the current map
+        self.release_mmap()
         p = self.path()
         self._size = os.path.getsize(p)//80 if os.path.exists(p) else 0
+        self._size += len(self._pending) // 80
+
+    def disk_size(self):
+        # must be called with self.lock held
+        return self._size - len(self._pending) // 80
+
+    def truncate_torn_tail(self):
+        '''A crash while headers were appended may leave a partial
+        header, or headers that are all zeros, at the end of the file.
+        Zeros are only expected below the checkpoints of the main chain.'''
+        p = self.path()
+        if not os.path.exists(p):
+            return
+        min_height = len(self.checkpoints) * 2016 if self.parent_id is None else self.checkpoint
+        with open(p, 'rb+') as f:
+            size = os.path.getsize(p)
+            end = size - size % 80
+            while end > 0 and self.checkpoint + end // 80 - 1 >= min_height:
+                f.seek(end - 80)
+                if f.read(80) != bytes(80):
+                    break
+                end -= 80
+            if end != size:
+                self.print_error("truncating torn tail of", p, size, end)
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def get_mmap(self):
+        # must be called with self.lock held
+        disk_size = self.disk_size()
+        if self._mmap is None and disk_size > 0:
+            with open(self.path(), 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), disk_size * 80, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def release_mmap(self):
+        # must be called with self.lock held
+        if self._mmap is None:
+            return
+        self._mmap.close()
+        self._mmap = None
+
+    def get_readers(self, height):
+        '''This branch and the forks that read its header at height'''
+        readers = [self]
+        for b in sorted(blockchains.values(), key=lambda b: b.checkpoint):
+            parent = blockchains.get(b.parent_id) if b.parent_id is not None else None
+            if parent in readers and (parent is not self or b.checkpoint > height):
+                readers.append(b)
+        return readers
+
+    def invalidate_cache(self, height):
+        '''Forget values derived from headers at or above height'''
+        self.hash_cache.discard_from(height)
+        # chunk index is affected if its last header is at or above height
+        self.target_cache.discard_from((height - 2015) // 2016)
+        # the work through the chunk after the last checkpoint is known
+        # from the checkpoint targets alone
+        self.truncate_chainwork(max((height - 2015) // 2016, len(self.checkpoints) + 1))
+
+    def chainwork_path(self):
+        return self.path() + '.chainwork'
+
+    def load_chainwork(self):
+        p = self.chainwork_path()
+        if not os.path.exists(p):
+            return
+        with open(p, 'rb') as f:
+            data = f.read()
+        work = 0
+        for i in range(len(data) // 32):
+            w = int.from_bytes(data[i*32:(i+1)*32], 'big')
+            # torn or zeroed by a crash
+            if w <= work:
+                break
+            self._chainwork.append(w)
+            work = w
+        # entries of chunks that are not complete anymore
+        num_chunks = max(0, (self.height() + 1) // 2016 - self.checkpoint // 2016)
+        del self._chainwork[num_chunks:]
+        if len(self._chainwork) * 32 != len(data):
+            with open(p, 'rb+') as f:
+                f.truncate(len(self._chainwork) * 32)
+
+    def truncate_chainwork(self, index):
+        '''Forget the work through chunk index and the chunks after it'''
+        with self.chainwork_lock:
+            n = max(0, index - self.checkpoint // 2016)
+            if n >= len(self._chainwork):
+                return
+            del self._chainwork[n:]
+            with open(self.chainwork_path(), 'rb+') as f:
+                f.truncate(n * 32)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def get_chunk_work(self, index):
+        '''Cumulative work through the end of chunk index, which must
+        be complete.  Missing values are computed and saved.'''
+        if index < 0:
+            return 0
+        first = self.checkpoint // 2016
+        if index < first:
+            return self.parent().get_chunk_work(index)
+        with self.chainwork_lock:
+            n = len(self._chainwork)
+            if index - first < n:
+                return self._chainwork[index - first]
+            work = self._chainwork[-1] if n else None
+        if work is None:
+            work = self.get_chunk_work(first - 1)
+        new = []
+        for i in range(first + n, index + 1):
+            work += 2016 * self.get_work(i)
+            new.append(work)
+        with self.chainwork_lock:
+            if len(self._chainwork) == n:
+                self._chainwork += new
+                with open(self.chainwork_path(), 'ab') as f:
+                    f.write(b''.join(w.to_bytes(32, 'big') for w in new))
+        return work
+
+    def get_chainwork(self, height=None):
+        '''Cumulative work of the chain up to height, by default the tip'''
+        if height is None:
+            height = self.height()
+        if height < 0:
+            return 0
+        index = height // 2016
+        return self.get_chunk_work(index - 1) + (height % 2016 + 1) * self.get_work(index)
+
+    def get_work(self, index):
+        '''Work of one header in chunk index'''
+        if bitcoin.NetworkConstants.TESTNET:
+            # proof of work is not verified
+            return 1
+        return target_to_work(self.get_target(index - 1))
+
+    def update_chainwork(self):
+        index = (self.height() + 1) // 2016 - 1
+        if index >= 0:
+            self.get_chunk_work(index)
 
     def verify_header(self, header, prev_hash, target):
-        _hash = hash_header(header)
         if prev_hash != header.get('prev_block_hash'):
             raise BaseException("prev hash mismatch: %s vs %s" % (prev_hash, header.get('prev_block_hash')))
         if bitcoin.NetworkConstants.TESTNET:
             return
-        bits = self.target_to_bits(target)
-        if bits != header.get('bits'):
-            raise BaseException("bits mismatch: %s vs %s" % (bits, header.get('bits')))
-        if int('0x' + _hash, 16) > target:
-            raise BaseException("insufficient proof of work: %s vs target %s" % (int('0x' + _hash, 16), target))
+        verify_raw_headers(bfh(serialize_header(header)), prev_hash, target)
 
     def verify_chunk(self, index, data):
-        num = len(data) // 80
         prev_hash = self.get_hash(index * 2016 - 1)
-        target = self.get_target(index-1)
-        for i in range(num):
-            raw_header = data[i*80:(i+1) * 80]
-            header = deserialize_header(raw_header, index*2016 + i)
-            self.verify_header(header, prev_hash, target)
-            prev_hash = hash_header(header)
+        target = None if bitcoin.NetworkConstants.TESTNET else self.get_target(index-1)
+        verify_raw_headers(data, prev_hash, target)
 
     def path(self):
         d = util.get_headers_dir(self.config)
@@ -182,38 +534,63 @@ class Blockchain(util.PrintError):
             chunk = chunk[-d:]
             d = 0
         self.write(chunk, d, index > len(self.checkpoints))
+        self.update_chainwork()
         self.swap_with_parent()
 
     def swap_with_parent(self):
         if self.parent_id is None:
             return
         parent_branch_size = self.parent().height() - self.checkpoint + 1
-        if parent_branch_size >= self.size():
+        if self.parent().get_chainwork() >= self.get_chainwork():
             return
         self.print_error("swap", self.checkpoint, self.parent_id)
         parent_id = self.parent_id
         checkpoint = self.checkpoint
         parent = self.parent()
-        with open(self.path(), 'rb') as f:
-            my_data = f.read()
-        with open(parent.path(), 'rb') as f:
-            f.seek((checkpoint - parent.checkpoint)*80)
-            parent_data = f.read(parent_branch_size*80)
-        self.write(parent_data, 0)
-        parent.write(my_data, (checkpoint - parent.checkpoint)*80)
-        # store file path
+        self.flush()
+        parent.flush()
+        offset = (checkpoint - parent.checkpoint)*80
+        d = util.get_headers_dir(self.config)
+        journal = {
+            'parent': os.path.relpath(parent.path(), d),
+            'fork': os.path.relpath(self.path(), d),
+            'offset': offset,
+        }
+        # the work below the fork point is the same for both
+        self.truncate_chainwork(checkpoint // 2016)
+        parent.truncate_chainwork(checkpoint // 2016)
+        with self.lock, parent.lock:
+            self.release_mmap()
+            parent.release_mmap()
+            # only the tails after the fork point are copied, in blocks
+            with open(self.path() + '.swap', 'wb') as f:
+                copy_range(parent.path(), offset, parent_branch_size*80, f)
+                f.flush()
+                os.fsync(f.fileno())
+            write_swap_journal(self.config, journal)
+            complete_swap(self.config, journal)
+            # store file path
+            for b in blockchains.values():
+                b.old_path = b.path()
+            # swap parameters
+            self.parent_id = parent.parent_id; parent.parent_id = parent_id
+            self.checkpoint = parent.checkpoint; parent.checkpoint = checkpoint
+            self._size = offset//80 + self._size; parent._size = parent_branch_size
+            self._chainwork, parent._chainwork = parent._chainwork, self._chainwork
+        # the branches under every checkpoint changed
         for b in blockchains.values():
-            b.old_path = b.path()
-        # swap parameters
-        self.parent_id = parent.parent_id; parent.parent_id = parent_id
-        self.checkpoint = parent.checkpoint; parent.checkpoint = checkpoint
-        self._size = parent._size; parent._size = parent_branch_size
+            b.hash_cache.clear()
+            b.target_cache.clear()
         # move files
         for b in blockchains.values():
             if b in [self, parent]: continue
             if b.old_path != b.path():
                 self.print_error("renaming", b.old_path, b.path())
+                with b.lock:
+                    b.release_mmap()
                 os.rename(b.old_path, b.path())
+                if os.path.exists(b.old_path + '.chainwork'):
+                    os.rename(b.old_path + '.chainwork', b.chainwork_path())
         # update pointers
         blockchains[self.checkpoint] = self
         blockchains[parent.checkpoint] = parent
@@ -221,6 +598,27 @@ class Blockchain(util.PrintError):
     def write(self, data, offset, truncate=True):
         filename = self.path()
         with self.lock:
+            if offset == self._size*80 and self.fsync_count > 1:
+                # append: write behind
+                self._pending += data
+                self._size += len(data) // 80
+                if self._pending_since is None:
+                    self._pending_since = time.time()
+                if self.flush_due():
+                    self._flush()
+                return
+            self._flush()
+            if offset < self._size*80:
+                # existing headers are overwritten or truncated.  Zeros
+                # are headers not downloaded yet, below the checkpoints;
+                # nothing was derived from them.
+                end = self._size*80 if truncate else min(offset + len(data), self._size*80)
+                old = self.get_mmap()[offset:end]
+                if old.count(0) != len(old):
+                    height = self.checkpoint + offset // 80
+                    for b in self.get_readers(height):
+                        b.invalidate_cache(height)
+            self.release_mmap()
             with open(filename, 'rb+') as f:
                 if truncate and offset != self._size*80:
                     f.seek(offset)
@@ -231,12 +629,41 @@ class Blockchain(util.PrintError):
                 os.fsync(f.fileno())
             self.update_size()
 
+    def flush_due(self):
+        # must be called with self.lock held
+        if not self._pending:
+            return False
+        return len(self._pending) // 80 >= self.fsync_count \
+            or (self.checkpoint + self._size) % 2016 == 0 \
+            or time.time() - self._pending_since >= self.fsync_delay
+
+    def _flush(self):
+        # must be called with self.lock held
+        if not self._pending:
+            return
+        self.release_mmap()
+        with open(self.path(), 'rb+') as f:
+            f.seek(self.disk_size() * 80)
+            f.write(self._pending)
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending = bytearray()
+        self._pending_since = None
+
+    def flush(self, due_only=False):
+        '''Write and sync pending headers to the file.  With due_only,
+        only if the durability policy asks for it.'''
+        with self.lock:
+            if not due_only or self.flush_due():
+                self._flush()
+
     def save_header(self, header):
         delta = header.get('block_height') - self.checkpoint
         data = bfh(serialize_header(header))
         assert delta == self.size()
         assert len(data) == 80
         self.write(data, delta*80)
+        self.update_chainwork()
         self.swap_with_parent()
 
     def read_header(self, height):
@@ -248,15 +675,45 @@ class Blockchain(util.PrintError):
         if height > self.height():
             return
         delta = height - self.checkpoint
-        name = self.path()
-        if os.path.exists(name):
-            with open(name, 'rb') as f:
-                f.seek(delta * 80)
-                h = f.read(80)
+        with self.lock:
+            if delta >= self._size:
+                return
+            disk_size = self.disk_size()
+            if delta >= disk_size:
+                d = delta - disk_size
+                h = bytes(self._pending[d * 80:(d + 1) * 80])
+            else:
+                h = self.get_mmap()[delta * 80:(delta + 1) * 80]
         if h == bytes([0])*80:
             return None
         return deserialize_header(h, height)
 
+    def read_raw_headers(self, height, count=1):
+        '''Returns at most count consecutive raw headers starting at
+        height.  The range is cut at the boundary of the branch that
+        holds height, and at the end of the headers already in the
+        file.  The headers are copied under the lock: a view of the map
+        would fault once another thread truncates the file.'''
+        if height < 0 or count <= 0:
+            return None
+        if height < self.checkpoint:
+            count = min(count, self.checkpoint - height)
+            return self.parent().read_raw_headers(height, count)
+        delta = height - self.checkpoint
+        with self.lock:
+            if delta >= self._size:
+                return None
+            disk_size = self.disk_size()
+            if delta >= disk_size:
+                d = delta - disk_size
+                count = min(count, self._size - delta)
+                return bytes(self._pending[d * 80:(d + count) * 80])
+            count = min(count, disk_size - delta)
+            return self.get_mmap()[delta * 80:(delta + count) * 80]
+
+    def read_raw_header(self, height):
+        return self.read_raw_headers(height, 1)
+
     def get_hash(self, height):
         if height == -1:
             return '0000000000000000000000000000000000000000000000000000000000000000'
@@ -267,8 +724,16 @@ class Blockchain(util.PrintError):
             index = height // 2016
             h, t = self.checkpoints[index]
             return h
+        elif height < self.checkpoint:
+            return self.parent().get_hash(height)
         else:
-            return hash_header(self.read_header(height))
+            h = self.hash_cache.get(height)
+            if h is None:
+                header = self.read_header(height)
+                h = hash_header(header)
+                if header is not None:
+                    self.hash_cache.put(height, h)
+            return h
 
     def get_target(self, index):
         # compute target from chunk x, used in chunk x+1
@@ -279,36 +744,35 @@ class Blockchain(util.PrintError):
         if index < len(self.checkpoints):
             h, t = self.checkpoints[index]
             return t
+        if index * 2016 + 2015 < self.checkpoint:
+            return self.parent().get_target(index)
+        new_target = self.target_cache.get(index)
+        if new_target is not None:
+            return new_target
         # new target
         first = self.read_header(index * 2016)
         last = self.read_header(index * 2016 + 2015)
-        bits = last.get('bits')
-        target = self.bits_to_target(bits)
-        nActualTimespan = last.get('timestamp') - first.get('timestamp')
-        nTargetTimespan = 14 * 24 * 60 * 60
-        nActualTimespan = max(nActualTimespan, nTargetTimespan // 4)
-        nActualTimespan = min(nActualTimespan, nTargetTimespan * 4)
-        new_target = min(MAX_TARGET, (target * nActualTimespan) // nTargetTimespan)
+        new_target = retarget(first.get('timestamp'), last.get('timestamp'), last.get('bits'))
+        self.target_cache.put(index, new_target)
         return new_target
 
+    def get_chunk_target(self, index, data):
+        '''Same as get_target, but computed from the raw headers of
+        chunk index, which are not saved yet'''
+        if bitcoin.NetworkConstants.TESTNET:
+            return None
+        if index < len(self.checkpoints):
+            h, t = self.checkpoints[index]
+            return t
+        first = deserialize_header(data[0:80], index * 2016)
+        last = deserialize_header(data[-80:], index * 2016 + 2015)
+        return retarget(first.get('timestamp'), last.get('timestamp'), last.get('bits'))
+
     def bits_to_target(self, bits):
-        bitsN = (bits >> 24) & 0xff
-        if not (bitsN >= 0x03 and bitsN <= 0x1d):
-            raise BaseException("First part of bits should be in [0x03, 0x1d]")
-        bitsBase = bits & 0xffffff
-        if not (bitsBase >= 0x8000 and bitsBase <= 0x7fffff):
-            raise BaseException("Second part of bits should be in [0x8000, 0x7fffff]")
-        return bitsBase << (8 * (bitsN-3))
+        return bits_to_target(bits)
 
     def target_to_bits(self, target):
-        c = ("%064x" % target)[2:]
-        while c[:2] == '00' and len(c) > 6:
-            c = c[2:]
-        bitsN, bitsBase = len(c) // 2, int('0x' + c[:6], 16)
-        if bitsBase >= 0x800000:
-            bitsN += 1
-            bitsBase >>= 8
-        return bitsN << 24 | bitsBase
+        return target_to_bits(target)
 
     def can_connect(self, header, check_height=True):
         height = header['block_height']
@@ -341,6 +805,50 @@ class Blockchain(util.PrintError):
             self.print_error('verify_chunk failed', str(e))
             return False
 
+    def connect_chunks(self, index, hexchunks, executor=None):
+        '''Verify and save consecutive chunks starting at index.  The
+        prev hash and target of each chunk are taken from the raw data
+        of the chunk before it, so that with an executor the chunks are
+        verified concurrently; the first one links to our headers, and
+        chunks below the checkpoints must end with theirs.  They are
+        saved in order, up to the first one that fails.  Returns the
+        number of chunks saved.'''
+        jobs = []
+        try:
+            prev_hash = self.get_hash(index * 2016 - 1)
+            target = None if bitcoin.NetworkConstants.TESTNET else self.get_target(index - 1)
+            for i, hexdata in enumerate(hexchunks):
+                data = bfh(hexdata)
+                jobs.append((data, prev_hash, target))
+                if len(data) != 2016 * 80:
+                    # only the last chunk can be incomplete
+                    break
+                prev_hash = hash_encode(hash_raw_header(data[-80:]))
+                target = self.get_chunk_target(index + i, data)
+        except BaseException as e:
+            # the chunk before is bad; it will fail verification too
+            self.print_error('cannot prepare chunk %d' % (index + len(jobs)), str(e))
+        if executor is not None:
+            results = [executor.submit(verify_raw_headers, *job) for job in jobs]
+        n = 0
+        for i, (data, prev_hash, target) in enumerate(jobs):
+            try:
+                if executor is not None:
+                    last_hash = results[i].result()
+                else:
+                    last_hash = verify_raw_headers(data, prev_hash, target)
+                if index + i < len(self.checkpoints) and last_hash != self.checkpoints[index + i][0]:
+                    raise BaseException("checkpoint mismatch at chunk %d" % (index + i))
+            except BaseException as e:
+                self.print_error('verify_chunk %d failed' % (index + i), str(e))
+                if executor is not None:
+                    for f in results[i+1:]:
+                        f.cancel()
+                break
+            self.save_chunk(index + i, data)
+            n += 1
+        return n
+
     def get_checkpoints(self):
         # for each chunk, store the hash of the last block and the target after the chunk
         cp = []
@@ -350,3 +858,107 @@ class Blockchain(util.PrintError):
             target = self.get_target(index)
             cp.append((h, target))
         return cp
+
+    def verify_snapshot(self, data):
+        '''Verify raw headers from genesis, in bulk.  Each chunk below
+        the checkpoints must end with its checkpoint hash, or be left
+        empty (zeros), as in a headers file pre-sized by the network.
+        Chunks above the checkpoints are verified like downloaded ones.
+        Returns the hash of the last header.'''
+        if len(data) % 80 or not data:
+            raise BaseException("snapshot size is not a multiple of 80 bytes")
+        data = memoryview(data)
+        genesis = data[0:80]
+        if genesis != bytes(80) and hash_encode(hash_raw_header(genesis)) != bitcoin.NetworkConstants.GENESIS:
+            raise BaseException("snapshot does not start with the genesis block")
+        num_checkpoints = len(self.checkpoints)
+        empty = bytes(2016 * 80)
+        prev_hash = '00' * 32
+        target = None if bitcoin.NetworkConstants.TESTNET else MAX_TARGET
+        for index in range((len(data) + 2015 * 80) // (2016 * 80)):
+            chunk = data[index * 2016 * 80:(index + 1) * 2016 * 80]
+            if index < num_checkpoints:
+                h, t = self.checkpoints[index]
+                if chunk != empty:
+                    last_hash = verify_raw_headers(chunk, prev_hash, target)
+                    if len(chunk) == len(empty) and last_hash != h:
+                        raise BaseException("checkpoint mismatch at chunk %d" % index)
+                prev_hash = h
+            else:
+                prev_hash = verify_raw_headers(chunk, prev_hash, target)
+            if len(chunk) == len(empty):
+                target = self.get_chunk_target(index, chunk)
+        return prev_hash
+
+    def export_headers(self, path):
+        '''Write the headers of this branch from genesis to path, and
+        their checkpoints, in the format of checkpoints.json, to
+        path + '.json'.  Returns the height of the last header.
+
+        The headers are copied under the lock of each branch.  If a
+        reorg changes them during the export, the snapshot does not
+        verify and is rejected by import_headers.'''
+        height = self.height()
+        data = bytearray()
+        while len(data) // 80 <= height:
+            raw = self.read_raw_headers(len(data) // 80, height + 1 - len(data) // 80)
+            if raw is None:
+                break
+            data += raw
+        height = len(data) // 80 - 1
+        meta = {
+            'height': height,
+            'tip': hash_encode(hash_raw_header(data[-80:])) if height > 0 else self.get_hash(0),
+            'checkpoints': self.get_checkpoints(),
+        }
+        for filename, content in [(path, data), (path + '.json', json.dumps(meta, indent=4).encode())]:
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(filename + '.tmp', filename)
+        return height
+
+    def import_headers(self, path):
+        '''Replace the headers of the main chain with a snapshot written
+        by export_headers.  The snapshot is verified against our own
+        checkpoints first, and written at once.  Local chunks are kept
+        where the snapshot has empty ones, and local headers above the
+        snapshot if they extend it.  Returns its height.
+
+        Forks that no longer connect must be dropped afterwards, see
+        drop_orphan_forks.  With a network, it must run on the network
+        thread, which also writes headers.'''
+        assert self.parent_id is None
+        with open(path, 'rb') as f:
+            data = f.read()
+        if os.path.exists(path + '.json'):
+            with open(path + '.json') as f:
+                meta = json.loads(f.read())
+            for i, (cp, our_cp) in enumerate(zip(meta.get('checkpoints', []), self.checkpoints)):
+                if list(cp) != list(our_cp):
+                    raise BaseException("snapshot checkpoint %d differs from ours" % i)
+        tip = self.verify_snapshot(data)
+        height = len(data) // 80 - 1
+        with self.lock:
+            if not os.path.exists(self.path()):
+                open(self.path(), 'wb').close()
+                self.update_size()
+        data = bytearray(data)
+        empty = bytes(2016 * 80)
+        for index in range(min(len(data) // (2016 * 80), len(self.checkpoints))):
+            chunk = slice(index * 2016 * 80, (index + 1) * 2016 * 80)
+            if data[chunk] == empty:
+                # ours were verified against the same checkpoints
+                raw = self.read_raw_headers(index * 2016, 2016)
+                if raw is not None and len(raw) == len(empty):
+                    data[chunk] = raw
+        keep = False
+        if self.height() > height:
+            # an empty header is in the checkpoint range of our file
+            raw = self.read_raw_headers(height)
+            keep = raw == bytes(80) or hash_encode(hash_raw_header(raw)) == tip
+        self.write(data, 0, not keep)
+        self.flush()
+        self.print_error("imported %d headers from %s" % (height + 1, path))
+        return height
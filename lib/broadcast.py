@@ -0,0 +1,202 @@
+# Electrum - Lightweight Bitcoin Client
+# Copyright (c) 2011-2016 Thomas Voegtlin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .util import PrintError
+
+# number of servers a transaction is sent to, our main server first
+BROADCAST_SERVERS = 3
+# seconds before a queued transaction is sent again, doubled after each
+# failed attempt
+RETRY_INTERVAL = 60
+MAX_RETRY_INTERVAL = 3600
+# queued transactions are dropped after this many attempts
+MAX_ATTEMPTS = 20
+# transactions whose results are kept for get_stats
+RECENT_RESULTS = 20
+
+
+class Broadcast(object):
+    '''A transaction sent to several servers at once'''
+
+    def __init__(self, txid, raw, servers):
+        self.txid = txid
+        self.raw = raw
+        # our main server first
+        self.servers = list(servers)
+        self.pending = set(servers)
+        self.errors = {}
+        self.accepted = []
+        self.futures = []
+        self.start_time = time.time()
+
+
+class Broadcaster(PrintError):
+    """Transactions being broadcast, and the queue of those that no
+    server accepted in time, which are sent again with a backoff.  The
+    queue is saved in the 'broadcast_queue' file of the electrum
+    directory, so that a transaction is not lost on restart.  Answers
+    are counted by server.
+
+    Broadcasts are started and answered on the network thread.  Other
+    threads submit transactions and read the stats."""
+
+    def __init__(self, config_path):
+        self.path = os.path.join(config_path, 'broadcast_queue') if config_path else None
+        self.lock = threading.Lock()
+        # txid -> {'tx', 'attempts', 'next_try'}
+        self.queue = self.read()
+        # txid -> Broadcast
+        self.in_flight = {}
+        # (txid, raw, future) submitted by other threads
+        self.submitted = []
+        # server -> counts of answers
+        self.servers = {}
+        # txid -> server -> 'accepted' or the error
+        self.results = OrderedDict()
+
+    def read(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                queue = json.loads(f.read())
+        except:
+            return {}
+        return queue if isinstance(queue, dict) else {}
+
+    def save(self):
+        if not self.path:
+            return
+        s = json.dumps(self.queue, indent=4, sort_keys=True)
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(s)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            self.print_error("cannot save broadcast queue:", e)
+
+    def submit(self, txid, raw, future):
+        with self.lock:
+            self.submitted.append((txid, raw, future))
+
+    def enqueue(self, txid, raw):
+        '''Queues a transaction that no server accepted in time'''
+        with self.lock:
+            if txid in self.queue:
+                return
+            self.print_error("queued", txid)
+            self.queue[txid] = {'tx': raw, 'attempts': 0, 'next_try': time.time() + RETRY_INTERVAL}
+            self.save()
+
+    def get_pending(self):
+        '''Submitted transactions, and queued ones that are due'''
+        now = time.time()
+        with self.lock:
+            pending = self.submitted
+            self.submitted = []
+            for txid, item in self.queue.items():
+                if item['next_try'] <= now and txid not in self.in_flight:
+                    pending.append((txid, item['tx'], None))
+        return pending
+
+    def start(self, txid, raw, servers, future):
+        '''Returns the Broadcast to send to servers, our main server
+        first, or None if txid is already being sent, in which case
+        future gets the same result'''
+        with self.lock:
+            b = self.in_flight.get(txid)
+            if b is None:
+                b = self.in_flight[txid] = Broadcast(txid, raw, servers)
+                new = True
+            else:
+                new = False
+            if future:
+                b.futures.append(future)
+        return b if new else None
+
+    def on_response(self, b, server, response):
+        error = response.get('error')
+        result = response.get('result')
+        if not error and result != b.txid:
+            error = result
+        with self.lock:
+            b.pending.discard(server)
+            counts = self.servers.setdefault(server, {'accepted': 0, 'errors': 0})
+            results = self.results.setdefault(b.txid, {})
+            if error:
+                counts['errors'] += 1
+                b.errors[server] = error
+                results[server] = str(error)
+            else:
+                counts['accepted'] += 1
+                counts['last_latency'] = time.time() - b.start_time
+                b.accepted.append(server)
+                results[server] = 'accepted'
+            while len(self.results) > RECENT_RESULTS:
+                self.results.popitem(last=False)
+            if b.accepted and self.queue.pop(b.txid, None):
+                self.print_error("sent queued", b.txid)
+                self.save()
+            if not b.pending:
+                self.finish(b)
+        if b.accepted:
+            self.set_result(b, True, b.txid)
+        elif not b.pending:
+            # the error of our main server, if it answered
+            errors = [b.errors[s] for s in b.servers if s in b.errors]
+            error = errors[0] if errors else 'no server'
+            self.set_result(b, False, "error: " + str(error))
+
+    def finish(self, b):
+        self.in_flight.pop(b.txid, None)
+        item = self.queue.get(b.txid)
+        if item is None or b.accepted:
+            return
+        item['attempts'] += 1
+        if item['attempts'] >= MAX_ATTEMPTS:
+            self.print_error("giving up", b.txid)
+            self.queue.pop(b.txid)
+        else:
+            delay = min(MAX_RETRY_INTERVAL, RETRY_INTERVAL * 2 ** item['attempts'])
+            item['next_try'] = time.time() + delay
+        self.save()
+
+    def set_result(self, b, ok, message):
+        for future in b.futures:
+            if not future.done():
+                future.set_result((ok, message))
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'queue': len(self.queue),
+                'in_flight': len(self.in_flight),
+                'servers': {s: dict(c) for s, c in self.servers.items()},
+                'recent': {txid: dict(r) for txid, r in self.results.items()},
+            }
@@ -36,6 +36,7 @@ from decimal import Decimal
 from .import util
 from .util import bfh, bh2u, format_satoshis, json_decode
 from .import bitcoin
+from .import blockchain
 from .bitcoin import is_address,  hash_160, COIN, TYPE_ADDRESS
 from .i18n import _
 from .transaction import Transaction, multisig_script
@@ -339,6 +340,30 @@ class Commands:
         """Return the list of available servers"""
         return self.network.get_servers()
 
+    @command('n')
+    def getnetworkstats(self):
+        """Return counters of the network: requests and latency by
+        method, time spent in callbacks, bytes, and queue depths"""
+        return self.network.get_network_stats()
+
+    @command('')
+    def exportheaders(self, filename):
+        """Export the block headers to a file, with their checkpoints in
+        filename.json. Returns the height of the last header."""
+        if self.network:
+            return self.network.export_headers(filename)
+        return blockchain.read_blockchains(self.config)[0].export_headers(filename)
+
+    @command('')
+    def importheaders(self, filename):
+        """Import block headers exported with exportheaders. They are
+        verified against the checkpoints before they are saved."""
+        if self.network:
+            return self.network.import_headers(filename)
+        height = blockchain.read_blockchains(self.config)[0].import_headers(filename)
+        blockchain.drop_orphan_forks()
+        return height
+
     @command('')
     def version(self):
         """Return the version of electrum."""
@@ -708,6 +733,7 @@ param_descriptions = {
     'requested_amount': 'Requested amount (in BTC).',
     'outputs': 'list of ["address", amount]',
     'redeem_script': 'redeem script (hexadecimal)',
+    'filename': 'File name',
 }
 
 command_options = {
@@ -839,6 +865,7 @@ def add_global_options(parser):
     group.add_argument("-P", "--portable", action="store_true", dest="portable", default=False, help="Use local 'electrum_data' directory")
     group.add_argument("-w", "--wallet", dest="wallet_path", help="wallet path")
     group.add_argument("--testnet", action="store_true", dest="testnet", default=False, help="Use Testnet")
+    group.add_argument("--regtest", action="store_true", dest="regtest", default=False, help="Use Regtest")
 
 def get_parser():
     # create main parser
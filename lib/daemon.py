@@ -24,6 +24,7 @@
 # SOFTWARE.
 import ast
 import os
+import select
 import time
 
 # from jsonrpc import JSONRPCResponseManager
@@ -32,7 +33,7 @@ from .jsonrpc import VerifyingJSONRPCServer
 
 from .version import ELECTRUM_VERSION
 from .network import Network
-from .util import json_decode, DaemonThread
+from .util import json_decode, DaemonThread, Wakeup, DAEMON_WAIT_TIMEOUT
 from .util import print_error, to_string
 from .wallet import Wallet
 from .storage import WalletStorage
@@ -118,12 +119,17 @@ class Daemon(DaemonThread):
 
     def __init__(self, config, fd, is_gui):
         DaemonThread.__init__(self)
+        self.wakeup_channel = Wakeup()
         self.config = config
         if config.get('offline'):
             self.network = None
             self.fx = None
         else:
-            self.network = Network(config)
+            network_class = Network
+            if config.get('asyncio_network'):
+                from .aionetwork import AsyncNetwork
+                network_class = AsyncNetwork
+            self.network = network_class(config)
             self.network.start()
             self.fx = FxThread(config, self.network)
             self.network.add_jobs([self.fx])
@@ -149,7 +155,8 @@ class Daemon(DaemonThread):
         os.write(fd, bytes(repr((server.socket.getsockname(), time.time())), 'utf8'))
         os.close(fd)
         self.server = server
-        server.timeout = 0.1
+        # handle_request() is called once the socket is readable
+        server.timeout = 0
         server.register_function(self.ping, 'ping')
         if is_gui:
             server.register_function(self.run_gui, 'gui')
@@ -196,6 +203,7 @@ class Daemon(DaemonThread):
                     'wallets': {k: w.is_up_to_date()
                                 for k, w in self.wallets.items()},
                     'fee_per_kb': self.config.fee_per_kb(),
+                    'network_stats': self.network.get_network_stats(),
                 }
             else:
                 response = "Daemon offline"
@@ -279,15 +287,24 @@ class Daemon(DaemonThread):
         result = func(*args, **kwargs)
         return result
 
+    def wakeup(self):
+        self.wakeup_channel.set()
+
     def run(self):
         while self.is_running():
-            self.server.handle_request() if self.server else time.sleep(0.1)
+            rin = [self.server, self.wakeup_channel] if self.server else [self.wakeup_channel]
+            r, w, x = select.select(rin, [], [], DAEMON_WAIT_TIMEOUT)
+            if self.wakeup_channel in r:
+                self.wakeup_channel.clear()
+            if self.server in r:
+                self.server.handle_request()
         for k, wallet in self.wallets.items():
             wallet.stop_threads()
         if self.network:
             self.print_error("shutting down network")
             self.network.stop()
             self.network.join()
+        self.wakeup_channel.close()
         self.on_stop()
 
     def stop(self):
@@ -0,0 +1,183 @@
+# Electrum - Lightweight Bitcoin Client
+# Copyright (c) 2011-2016 Thomas Voegtlin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict, deque
+
+from .network_stats import Histogram
+from .util import PrintError
+
+# events that only tell that something changed, or carry a status value
+# of which only the latest matters.  Bursts of them are delivered once.
+COALESCED_EVENTS = ['updated', 'status', 'interfaces', 'servers', 'banner', 'fee']
+# how long a coalesced event waits for others, in seconds
+COALESCE_DELAY = 0.1
+# callbacks that take longer than this are reported, in seconds
+SLOW_CALLBACK = 0.5
+
+
+class SubscriberStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        # from the trigger of an event to the start of the callback
+        self.delay = Histogram()
+        self.duration = Histogram()
+
+    def get_stats(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'delay': self.delay.get_stats(),
+            'duration': self.duration.get_stats(),
+        }
+
+
+class EventBus(PrintError):
+    """Callbacks registered for events, like those of the GUI and of
+    plugins.  They are run by a thread of the bus, in the order of the
+    events, so that a slow callback does not hold the thread that
+    triggered the event.  Events of COALESCED_EVENTS wait COALESCE_DELAY
+    for events of the same name, and only the latest one is delivered.
+
+    With threaded=False, callbacks are run by trigger(), as before.
+    """
+
+    def __init__(self, threaded=True, coalesce_delay=COALESCE_DELAY):
+        self.threaded = threaded
+        self.coalesce_delay = coalesce_delay
+        self.callbacks = defaultdict(list)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # [due time, trigger time, event, args], oldest first
+        self.queue = deque()
+        # event -> its entry in the queue, for coalesced events
+        self.pending = {}
+        self.triggered = 0
+        self.coalesced = 0
+        self.subscribers = defaultdict(SubscriberStats)
+        self.thread = None
+        self.running = threaded
+
+    def register(self, callback, events):
+        with self.lock:
+            for event in events:
+                self.callbacks[event].append(callback)
+
+    def unregister(self, callback):
+        with self.lock:
+            for callbacks in self.callbacks.values():
+                if callback in callbacks:
+                    callbacks.remove(callback)
+
+    def trigger(self, event, *args):
+        now = time.time()
+        with self.lock:
+            self.triggered += 1
+            if not self.running:
+                callbacks = self.callbacks[event][:]
+            else:
+                entry = self.pending.get(event)
+                if entry is not None:
+                    # delivered with the latest arguments, at the
+                    # position of the first event of the burst
+                    entry[3] = args
+                    self.coalesced += 1
+                    return
+                if event in COALESCED_EVENTS:
+                    entry = [now + self.coalesce_delay, now, event, args]
+                    self.pending[event] = entry
+                else:
+                    entry = [now, now, event, args]
+                self.queue.append(entry)
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='EventBus')
+                    self.thread.daemon = True
+                    self.thread.start()
+                self.cond.notify()
+                return
+        self.dispatch(now, event, args, callbacks)
+
+    def run(self):
+        while True:
+            with self.lock:
+                while self.running:
+                    if self.queue:
+                        wait = self.queue[0][0] - time.time()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self.cond.wait(wait)
+                if not self.queue:
+                    return
+                entry = self.queue.popleft()
+                due, t, event, args = entry
+                if self.pending.get(event) is entry:
+                    self.pending.pop(event)
+                callbacks = self.callbacks[event][:]
+            self.dispatch(t, event, args, callbacks)
+
+    def dispatch(self, t, event, args, callbacks):
+        for callback in callbacks:
+            name = getattr(callback, '__qualname__', None) or repr(callback)
+            start = time.time()
+            error = False
+            try:
+                callback(event, *args)
+            except BaseException:
+                if not self.threaded:
+                    raise
+                error = True
+                traceback.print_exc(file=sys.stderr)
+            end = time.time()
+            with self.lock:
+                s = self.subscribers[name]
+                s.calls += 1
+                s.errors += error
+                s.delay.add((start - t) * 1000)
+                s.duration.add((end - start) * 1000)
+            if end - start > SLOW_CALLBACK:
+                self.print_error("slow callback for", event, name, "%.3fs" % (end - start))
+
+    def stop(self):
+        '''Delivers the queued events.  Later ones are delivered by trigger().'''
+        with self.lock:
+            self.running = False
+            self.cond.notify()
+            thread = self.thread
+        if thread and thread is not threading.current_thread():
+            thread.join()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'triggered': self.triggered,
+                'coalesced': self.coalesced,
+                'queued': len(self.queue),
+                'subscribers': {name: s.get_stats() for name, s in self.subscribers.items()},
+            }
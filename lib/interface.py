@@ -41,6 +41,68 @@ from . import util
 from . import x509
 from . import pem
 
+# Unanswered requests per server.  The window grows while responses
+# come back fast, and is halved when they are slow, are errors, or do
+# not come at all.
+INITIAL_WINDOW = 10
+MIN_WINDOW = 2
+MAX_WINDOW = 1000
+# responses that took longer than the fastest one by this many seconds
+# were queued by the server: the window is too large
+QUEUE_DELAY = 1.0
+# the fastest latency drifts toward each new one by this fraction, so
+# that a single fast response is forgotten
+MIN_LATENCY_DECAY = 0.05
+# responses whose latency is mostly transfer time, not queueing
+LARGE_RESPONSES = {
+    'blockchain.block.get_chunk',
+}
+# no response for that long shrinks the window
+WINDOW_TIMEOUT = 5
+
+# SSL contexts by CA file, and the last TLS session of each server with
+# its context, so that reconnections resume the session instead of
+# doing a full handshake
+tls_lock = threading.Lock()
+tls_contexts = {}
+tls_sessions = {}
+# sessions can only be resumed since Python 3.6
+TLS_RESUMPTION = hasattr(ssl.SSLSocket, 'session')
+
+
+def get_cached_ssl_context(ca_certs):
+    '''A context that requires a certificate signed by ca_certs, shared
+    by the connections that use the same version of that file'''
+    key = ca_certs, os.stat(ca_certs).st_mtime
+    with tls_lock:
+        context = tls_contexts.get(key)
+        if context is None:
+            context = TcpConnection.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED, ca_certs=ca_certs)
+            tls_contexts[key] = context
+    return context
+
+
+def save_tls_session(server, s):
+    '''Keeps the session of socket s, to be resumed by the next connection
+    to server.  With TLS 1.3 it is only known once data was received.'''
+    session = getattr(s, 'session', None)
+    if session is not None:
+        with tls_lock:
+            tls_sessions[server] = s.context, session
+
+
+def wrap_socket(server, context, s):
+    if not TLS_RESUMPTION:
+        return context.wrap_socket(s, do_handshake_on_connect=True)
+    with tls_lock:
+        cached = tls_sessions.get(server)
+    session = cached[1] if cached and cached[0] is context else None
+    s = context.wrap_socket(s, do_handshake_on_connect=True, session=session)
+    if s.session_reused:
+        print_error(server, "TLS session resumed")
+    save_tls_session(server, s)
+    return s
+
 
 def Connection(server, queue, config_path):
     """Makes asynchronous connections to a remote electrum server.
@@ -141,8 +203,8 @@ class TcpConnection(threading.Thread, util.PrintError):
                     return
                 # try with CA first
                 try:
-                    context = self.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED, ca_certs=ca_path)
-                    s = context.wrap_socket(s, do_handshake_on_connect=True)
+                    context = get_cached_ssl_context(ca_path)
+                    s = wrap_socket(self.server, context, s)
                 except ssl.SSLError as e:
                     print_error(e)
                     s = None
@@ -183,9 +245,12 @@ class TcpConnection(threading.Thread, util.PrintError):
 
         if self.use_ssl:
             try:
-                context = self.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED,
-                                               ca_certs=(temporary_path if is_new else cert_path))
-                s = context.wrap_socket(s, do_handshake_on_connect=True)
+                if is_new:
+                    context = self.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED, ca_certs=temporary_path)
+                    s = context.wrap_socket(s, do_handshake_on_connect=True)
+                else:
+                    context = get_cached_ssl_context(cert_path)
+                    s = wrap_socket(self.server, context, s)
             except socket.timeout:
                 self.print_error('timeout')
                 return
@@ -241,21 +306,33 @@ class Interface(util.PrintError):
     electrum server.  It's exposed API is:
 
     - Member functions close(), fileno(), get_responses(), has_timed_out(),
-      ping_required(), queue_request(), send_requests()
+      ping_required(), queue_request(), send_requests(), window_size()
     - Member variable server.
     """
 
-    def __init__(self, server, socket):
+    def __init__(self, server, socket, pipe=None):
         self.server = server
         self.host, _, _ = server.rsplit(':', 2)
         self.socket = socket
 
-        self.pipe = util.SocketPipe(socket)
-        self.pipe.set_timeout(0.0)  # Don't wait for data
+        if pipe is None:
+            pipe = util.SocketPipe(socket)
+            pipe.set_timeout(0.0)  # Don't wait for data
+        self.pipe = pipe
         # Dump network messages.  Set at runtime from the console.
         self.debug = False
         self.unsent_requests = []
         self.unanswered_requests = {}
+        self.sent_time = {}
+        self.window = INITIAL_WINDOW
+        self.ssthresh = MAX_WINDOW
+        self.min_latency = None
+        self.last_decrease = 0
+        self.window_used = False
+        # round-trip time of the last ping
+        self.ping_time = None
+        # a NetworkStats, set by the network
+        self.stats = None
         # Set last ping to zero to ensure immediate ping
         self.last_request = time.time()
         self.last_ping = 0
@@ -269,6 +346,7 @@ class Interface(util.PrintError):
         return self.socket.fileno()
 
     def close(self):
+        save_tls_session(self.server, self.socket)
         if not self.closed_remotely:
             try:
                 self.socket.shutdown(socket.SHUT_RDWR)
@@ -283,10 +361,60 @@ class Interface(util.PrintError):
         self.request_time = time.time()
         self.unsent_requests.append(args)
 
+    def window_size(self):
+        '''The number of requests that may be unanswered'''
+        return int(self.window)
+
     def num_requests(self):
-        '''Keep unanswered requests below 100'''
-        n = 100 - len(self.unanswered_requests)
-        return min(n, len(self.unsent_requests))
+        '''Keep unanswered requests within the window'''
+        n = self.window_size() - len(self.unanswered_requests)
+        return max(0, min(n, len(self.unsent_requests)))
+
+    def increase_window(self):
+        # only when the window is used, so that it does not grow while idle
+        if not self.window_used:
+            return
+        if self.window < self.ssthresh:
+            # slow start: doubles every round trip
+            self.window += 1
+        else:
+            self.window += 1 / self.window
+        self.window = min(self.window, MAX_WINDOW)
+
+    def decrease_window(self, sent_time):
+        # once per round trip: requests sent before the last decrease
+        # were sent with the larger window
+        if sent_time < self.last_decrease:
+            return
+        self.window = max(self.window / 2, MIN_WINDOW)
+        self.ssthresh = self.window
+        self.last_decrease = time.time()
+        self.print_error("request window", self.window_size())
+
+    def on_response(self, request, response):
+        sent_time = self.sent_time.pop(request[2], None)
+        if sent_time is None:
+            return
+        latency = time.time() - sent_time
+        if request[0] == 'server.version':
+            self.ping_time = latency
+        if self.stats:
+            self.stats.response_received(request[0], latency, response.get('error'))
+        if response.get('error'):
+            self.decrease_window(sent_time)
+            return
+        if request[0] in LARGE_RESPONSES:
+            self.increase_window()
+            return
+        queued = self.min_latency is not None and latency > self.min_latency + QUEUE_DELAY
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        else:
+            self.min_latency += MIN_LATENCY_DECAY * (latency - self.min_latency)
+        if queued:
+            self.decrease_window(sent_time)
+        else:
+            self.increase_window()
 
     def send_requests(self):
         '''Sends queued requests.  Returns False on failure.'''
@@ -299,10 +427,16 @@ class Interface(util.PrintError):
             self.print_error("socket error:", e)
             return False
         self.unsent_requests = self.unsent_requests[n:]
+        now = time.time()
         for request in wire_requests:
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.sent_time[request[2]] = now
+            if self.stats:
+                self.stats.request_sent(request[0])
+        if wire_requests:
+            self.window_used = len(self.unanswered_requests) >= self.window / 2
         return True
 
     def ping_required(self):
@@ -317,6 +451,8 @@ class Interface(util.PrintError):
 
     def has_timed_out(self):
         '''Returns True if the interface has timed out.'''
+        if self.unanswered_requests and self.pipe.idle_time() > WINDOW_TIMEOUT:
+            self.decrease_window(min(self.sent_time.values(), default=0))
         if (self.unanswered_requests and time.time() - self.request_time > 10
             and self.pipe.idle_time() > 10):
             self.print_error("timeout", len(self.unanswered_requests))
@@ -353,6 +489,7 @@ class Interface(util.PrintError):
             else:
                 request = self.unanswered_requests.pop(wire_id, None)
                 if request:
+                    self.on_response(request, response)
                     responses.append((request, response))
                 else:
                     self.print_error("unknown wire ID", wire_id)
@@ -28,7 +28,9 @@ import errno
 import random
 import re
 import select
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from functools import partial
+import concurrent.futures
 import threading
 import socket
 import json
@@ -39,11 +41,47 @@ from . import bitcoin
 from .bitcoin import *
 from .interface import Connection, Interface
 from . import blockchain
+from .broadcast import Broadcaster, BROADCAST_SERVERS
+from .event_bus import EventBus
+from .response_cache import ResponseCache, RESPONSE_CACHE_SIZE
+from .network_stats import NetworkStats
+from .server_stats import ServerStats
+from .synchronizer import history_status
+from .transaction import Transaction
+from .verifier import hash_merkle_root
 from .version import ELECTRUM_VERSION, PROTOCOL_VERSION
 
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+# with auto_connect, a server that connected first becomes our main
+# server if the default server has not connected after this long
+DEFAULT_SERVER_WAIT = 3
+# the network thread waits for sockets and wakeups for at most this
+# long; timeouts, pings and reconnections are checked at this interval
+MAINTENANCE_INTERVAL = 1.0
+# chunks outstanding during a header catch-up
+CHUNK_WINDOW = 4
+# a server that sent a bad chunk is asked for it again after this long,
+# if no other server has it
+CHUNK_RETRY_DELAY = 10
+# headers requested per round trip while looking for the point where
+# the branch of a server forks from ours
+FORK_PROBES = 8
+# client requests that are sent to the least loaded interface on our
+# branch, and whose results are checked before they are used
+SPREAD_METHODS = {
+    'blockchain.transaction.get',
+    'blockchain.transaction.get_merkle',
+    'blockchain.scripthash.get_history',
+}
+# requests whose results never change, once their block is buried
+# under CACHE_DEPTH blocks
+CACHED_METHODS = {
+    'blockchain.transaction.get',
+    'blockchain.transaction.get_merkle',
+}
+CACHE_DEPTH = 6
 
 
 def parse_servers(result):
@@ -99,6 +137,50 @@ def pick_random_server(hostmap = None, protocol = 's', exclude_set = set()):
 
 from .simple_config import SimpleConfig
 
+
+class SocketQueue(queue.Queue):
+    '''Sockets of new connections, put by Connection threads.  The
+    network thread is woken up to take them.'''
+
+    def __init__(self, wakeup):
+        queue.Queue.__init__(self)
+        self.wakeup = wakeup
+
+    def put(self, item, block=True, timeout=None):
+        queue.Queue.put(self, item, block, timeout)
+        self.wakeup()
+
+
+class Subscription(object):
+    '''The callbacks subscribed to a notification, and the last one
+    received.  It is dropped with its last callback.'''
+
+    def __init__(self):
+        self.callbacks = []
+        self.response = None
+
+
+class AddressCallback(object):
+    '''Calls callback with the address of a scripthash request.  It is
+    equal to callback, so that it can be unsubscribed with it.'''
+
+    def __init__(self, callback, address):
+        self.callback = callback
+        self.address = address
+
+    def __call__(self, response):
+        response = response.copy()
+        response['params'] = [self.address]
+        self.callback(response)
+
+    def __eq__(self, other):
+        if isinstance(other, AddressCallback):
+            return self.callback == other.callback and self.address == other.address
+        return self.callback == other
+
+    def __hash__(self):
+        return hash(self.callback)
+
 proxy_modes = ['socks4', 'socks5', 'http']
 
 
@@ -171,6 +253,8 @@ class Network(util.DaemonThread):
         self.blockchain_index = config.get('blockchain_index', 0)
         if self.blockchain_index not in self.blockchains.keys():
             self.blockchain_index = 0
+        self.server_stats = ServerStats(self.config.path)
+        self.stats = NetworkStats()
         # Server for addresses and transactions
         self.default_server = self.config.get('server', None)
         # Sanitize default server
@@ -181,9 +265,13 @@ class Network(util.DaemonThread):
                 self.print_error('Warning: failed to parse server-string; falling back to random.')
                 self.default_server = None
         if not self.default_server:
-            self.default_server = pick_random_server()
+            self.default_server = self.pick_server()
+        self.default_server_time = 0
         self.lock = threading.Lock()
+        self.wakeup_channel = util.Wakeup()
         self.pending_sends = []
+        # functions to run on the network thread, with their futures
+        self.pending_calls = []
         self.message_id = 0
         self.debug = False
         self.irc_servers = {} # returned by interface (list from irc)
@@ -192,11 +280,10 @@ class Network(util.DaemonThread):
         self.banner = ''
         self.donation_address = ''
         self.relay_fee = None
-        # callbacks passed with subscriptions
-        self.subscriptions = defaultdict(list)
-        self.sub_cache = {}
-        # callbacks set by the GUI
-        self.callbacks = defaultdict(list)
+        # index -> Subscription, for the callbacks passed with subscriptions
+        self.subscriptions = {}
+        # callbacks set by the GUI and plugins, run by a thread of the bus
+        self.event_bus = EventBus(self.config.get('threaded_callbacks', True))
 
         dir_path = os.path.join( self.config.path, 'certs')
         if not os.path.exists(dir_path):
@@ -205,9 +292,17 @@ class Network(util.DaemonThread):
 
         # subscriptions and requests
         self.subscribed_addresses = set()
-        self.h2addr = {}
-        # Requests from client we've not seen a response to
+        # Requests from client we've not seen a response to:
+        # message_id -> (method, params, callback, server)
         self.unanswered_requests = {}
+        self.spread_requests = self.config.get('spread_requests', True)
+        # immutable results, shared by the wallets of the daemon
+        cache_size = self.config.get('response_cache_size', RESPONSE_CACHE_SIZE)
+        cache_path = os.path.join(self.config.path, 'response_cache') if self.config.path else None
+        self.response_cache = ResponseCache(cache_path, cache_size * 2**20)
+        # transactions are sent to several servers, and queued if none answers
+        self.broadcast_servers = self.config.get('broadcast_servers', BROADCAST_SERVERS)
+        self.broadcaster = Broadcaster(self.config.path)
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
@@ -218,26 +313,30 @@ class Network(util.DaemonThread):
         self.interfaces = {}
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
-        self.requested_chunks = set()
-        self.socket_queue = queue.Queue()
+        # header catch-up: chunk index -> (server, blockchain) for
+        # requests in flight, and (server, blockchain, data) for chunks
+        # not connected yet.  failed_chunks holds the servers that sent
+        # a bad chunk, with the time, so that it is requested elsewhere;
+        # they are asked again after CHUNK_RETRY_DELAY.
+        self.chunk_window = self.config.get('chunk_window', CHUNK_WINDOW)
+        self.requested_chunks = {}
+        self.received_chunks = {}
+        self.failed_chunks = defaultdict(dict)
+        # header chunks are verified in this many processes
+        self.verify_processes = self.config.get('verify_processes', 0)
+        self.chunk_executor = None
+        self.socket_queue = SocketQueue(self.wakeup)
         self.start_network(deserialize_server(self.default_server)[2],
                            deserialize_proxy(self.config.get('proxy')))
 
     def register_callback(self, callback, events):
-        with self.lock:
-            for event in events:
-                self.callbacks[event].append(callback)
+        self.event_bus.register(callback, events)
 
     def unregister_callback(self, callback):
-        with self.lock:
-            for callbacks in self.callbacks.values():
-                if callback in callbacks:
-                    callbacks.remove(callback)
+        self.event_bus.unregister(callback)
 
     def trigger_callback(self, event, *args):
-        with self.lock:
-            callbacks = self.callbacks[event][:]
-        [callback(event, *args) for callback in callbacks]
+        self.event_bus.trigger(event, *args)
 
     def read_recent_servers(self):
         if not self.config.path:
@@ -260,6 +359,7 @@ class Network(util.DaemonThread):
                 f.write(s)
         except:
             pass
+        self.server_stats.save()
 
     def get_server_height(self):
         return self.interface.tip if self.interface else 0
@@ -302,16 +402,24 @@ class Network(util.DaemonThread):
 
     def send_subscriptions(self):
         self.print_error('sending subscriptions to', self.interface.server, len(self.unanswered_requests), len(self.subscribed_addresses))
-        self.sub_cache.clear()
-        # Resend unanswered requests
-        requests = self.unanswered_requests.values()
+        with self.lock:
+            for subscription in self.subscriptions.values():
+                subscription.response = None
+        # Resend unanswered requests, but those in flight on another
+        # server. A broadcast is never resent: the broadcaster counts
+        # answers by server, and connection_down fails it if its server
+        # is lost
+        requests = self.unanswered_requests
         self.unanswered_requests = {}
         if self.interface.ping_required():
             params = [ELECTRUM_VERSION, PROTOCOL_VERSION]
             self.queue_request('server.version', params, self.interface)
-        for request in requests:
-            message_id = self.queue_request(request[0], request[1])
-            self.unanswered_requests[message_id] = request
+        for message_id, (method, params, callback, server) in requests.items():
+            if (method in SPREAD_METHODS and server in self.interfaces
+                    or method == 'blockchain.transaction.broadcast'):
+                self.unanswered_requests[message_id] = method, params, callback, server
+                continue
+            self.queue_client_request(method, params, callback, self.interface)
         self.queue_request('server.banner', [])
         self.queue_request('server.donation_address', [])
         self.queue_request('server.peers.subscribe', [])
@@ -358,6 +466,11 @@ class Network(util.DaemonThread):
         '''The interfaces that are in connected state'''
         return list(self.interfaces.keys())
 
+    def get_request_windows(self):
+        '''The size of the request window of each connected server'''
+        return {server: interface.window_size()
+                for server, interface in list(self.interfaces.items())}
+
     def get_servers(self):
         out = bitcoin.NetworkConstants.DEFAULT_SERVERS
         if self.irc_servers:
@@ -377,12 +490,26 @@ class Network(util.DaemonThread):
             if server == self.default_server:
                 self.print_error("connecting to %s as new interface" % server)
                 self.set_status('connecting')
+                self.default_server_time = time.time()
             self.connecting.add(server)
-            c = Connection(server, self.socket_queue, self.config.path)
+            self.server_stats.start_connecting(server)
+            self.connect(server)
+
+    def connect(self, server):
+        '''Start connecting to server.  The result is put on socket_queue.'''
+        Connection(server, self.socket_queue, self.config.path)
+
+    def pick_server(self, hostmap=None, protocol='s', exclude_set=set()):
+        '''Like pick_random_server, but among the servers that were the
+        fastest and most reliable so far'''
+        if hostmap is None:
+            hostmap = bitcoin.NetworkConstants.DEFAULT_SERVERS
+        eligible = set(filter_protocol(hostmap, protocol)) - exclude_set
+        return self.server_stats.pick(eligible)
 
     def start_random_interface(self):
         exclude_set = self.disconnected_servers.union(set(self.interfaces))
-        server = pick_random_server(self.get_servers(), self.protocol, exclude_set)
+        server = self.pick_server(self.get_servers(), self.protocol, exclude_set)
         if server:
             self.start_interface(server)
 
@@ -430,9 +557,10 @@ class Network(util.DaemonThread):
             self.close_interface(self.interface)
         assert self.interface is None
         assert not self.interfaces
+        self.server_stats.save()
         self.connecting = set()
         # Get a new queue - no old pending connections thanks!
-        self.socket_queue = queue.Queue()
+        self.socket_queue = SocketQueue(self.wakeup)
 
     def set_parameters(self, host, port, protocol, proxy, auto_connect):
         proxy_str = serialize_proxy(proxy)
@@ -463,13 +591,22 @@ class Network(util.DaemonThread):
             self.switch_lagging_interface()
             self.notify('updated')
 
+    def default_server_late(self):
+        '''Whether the default server failed to connect, or is taking
+        longer than DEFAULT_SERVER_WAIT'''
+        if self.default_server in self.interfaces:
+            return False
+        return (self.default_server not in self.connecting
+                or time.time() - self.default_server_time > DEFAULT_SERVER_WAIT)
+
     def switch_to_random_interface(self):
-        '''Switch to a random connected server other than the current one'''
+        '''Switch to one of the best connected servers other than the
+        current one'''
         servers = self.get_interfaces()    # Those in connected state
         if self.default_server in servers:
             servers.remove(self.default_server)
         if servers:
-            self.switch_to_interface(random.choice(servers))
+            self.switch_to_interface(self.server_stats.pick(servers))
 
     def switch_lagging_interface(self):
         '''If auto_connect and lagging, switch interface'''
@@ -478,7 +615,7 @@ class Network(util.DaemonThread):
             header = self.blockchain().read_header(self.get_local_height())
             filtered = list(map(lambda x:x[0], filter(lambda x: x[1].tip_header==header, self.interfaces.items())))
             if filtered:
-                choice = random.choice(filtered)
+                choice = self.server_stats.pick(filtered)
                 self.switch_to_interface(choice)
 
     def switch_to_interface(self, server):
@@ -508,6 +645,7 @@ class Network(util.DaemonThread):
                 self.interfaces.pop(interface.server)
             if interface.server == self.default_server:
                 self.interface = None
+            self.stats.connection_closed(interface.pipe)
             interface.close()
 
     def add_recent_server(self, server):
@@ -529,6 +667,8 @@ class Network(util.DaemonThread):
         # We handle some responses; return the rest to the client.
         if method == 'server.version':
             interface.server_version = result
+            if error is None and interface.ping_time is not None:
+                self.server_stats.ping(interface.server, interface.ping_time)
         elif method == 'blockchain.headers.subscribe':
             if error is None:
                 self.on_notify_header(interface, result)
@@ -560,7 +700,9 @@ class Network(util.DaemonThread):
             self.on_get_header(interface, response)
 
         for callback in callbacks:
+            t0 = time.perf_counter()
             callback(response)
+            self.stats.callback_done(method, time.perf_counter() - t0)
 
     def get_index(self, method, params):
         """ hashable index for subscriptions and cache"""
@@ -573,23 +715,27 @@ class Network(util.DaemonThread):
                 method, params, message_id = request
                 k = self.get_index(method, params)
                 # client requests go through self.send() with a
-                # callback, are only sent to the current interface,
-                # and are placed in the unanswered_requests dictionary
+                # callback, and are placed in the unanswered_requests
+                # dictionary.  Those in SPREAD_METHODS may have been
+                # sent to another interface than the current one.
                 client_req = self.unanswered_requests.pop(message_id, None)
                 if client_req:
-                    assert interface == self.interface
+                    if interface != self.interface and not self.check_response(response, client_req):
+                        continue
+                    if method in CACHED_METHODS and not response.get('error'):
+                        self.cache_response(method, params, response.get('result'))
                     callbacks = [client_req[2]]
                 else:
                     # fixme: will only work for subscriptions
                     k = self.get_index(method, params)
-                    callbacks = self.subscriptions.get(k, [])
+                    callbacks = self.get_callbacks(k)
 
                 # Copy the request method and params to the response
                 response['method'] = method
                 response['params'] = params
                 # Only once we've received a response to an addr subscription
                 # add it to the list; avoids double-sends on reconnection
-                if method == 'blockchain.scripthash.subscribe':
+                if method == 'blockchain.scripthash.subscribe' and k in self.subscriptions:
                     self.subscribed_addresses.add(params[0])
             else:
                 if not response:  # Closed remotely / misbehaving
@@ -605,43 +751,65 @@ class Network(util.DaemonThread):
                 elif method == 'blockchain.scripthash.subscribe':
                     response['params'] = [params[0]]  # addr
                     response['result'] = params[1]
-                callbacks = self.subscriptions.get(k, [])
+                callbacks = self.get_callbacks(k)
 
             # update cache if it's a subscription
-            if method.endswith('.subscribe'):
-                self.sub_cache[k] = response
+            subscription = self.subscriptions.get(k)
+            if subscription and method.endswith('.subscribe'):
+                subscription.response = response
             # Response is now in canonical form
             self.process_response(interface, response, callbacks)
 
+    def get_callbacks(self, k):
+        with self.lock:
+            subscription = self.subscriptions.get(k)
+            return list(subscription.callbacks) if subscription else []
+
     def addr_to_scripthash(self, addr):
-        h = bitcoin.address_to_scripthash(addr)
-        if h not in self.h2addr:
-            self.h2addr[h] = addr
-        return h
-
-    def overload_cb(self, callback):
-        def cb2(x):
-            x2 = x.copy()
-            p = x2.pop('params')
-            addr = self.h2addr[p[0]]
-            x2['params'] = [addr]
-            callback(x2)
-        return cb2
+        return bitcoin.address_to_scripthash(addr)
 
     def subscribe_to_addresses(self, addresses, callback):
-        hashes = [self.addr_to_scripthash(addr) for addr in addresses]
-        msgs = [('blockchain.scripthash.subscribe', [x]) for x in hashes]
-        self.send(msgs, self.overload_cb(callback))
+        with self.lock:
+            for addr in addresses:
+                h = self.addr_to_scripthash(addr)
+                msg = ('blockchain.scripthash.subscribe', [h])
+                self.pending_sends.append(([msg], AddressCallback(callback, addr)))
+        self.wakeup()
 
     def request_address_history(self, address, callback):
         h = self.addr_to_scripthash(address)
-        self.send([('blockchain.scripthash.get_history', [h])], self.overload_cb(callback))
+        self.send([('blockchain.scripthash.get_history', [h])], AddressCallback(callback, address))
 
     def send(self, messages, callback):
         '''Messages is a list of (method, params) tuples'''
         messages = list(messages)
         with self.lock:
             self.pending_sends.append((messages, callback))
+        self.wakeup()
+
+    def wakeup(self):
+        self.wakeup_channel.set()
+
+    def run_in_network_thread(self, func, timeout=None):
+        '''Runs func on the network thread, which owns the headers
+        files and the interfaces, and returns its result'''
+        if threading.current_thread() is self or not self.is_alive():
+            return func()
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.pending_calls.append((func, future))
+        self.wakeup()
+        return future.result(timeout)
+
+    def run_pending_calls(self):
+        with self.lock:
+            calls = self.pending_calls
+            self.pending_calls = []
+        for func, future in calls:
+            try:
+                future.set_result(func())
+            except BaseException as e:
+                future.set_exception(e)
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -656,31 +824,204 @@ class Network(util.DaemonThread):
         for messages, callback in sends:
             for method, params in messages:
                 r = None
+                k = self.get_index(method, params)
                 if method.endswith('.subscribe'):
-                    k = self.get_index(method, params)
-                    # add callback to list
-                    l = self.subscriptions.get(k, [])
-                    if callback not in l:
-                        l.append(callback)
-                    self.subscriptions[k] = l
-                    # check cached response for subscriptions
-                    r = self.sub_cache.get(k)
+                    with self.lock:
+                        subscription = self.subscriptions.get(k)
+                        if subscription is None:
+                            subscription = self.subscriptions[k] = Subscription()
+                        if callback not in subscription.callbacks:
+                            subscription.callbacks.append(callback)
+                        # check cached response for subscriptions
+                        r = subscription.response
+                elif method in CACHED_METHODS:
+                    r = self.get_cached_response(method, params)
                 if r is not None:
                     util.print_error("cache hit", k)
                     callback(r)
                 else:
-                    message_id = self.queue_request(method, params)
-                    self.unanswered_requests[message_id] = method, params, callback
+                    interface = self.get_request_interface(method, params)
+                    self.queue_client_request(method, params, callback, interface)
+        self.process_broadcasts()
+
+    def get_broadcast_interfaces(self):
+        '''Our main interface, and the best of the others on our branch'''
+        others = [i.server for i in self.interfaces.values()
+                  if i is not self.interface and i.mode == 'default'
+                  and i.blockchain is self.interface.blockchain]
+        best = self.server_stats.rank(others)[:self.broadcast_servers - 1]
+        return [self.interface] + [self.interfaces[server] for server in best]
+
+    def process_broadcasts(self):
+        for txid, raw, future in self.broadcaster.get_pending():
+            interfaces = self.get_broadcast_interfaces()
+            b = self.broadcaster.start(txid, raw, [i.server for i in interfaces], future)
+            if b is None:
+                continue
+            self.print_error("broadcasting", txid, "to", len(interfaces), "servers")
+            for interface in interfaces:
+                callback = partial(self.broadcaster.on_response, b, interface.server)
+                self.queue_client_request('blockchain.transaction.broadcast', [raw], callback, interface)
+
+    def get_block_hash(self, height):
+        header = self.blockchain().read_header(height)
+        return blockchain.hash_header(header) if header else None
+
+    def get_cached_response(self, method, params):
+        if method == 'blockchain.transaction.get' and len(params) > 1:
+            return
+        is_valid = lambda height, block_hash: self.get_block_hash(height) == block_hash
+        result = self.response_cache.get(method, params, is_valid)
+        if result is not None:
+            return {'method': method, 'params': params, 'result': result}
+
+    def cache_response(self, method, params, result):
+        '''Caches the result of a request in CACHED_METHODS, if it is
+        right and cannot change'''
+        try:
+            if method == 'blockchain.transaction.get':
+                if len(params) == 1 and Transaction(result).txid() == params[0]:
+                    self.response_cache.put(method, params, result)
+            elif method == 'blockchain.transaction.get_merkle':
+                height = result['block_height']
+                if self.get_local_height() - height + 1 < CACHE_DEPTH:
+                    return
+                header = self.blockchain().read_header(height)
+                merkle_root = hash_merkle_root(result['merkle'], params[0], result['pos'])
+                if header and header.get('merkle_root') == merkle_root:
+                    self.response_cache.put(method, params, result, height, blockchain.hash_header(header))
+        except Exception as e:
+            self.print_error("cannot cache", method, params, repr(e))
+
+    def get_cache_stats(self):
+        return self.response_cache.get_stats()
+
+    def queue_client_request(self, method, params, callback, interface):
+        message_id = self.queue_request(method, params, interface)
+        self.unanswered_requests[message_id] = method, params, callback, interface.server
+
+    def get_request_interface(self, method, params):
+        '''The interface a client request is sent to.  Requests whose
+        result can be checked go to the least loaded of the interfaces
+        that are on our branch and at our height, relative to the size
+        of their request window.'''
+        if not self.spread_requests or method not in SPREAD_METHODS:
+            return self.interface
+        if method == 'blockchain.transaction.get' and len(params) > 1:
+            # a verbose result cannot be checked
+            return self.interface
+        if method == 'blockchain.scripthash.get_history':
+            # checked against the status sent by our server
+            k = self.get_index('blockchain.scripthash.subscribe', params)
+            subscription = self.subscriptions.get(k)
+            if subscription is None or subscription.response is None:
+                return self.interface
+        candidates = [self.interface]
+        for interface in self.interfaces.values():
+            if (interface is not self.interface and interface.mode == 'default'
+                    and interface.blockchain is self.interface.blockchain
+                    and interface.tip >= self.interface.tip):
+                candidates.append(interface)
+        def load(interface):
+            n = len(interface.unsent_requests) + len(interface.unanswered_requests)
+            return n / interface.window_size()
+        return min(candidates, key=load)
+
+    def check_response(self, response, request):
+        '''Checks the response of a server that is not our main server
+        to a client request.  If it is wrong, or an error, the request
+        is sent to our main server instead.'''
+        method, params, callback, server = request
+        result = response.get('result')
+        error = response.get('error')
+        try:
+            if method == 'blockchain.transaction.broadcast':
+                # the broadcaster handles errors
+                ok = True
+            elif error:
+                ok = False
+            elif method == 'blockchain.transaction.get':
+                ok = len(params) == 1 and Transaction(result).txid() == params[0]
+            elif method == 'blockchain.transaction.get_merkle':
+                # the verifier needs the header; a server that is
+                # behind may not have the transaction in a block yet
+                header = self.blockchain().read_header(result['block_height'])
+                merkle_root = hash_merkle_root(result['merkle'], params[0], result['pos'])
+                ok = header is not None and header.get('merkle_root') == merkle_root
+            elif method == 'blockchain.scripthash.get_history':
+                k = self.get_index('blockchain.scripthash.subscribe', params)
+                status = self.subscriptions[k].response['result']
+                hist = [(item['tx_hash'], item['height']) for item in result]
+                ok = history_status(hist) == status
+            else:
+                ok = True
+        except Exception as e:
+            self.print_error(server, "bad response", method, params, repr(e))
+            ok = False
+        if ok:
+            return True
+        self.print_error(server, "wrong response to", method, params, error)
+        if self.interface:
+            self.queue_client_request(method, params, callback, self.interface)
+        else:
+            self.requeue(method, params, callback)
+        return False
+
+    def requeue(self, method, params, callback):
+        with self.lock:
+            self.pending_sends.append(([(method, params)], callback))
 
     def unsubscribe(self, callback):
-        '''Unsubscribe a callback to free object references to enable GC.'''
+        '''Unsubscribe a callback to free object references to enable GC.
+        Subscriptions left without callbacks are dropped, with their
+        cached response, and are not sent again on reconnection.'''
         # Note: we can't unsubscribe from the server, so if we receive
         # subsequent notifications process_response() will emit a harmless
         # "received unexpected notification" warning
         with self.lock:
-            for v in self.subscriptions.values():
-                if callback in v:
-                    v.remove(callback)
+            for k, subscription in list(self.subscriptions.items()):
+                subscription.callbacks = [c for c in subscription.callbacks if not c == callback]
+                if not subscription.callbacks:
+                    self.subscriptions.pop(k)
+                    method, _, h = k.partition(':')
+                    if method == 'blockchain.scripthash.subscribe':
+                        self.subscribed_addresses.discard(h)
+
+    def get_subscription_stats(self):
+        '''Sizes of the subscription state, to watch memory use'''
+        with self.lock:
+            return {
+                'subscriptions': len(self.subscriptions),
+                'callbacks': sum(len(s.callbacks) for s in self.subscriptions.values()),
+                'cached_responses': sum(s.response is not None for s in self.subscriptions.values()),
+                'subscribed_addresses': len(self.subscribed_addresses),
+            }
+
+    def get_network_stats(self):
+        '''Counters and queue depths, for monitoring'''
+        stats = self.stats.get_stats()
+        interfaces = list(self.interfaces.values())
+        stats['bytes_sent'] = self.stats.bytes_sent + sum(i.pipe.bytes_sent for i in interfaces)
+        stats['bytes_received'] = self.stats.bytes_received + sum(i.pipe.bytes_received for i in interfaces)
+        stats['queues'] = {
+            'pending_sends': len(self.pending_sends),
+            'unanswered_requests': len(self.unanswered_requests),
+            'unsent_requests': sum(len(i.unsent_requests) for i in interfaces),
+        }
+        stats['interfaces'] = {
+            i.server: {
+                'unsent_requests': len(i.unsent_requests),
+                'unanswered_requests': len(i.unanswered_requests),
+                'window': i.window_size(),
+                'bytes_sent': i.pipe.bytes_sent,
+                'bytes_received': i.pipe.bytes_received,
+            } for i in interfaces
+        }
+        stats['subscriptions'] = self.get_subscription_stats()
+        stats['response_cache'] = self.get_cache_stats()
+        stats['events'] = self.event_bus.get_stats()
+        stats['broadcast'] = self.broadcaster.get_stats()
+        return stats
 
     def connection_down(self, server):
         '''A connection to server either went down, or was never made.
@@ -691,25 +1032,51 @@ class Network(util.DaemonThread):
         if server in self.interfaces:
             self.close_interface(self.interfaces[server])
             self.notify('interfaces')
+        else:
+            self.server_stats.connection_failed(server)
         for b in self.blockchains.values():
             if b.catch_up == server:
                 b.catch_up = None
+        # requests on our main server are sent again by
+        # send_subscriptions
+        for message_id, (method, params, callback, s) in list(self.unanswered_requests.items()):
+            if s == server and method in SPREAD_METHODS:
+                self.unanswered_requests.pop(message_id)
+                self.requeue(method, params, callback)
+            elif s == server and method == 'blockchain.transaction.broadcast':
+                self.unanswered_requests.pop(message_id)
+                callback({'method': method, 'params': params, 'error': 'connection closed'})
+        for index, (s, b) in list(self.requested_chunks.items()):
+            if s == server:
+                self.requested_chunks.pop(index)
 
     def new_interface(self, server, socket):
         # todo: get tip first, then decide which checkpoint to use.
+        self.server_stats.connected(server)
         self.add_recent_server(server)
-        interface = Interface(server, socket)
+        interface = self.create_interface(server, socket)
+        interface.stats = self.stats
         interface.blockchain = None
         interface.tip_header = None
         interface.tip = 0
         interface.mode = 'default'
         interface.request = None
+        interface.probes = {}
         self.interfaces[server] = interface
         self.queue_request('blockchain.headers.subscribe', [], interface)
         if server == self.default_server:
             self.switch_to_interface(server)
+        elif self.auto_connect and self.interface is None and self.default_server_late():
+            # the servers are connected to in parallel: if the default
+            # server is late, the first one to answer becomes our main
+            # server
+            self.print_error("connected first:", server)
+            self.switch_to_interface(server)
         #self.notify('interfaces')
 
+    def create_interface(self, server, socket):
+        return Interface(server, socket)
+
     def maintain_sockets(self):
         '''Socket maintenance.'''
         # Responses to connection attempts?
@@ -726,6 +1093,7 @@ class Network(util.DaemonThread):
         # must use copy of values
         for interface in list(self.interfaces.values()):
             if interface.has_timed_out():
+                self.server_stats.timed_out(interface.server)
                 self.connection_down(interface.server)
             elif interface.ping_required():
                 params = [ELECTRUM_VERSION, PROTOCOL_VERSION]
@@ -743,7 +1111,7 @@ class Network(util.DaemonThread):
         # main interface
         if not self.is_connected():
             if self.auto_connect:
-                if not self.is_connecting():
+                if not self.is_connecting() or self.default_server_late():
                     self.switch_to_random_interface()
             else:
                 if self.default_server in self.disconnected_servers:
@@ -756,117 +1124,255 @@ class Network(util.DaemonThread):
             if self.config.is_fee_estimates_update_required():
                 self.request_fee_estimates()
 
-    def request_chunk(self, interface, index):
-        if index in self.requested_chunks:
+    def get_chunk_executor(self):
+        if self.chunk_executor is None and self.verify_processes > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            self.chunk_executor = ProcessPoolExecutor(self.verify_processes)
+        return self.chunk_executor
+
+    def request_chunk(self, interface, index, blockchain=None):
+        b = blockchain or interface.blockchain
+        if index in self.requested_chunks or b is None:
             return
         interface.print_error("requesting chunk %d" % index)
-        self.requested_chunks.add(index)
+        self.requested_chunks[index] = interface.server, b
         self.queue_request('blockchain.block.get_chunk', [index], interface)
 
+    def chunk_sources(self, lead, index):
+        '''Interfaces that can serve chunk index for the catch-up of
+        lead: those that follow the same branch'''
+        height = min(index * 2016 + 2015, lead.tip)
+        failed = self.failed_chunks.get(index, {})
+        return [i for i in self.interfaces.values()
+                if (i is lead or i.blockchain is lead.blockchain)
+                and i.tip >= height and i.server not in failed]
+
+    def fill_chunk_window(self, lead):
+        '''Keep chunk_window chunks in flight for the catch-up of lead,
+        spread over the least busy interfaces'''
+        b = lead.blockchain
+        load = defaultdict(int)
+        in_flight = 0
+        for server, blockchain in self.requested_chunks.values():
+            load[server] += 1
+            if blockchain == b:
+                in_flight += 1
+        index = (b.height() + 1) // 2016
+        while in_flight < self.chunk_window and index <= lead.tip // 2016:
+            if index not in self.requested_chunks and index not in self.received_chunks:
+                sources = self.chunk_sources(lead, index)
+                if not sources:
+                    break
+                interface = min(sources, key=lambda i: load[i.server])
+                self.request_chunk(interface, index, b)
+                load[interface.server] += 1
+                in_flight += 1
+            index += 1
+
     def on_get_chunk(self, interface, response):
         '''Handle receiving a chunk of block headers'''
         error = response.get('error')
         result = response.get('result')
         params = response.get('params')
-        if result is None or params is None or error is not None:
+        if params is None:
             interface.print_error(error or 'bad response')
             return
         index = params[0]
         # Ignore unsolicited chunks
-        if index not in self.requested_chunks:
-            return
-        self.requested_chunks.remove(index)
-        connect = interface.blockchain.connect_chunk(index, result)
-        if not connect:
-            self.connection_down(interface.server)
+        server, b = self.requested_chunks.get(index, (None, None))
+        if server != interface.server:
             return
-        # If not finished, get the next chunk
-        if interface.blockchain.height() < interface.tip:
-            self.request_chunk(interface, index+1)
+        self.requested_chunks.pop(index)
+        if result is None or error is not None:
+            interface.print_error(error or 'bad response')
+            self.failed_chunks[index][server] = time.time()
         else:
-            interface.mode = 'default'
-            interface.print_error('catch up done', interface.blockchain.height())
-            interface.blockchain.catch_up = None
+            self.received_chunks[index] = server, b, result
+            self.connect_received_chunks(b)
+        # If not finished, get the next chunks
+        lead = self.interfaces.get(b.catch_up)
+        if lead and lead.mode == 'catch_up' and lead.blockchain == b:
+            if b.height() < lead.tip:
+                self.fill_chunk_window(lead)
+            else:
+                lead.mode = 'default'
+                lead.print_error('catch up done', b.height())
+                b.catch_up = None
         self.notify('updated')
 
+    def connect_received_chunks(self, b):
+        '''Connect the received chunks of blockchain b that follow its
+        tip, or that are below the checkpoints, in runs of consecutive
+        chunks.  A run is held back while the chunk extending it is in
+        flight, so that it can be verified in one batch.'''
+        batch = max(1, self.verify_processes)
+        num_checkpoints = len(bitcoin.NetworkConstants.CHECKPOINTS)
+        while True:
+            next_index = (b.height() + 1) // 2016
+            mine = [i for i, (s, bc, d) in self.received_chunks.items() if bc == b]
+            for i in mine:
+                if num_checkpoints <= i < next_index:
+                    self.received_chunks.pop(i)
+            if next_index in mine:
+                start = next_index
+            else:
+                below = [i for i in mine if i < num_checkpoints]
+                if not below:
+                    return
+                start = min(below)
+            end = start
+            while end + 1 in mine:
+                end += 1
+            if end - start + 1 < batch and end + 1 in self.requested_chunks:
+                return
+            run = [self.received_chunks.pop(i) for i in range(start, end + 1)]
+            n = b.connect_chunks(start, [data for s, bc, data in run], self.get_chunk_executor())
+            for i in range(start, start + n):
+                self.failed_chunks.pop(i, None)
+            if n == len(run):
+                continue
+            # keep the chunks after the bad one, ask another server for it
+            for i, item in enumerate(run[n+1:], start + n + 1):
+                self.received_chunks[i] = item
+            server = run[n][0]
+            self.failed_chunks[start + n][server] = time.time()
+            if server == b.catch_up or start + n < num_checkpoints:
+                self.connection_down(server)
+            return
+
     def request_header(self, interface, height):
-        #interface.print_error("requesting header %d" % height)
-        self.queue_request('blockchain.block.get_header', [height], interface)
-        interface.request = height
+        self.request_headers(interface, [height])
+
+    def request_headers(self, interface, heights):
+        '''Headers requested together are handled together, when the
+        last one is received'''
+        interface.request = sorted(set(heights))
+        interface.probes = {}
+        for height in interface.request:
+            self.queue_request('blockchain.block.get_header', [height], interface)
         interface.req_time = time.time()
 
+    def backward_probes(self, start, step):
+        '''start and heights below it at doubling distances, but not
+        below the last checkpoint'''
+        floor = self.max_checkpoint()
+        distances = [0] + [2**i for i in range(FORK_PROBES - 1)]
+        return [max(floor, start - d * step) for d in distances]
+
+    def binary_probes(self, interface):
+        '''Heights that split the range between good and bad evenly'''
+        good, bad = interface.good, interface.bad
+        n = min(FORK_PROBES, bad - good - 1)
+        return [good + (bad - good) * i // (n + 1) for i in range(1, n + 1)]
+
     def on_get_header(self, interface, response):
-        '''Handle receiving a single block header'''
+        '''Handle receiving a block header.  To find where the branch
+        of a server forks from ours, several heights are probed at once
+        in the backward and binary modes.'''
         header = response.get('result')
         if not header:
             interface.print_error(response)
             self.connection_down(interface.server)
             return
         height = header.get('block_height')
-        if interface.request != height:
+        if not interface.request or height not in interface.request:
             interface.print_error("unsolicited header",interface.request, height)
             self.connection_down(interface.server)
             return
-        chain = blockchain.check_header(header)
+        interface.probes[height] = header
+        if len(interface.probes) < len(interface.request):
+            return
+        headers = [interface.probes[h] for h in interface.request]
+        next_heights = None
         if interface.mode == 'backward':
-            can_connect = blockchain.can_connect(header)
-            if can_connect and can_connect.catch_up is None:
-                interface.mode = 'catch_up'
-                interface.blockchain = can_connect
-                interface.blockchain.save_header(header)
-                next_height = height + 1
-                interface.blockchain.catch_up = interface.server
-            elif chain:
-                interface.print_error("binary search")
-                interface.mode = 'binary'
-                interface.blockchain = chain
-                interface.good = height
-                next_height = (interface.bad + interface.good) // 2
-                assert next_height >= self.max_checkpoint(), (interface.bad, interface.good)
+            # from the highest, as if they had been requested one by one
+            for header in reversed(headers):
+                height = header['block_height']
+                can_connect = blockchain.can_connect(header)
+                chain = blockchain.check_header(header)
+                if can_connect and can_connect.catch_up is None:
+                    interface.mode = 'catch_up'
+                    interface.blockchain = can_connect
+                    interface.blockchain.save_header(header)
+                    next_heights = [height + 1]
+                    interface.blockchain.catch_up = interface.server
+                    break
+                elif chain:
+                    interface.print_error("binary search")
+                    interface.mode = 'binary'
+                    interface.blockchain = chain
+                    interface.good = height
+                    interface.good_header = header
+                    break
+                interface.bad = height
+                interface.bad_header = header
             else:
-                if height == 0:
+                if height <= self.max_checkpoint():
                     self.connection_down(interface.server)
-                    next_height = None
                 else:
-                    interface.bad = height
-                    interface.bad_header = header
-                    delta = interface.tip - height
-                    next_height = max(self.max_checkpoint(), interface.tip - 2 * delta)
+                    next_heights = self.backward_probes(height - 1, interface.tip - height)
 
         elif interface.mode == 'binary':
-            if chain:
+            # the headers of the server are ours up to the fork point
+            for header in headers:
+                height = header['block_height']
+                chain = blockchain.check_header(header)
+                if not chain:
+                    interface.bad = height
+                    interface.bad_header = header
+                    break
                 interface.good = height
+                interface.good_header = header
                 interface.blockchain = chain
+
+        elif interface.mode == 'catch_up':
+            header = headers[0]
+            height = header['block_height']
+            can_connect = interface.blockchain.can_connect(header)
+            if can_connect:
+                interface.blockchain.save_header(header)
+                next_heights = [height + 1] if height < interface.tip else None
             else:
+                # go back
+                interface.print_error("cannot connect", height)
+                interface.mode = 'backward'
                 interface.bad = height
                 interface.bad_header = header
+                next_heights = self.backward_probes(height - 1, 1)
+
+            if next_heights is None:
+                # exit catch_up state
+                interface.print_error('catch up done', interface.blockchain.height())
+                interface.blockchain.catch_up = None
+                self.switch_lagging_interface()
+                self.notify('updated')
+
+        else:
+            raise BaseException(interface.mode)
+
+        if interface.mode == 'binary':
             if interface.bad != interface.good + 1:
-                next_height = (interface.bad + interface.good) // 2
-                assert next_height >= self.max_checkpoint()
+                next_heights = self.binary_probes(interface)
             elif not interface.blockchain.can_connect(interface.bad_header, check_height=False):
                 self.connection_down(interface.server)
-                next_height = None
             else:
                 branch = self.blockchains.get(interface.bad)
                 if branch is not None:
                     if branch.check_header(interface.bad_header):
                         interface.print_error('joining chain', interface.bad)
-                        next_height = None
-                    elif branch.parent().check_header(header):
+                    elif branch.parent().check_header(interface.bad_header):
                         interface.print_error('reorg', interface.bad, interface.tip)
                         interface.blockchain = branch.parent()
-                        next_height = None
                     else:
                         interface.print_error('checkpoint conflicts with existing fork', branch.path())
-                        branch.write('', 0)
+                        branch.write(b'', 0)
                         branch.save_header(interface.bad_header)
                         interface.mode = 'catch_up'
                         interface.blockchain = branch
-                        next_height = interface.bad + 1
+                        next_heights = [interface.bad + 1]
                         interface.blockchain.catch_up = interface.server
                 else:
                     bh = interface.blockchain.height()
-                    next_height = None
                     if bh > interface.good:
                         if not interface.blockchain.check_header(interface.bad_header):
                             b = interface.blockchain.fork(interface.bad_header)
@@ -874,46 +1380,26 @@ class Network(util.DaemonThread):
                             interface.blockchain = b
                             interface.print_error("new chain", b.checkpoint)
                             interface.mode = 'catch_up'
-                            next_height = interface.bad + 1
+                            next_heights = [interface.bad + 1]
                             interface.blockchain.catch_up = interface.server
                     else:
                         assert bh == interface.good
                         if interface.blockchain.catch_up is None and bh < interface.tip:
                             interface.print_error("catching up from %d"% (bh + 1))
                             interface.mode = 'catch_up'
-                            next_height = bh + 1
+                            next_heights = [bh + 1]
                             interface.blockchain.catch_up = interface.server
 
                 self.notify('updated')
 
-        elif interface.mode == 'catch_up':
-            can_connect = interface.blockchain.can_connect(header)
-            if can_connect:
-                interface.blockchain.save_header(header)
-                next_height = height + 1 if height < interface.tip else None
-            else:
-                # go back
-                interface.print_error("cannot connect", height)
-                interface.mode = 'backward'
-                interface.bad = height
-                interface.bad_header = header
-                next_height = height - 1
-
-            if next_height is None:
-                # exit catch_up state
-                interface.print_error('catch up done', interface.blockchain.height())
-                interface.blockchain.catch_up = None
-                self.switch_lagging_interface()
-                self.notify('updated')
-
-        else:
-            raise BaseException(interface.mode)
-        # If not finished, get the next header
-        if next_height:
-            if interface.mode == 'catch_up' and interface.tip > next_height + 50:
-                self.request_chunk(interface, next_height // 2016)
+        # If not finished, get the next headers
+        if next_heights:
+            if interface.mode == 'catch_up' and interface.tip > next_heights[0] + 50:
+                # chunks take over from single headers
+                interface.request = None
+                self.fill_chunk_window(interface)
             else:
-                self.request_header(interface, next_height)
+                self.request_headers(interface, next_heights)
         else:
             interface.mode = 'default'
             interface.request = None
@@ -926,18 +1412,28 @@ class Network(util.DaemonThread):
             if interface.request and time.time() - interface.request_time > 20:
                 interface.print_error("blockchain request timed out")
                 self.connection_down(interface.server)
-                continue
+        # servers that sent a bad chunk may serve it again
+        now = time.time()
+        for index, failed in list(self.failed_chunks.items()):
+            for server, t in list(failed.items()):
+                if now - t > CHUNK_RETRY_DELAY:
+                    failed.pop(server)
+            if not failed:
+                self.failed_chunks.pop(index)
+        for interface in list(self.interfaces.values()):
+            # chunks lost with a dropped interface or refused by every
+            # source are requested again.  While a header is requested,
+            # its response decides.
+            if (interface.mode == 'catch_up' and interface.request is None
+                    and interface.tip > interface.blockchain.height()):
+                self.fill_chunk_window(interface)
 
     def wait_on_sockets(self):
-        # Python docs say Windows doesn't like empty selects.
-        # Sleep to prevent busy looping
-        if not self.interfaces:
-            time.sleep(0.1)
-            return
-        rin = [i for i in self.interfaces.values()]
+        # Woken up by send(), add_jobs() and stop(), from other threads
+        rin = [i for i in self.interfaces.values()] + [self.wakeup_channel]
         win = [i for i in self.interfaces.values() if i.num_requests()]
         try:
-            rout, wout, xout = select.select(rin, win, [], 0.1)
+            rout, wout, xout = select.select(rin, win, [], MAINTENANCE_INTERVAL)
         except socket.error as e:
             # TODO: py3, get code from e
             code = None
@@ -945,6 +1441,9 @@ class Network(util.DaemonThread):
                 return
             raise
         assert not xout
+        if self.wakeup_channel in rout:
+            self.wakeup_channel.clear()
+            rout.remove(self.wakeup_channel)
         for interface in wout:
             interface.send_requests()
         for interface in rout:
@@ -954,14 +1453,19 @@ class Network(util.DaemonThread):
         b = self.blockchains[0]
         filename = b.path()
         length = 80 * len(bitcoin.NetworkConstants.CHECKPOINTS) * 2016
-        if not os.path.exists(filename) or os.path.getsize(filename) < length:
-            with open(filename, 'wb') as f:
-                if length>0:
-                    f.seek(length-1)
-                    f.write(b'\x00')
         with b.lock:
+            if not os.path.exists(filename) or os.path.getsize(filename) < length:
+                b.release_mmap()
+                with open(filename, 'wb') as f:
+                    if length>0:
+                        f.seek(length-1)
+                        f.write(b'\x00')
             b.update_size()
 
+    def flush_headers(self, due_only=False):
+        for b in list(self.blockchains.values()):
+            b.flush(due_only)
+
     def run(self):
         self.init_headers_file()
         while self.is_running():
@@ -969,8 +1473,16 @@ class Network(util.DaemonThread):
             self.wait_on_sockets()
             self.maintain_requests()
             self.run_jobs()    # Synchronizer and Verifier
+            self.run_pending_calls()
             self.process_pending_sends()
+            self.flush_headers(due_only=True)
         self.stop_network()
+        self.flush_headers()
+        self.response_cache.close()
+        self.wakeup_channel.close()
+        if self.chunk_executor:
+            self.chunk_executor.shutdown()
+        self.event_bus.stop()
         self.on_stop()
 
     def on_notify_header(self, interface, header):
@@ -982,6 +1494,10 @@ class Network(util.DaemonThread):
             return
         interface.tip_header = header
         interface.tip = height
+        best = max([height] + [i.tip for i in self.interfaces.values()])
+        for i in self.interfaces.values():
+            if i.tip:
+                self.server_stats.lag(i.server, best - i.tip)
         if interface.mode != 'default':
             return
         b = blockchain.check_header(header)
@@ -1004,17 +1520,17 @@ class Network(util.DaemonThread):
             interface.mode = 'backward'
             interface.bad = height
             interface.bad_header = header
-            self.request_header(interface, min(tip +1, height - 1))
+            self.request_headers(interface, self.backward_probes(min(tip + 1, height - 1), 1))
         else:
             chain = self.blockchains[0]
             if chain.catch_up is None:
-                chain.catch_up = interface
+                chain.catch_up = interface.server
                 interface.mode = 'catch_up'
                 interface.blockchain = chain
                 self.print_error("switching to catchup mode", tip,  self.blockchains)
                 self.request_header(interface, 0)
             else:
-                self.print_error("chain already catching up with", chain.catch_up.server)
+                self.print_error("chain already catching up with", chain.catch_up)
 
     def blockchain(self):
         if self.interface and self.interface.blockchain is not None:
@@ -1022,11 +1538,12 @@ class Network(util.DaemonThread):
         return self.blockchains[self.blockchain_index]
 
     def get_blockchains(self):
-        out = {}
-        for k, b in self.blockchains.items():
+        '''Interfaces by branch, the heaviest branch first'''
+        out = OrderedDict()
+        for b in sorted(self.blockchains.values(), key=lambda b: b.get_chainwork(), reverse=True):
             r = list(filter(lambda i: i.blockchain==b, list(self.interfaces.values())))
             if r:
-                out[k] = r
+                out[b.checkpoint] = r
         return out
 
     def follow_chain(self, index):
@@ -1050,26 +1567,56 @@ class Network(util.DaemonThread):
     def get_local_height(self):
         return self.blockchain().height()
 
+    def async_get(self, request):
+        '''Sends request, and returns a concurrent.futures.Future of its
+        result.  An error of the server is raised as a BaseException.'''
+        future = concurrent.futures.Future()
+        def callback(r):
+            # subscriptions are answered again
+            if future.done():
+                return
+            if r.get('error'):
+                future.set_exception(BaseException(r.get('error')))
+            else:
+                future.set_result(r.get('result'))
+        self.send([request], callback)
+        return future
+
+    def gather(self, requests, timeout=30, return_exceptions=False):
+        '''Sends requests at once, and returns their results in the same
+        order, so that they take one round-trip instead of one each.
+        With return_exceptions, errors are returned in place of results
+        instead of being raised.'''
+        futures = [self.async_get(request) for request in requests]
+        deadline = time.time() + timeout
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(max(0, deadline - time.time())))
+            except concurrent.futures.TimeoutError:
+                raise BaseException('Server did not answer')
+            except BaseException as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+
     def synchronous_get(self, request, timeout=30):
-        q = queue.Queue()
-        self.send([request], q.put)
-        try:
-            r = q.get(True, timeout)
-        except queue.Empty:
-            raise BaseException('Server did not answer')
-        if r.get('error'):
-            raise BaseException(r.get('error'))
-        return r.get('result')
+        return self.gather([request], timeout)[0]
 
     def broadcast(self, tx, timeout=30):
+        '''Sends tx to several servers, and returns once one of them
+        accepted it, or all of them refused it.  If no server answered
+        in time, tx is queued and sent again later.'''
         tx_hash = tx.txid()
+        future = concurrent.futures.Future()
+        self.broadcaster.submit(tx_hash, str(tx), future)
+        self.wakeup()
         try:
-            out = self.synchronous_get(('blockchain.transaction.broadcast', [str(tx)]), timeout)
-        except BaseException as e:
-            return False, "error: " + str(e)
-        if out != tx_hash:
-            return False, "error: " + out
-        return True, out
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.broadcaster.enqueue(tx_hash, str(tx))
+            return False, "error: Server did not answer, the transaction will be sent again"
 
     def export_checkpoints(self, path):
         # run manually from the console to generate checkpoints
@@ -1077,5 +1624,30 @@ class Network(util.DaemonThread):
         with open(path, 'w') as f:
             f.write(json.dumps(cp, indent=4))
 
+    def export_headers(self, path):
+        return self.blockchain().export_headers(path)
+
+    def import_headers(self, path):
+        return self.run_in_network_thread(partial(self.on_import_headers, path))
+
+    def on_import_headers(self, path):
+        height = self.blockchains[0].import_headers(path)
+        dropped = blockchain.drop_orphan_forks()
+        if dropped:
+            for index, (server, b) in list(self.requested_chunks.items()):
+                if b.checkpoint in dropped:
+                    self.requested_chunks.pop(index)
+            for index, (server, b, data) in list(self.received_chunks.items()):
+                if b.checkpoint in dropped:
+                    self.received_chunks.pop(index)
+            # they get a branch again when they reconnect
+            for interface in list(self.interfaces.values()):
+                if interface.blockchain and interface.blockchain.checkpoint in dropped:
+                    self.connection_down(interface.server)
+            if self.blockchain_index in dropped:
+                self.blockchain_index = 0
+        self.notify('updated')
+        return height
+
     def max_checkpoint(self):
         return max(0, len(bitcoin.NetworkConstants.CHECKPOINTS) * 2016 - 1)
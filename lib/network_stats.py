@@ -0,0 +1,125 @@
+# Electrum - Lightweight Bitcoin Client
+# Copyright (c) 2011-2016 Thomas Voegtlin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Counters of the network thread.  They are only updated by it, with a
+# few integer operations per message, and read by get_stats() from
+# other threads.
+
+import bisect
+import time
+from collections import defaultdict
+
+# upper bounds of the buckets of latency histograms, in ms
+BUCKETS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        '''Upper bound of the bucket of the p-th percentile'''
+        n = p * self.count / 100
+        seen = 0
+        for i, c in enumerate(list(self.counts)):
+            seen += c
+            if seen >= n and c:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return 0
+
+    def get_stats(self):
+        counts = list(self.counts)
+        buckets = {'<=%d' % b: c for b, c in zip(BUCKETS, counts) if c}
+        if counts[-1]:
+            buckets['>%d' % BUCKETS[-1]] = counts[-1]
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count if self.count else 0,
+            'max_ms': self.max,
+            'p50_ms': self.percentile(50),
+            'p90_ms': self.percentile(90),
+            'p99_ms': self.percentile(99),
+            'buckets': buckets,
+        }
+
+
+class MethodStats(object):
+
+    def __init__(self):
+        self.sent = 0
+        self.errors = 0
+        self.latency = Histogram()
+        self.callbacks = Histogram()
+
+    def get_stats(self):
+        return {
+            'sent': self.sent,
+            'errors': self.errors,
+            'latency': self.latency.get_stats(),
+            'callbacks': self.callbacks.get_stats(),
+        }
+
+
+class NetworkStats(object):
+    """Requests and responses by method, with histograms of the latency
+    of servers and of the time spent in callbacks, and the bytes sent
+    and received over connections that were closed."""
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.methods = defaultdict(MethodStats)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def request_sent(self, method):
+        self.methods[method].sent += 1
+
+    def response_received(self, method, latency, error):
+        m = self.methods[method]
+        m.latency.add(latency * 1000)
+        if error:
+            m.errors += 1
+
+    def callback_done(self, method, duration):
+        self.methods[method].callbacks.add(duration * 1000)
+
+    def connection_closed(self, pipe):
+        self.bytes_sent += pipe.bytes_sent
+        self.bytes_received += pipe.bytes_received
+
+    def get_stats(self):
+        return {
+            'uptime': time.time() - self.start_time,
+            'methods': {method: m.get_stats() for method, m in list(self.methods.items())},
+        }
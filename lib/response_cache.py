@@ -0,0 +1,165 @@
+# Electrum - Lightweight Bitcoin Client
+# Copyright (c) 2011-2016 Thomas Voegtlin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import sqlite3
+import threading
+
+from .util import PrintError
+
+# in MB
+RESPONSE_CACHE_SIZE = 50
+
+
+class ResponseCache(PrintError):
+    """Results of server requests that never change, like transactions,
+    in an sqlite database that is shared by the wallets of a daemon and
+    kept between runs.  Least recently used results are evicted when
+    the results take more than max_size bytes.
+
+    Results that depend on a block, like merkle branches, are stored
+    with the height and hash of the block.  They are dropped when the
+    block is no longer in the chain, and those above it with them.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self.clock = 0
+        self.db = None
+        if path and max_size > 0:
+            try:
+                self.open()
+            except sqlite3.DatabaseError as e:
+                self.print_error("cannot open response cache, recreating it:", e)
+                os.remove(path)
+                self.open()
+
+    def open(self):
+        # only used under self.lock, from several threads
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        # a lost write only costs a request
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            height INTEGER,
+            block_hash TEXT,
+            last_used INTEGER NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_height ON responses (height)')
+        size, clock = self.db.execute('SELECT SUM(size), MAX(last_used) FROM responses').fetchone()
+        self.size = size or 0
+        self.clock = clock or 0
+
+    def close(self):
+        with self.lock:
+            if self.db:
+                self.db.close()
+                self.db = None
+
+    def key(self, method, params):
+        return method + ':' + json.dumps(params)
+
+    def get(self, method, params, is_valid=None):
+        '''Returns the cached result, or None.  is_valid(height,
+        block_hash) tells if the block of a result is in the chain.'''
+        if not self.db:
+            return
+        key = self.key(method, params)
+        with self.lock:
+            row = self.db.execute('SELECT result, height, block_hash FROM responses WHERE key = ?',
+                                  (key,)).fetchone()
+            if row is not None:
+                result, height, block_hash = row
+                if height is not None and is_valid and not is_valid(height, block_hash):
+                    self.print_error("block", height, "is no longer in the chain")
+                    self._invalidate(height)
+                    row = None
+            if row is None:
+                self.misses += 1
+                return
+            self.hits += 1
+            self.clock += 1
+            self.db.execute('UPDATE responses SET last_used = ? WHERE key = ?', (self.clock, key))
+            self.db.commit()
+        return json.loads(result)
+
+    def put(self, method, params, result, height=None, block_hash=None):
+        if not self.db:
+            return
+        key = self.key(method, params)
+        value = json.dumps(result)
+        with self.lock:
+            self.clock += 1
+            row = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.size -= row[0]
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                            (key, value, len(value), height, block_hash, self.clock))
+            self.size += len(value)
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        while self.size > self.max_size:
+            rows = self.db.execute('SELECT key, size FROM responses ORDER BY last_used LIMIT 100').fetchall()
+            if not rows:
+                self.size = 0
+                break
+            for key, size in rows:
+                self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.size -= size
+                if self.size <= self.max_size:
+                    break
+
+    def invalidate(self, height):
+        '''Drops the results of blocks from height'''
+        if not self.db:
+            return
+        with self.lock:
+            self._invalidate(height)
+
+    def _invalidate(self, height):
+        size = self.db.execute('SELECT SUM(size) FROM responses WHERE height >= ?',
+                               (height,)).fetchone()[0]
+        self.db.execute('DELETE FROM responses WHERE height >= ?', (height,))
+        self.db.commit()
+        self.size -= size or 0
+
+    def get_stats(self):
+        with self.lock:
+            count = self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0] if self.db else 0
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'count': count,
+                'size': self.size,
+                'max_size': self.max_size,
+            }
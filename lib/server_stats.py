@@ -0,0 +1,159 @@
+# Electrum - Lightweight Bitcoin Client
+# Copyright (c) 2011-2016 Thomas Voegtlin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import random
+import time
+
+from .util import PrintError
+
+# weight of a new measurement in the moving averages
+ALPHA = 0.3
+# assumed for servers without measurements, in seconds
+DEFAULT_CONNECT_TIME = 2.0
+DEFAULT_RTT = 1.0
+# cost, in seconds, of a failed connection, of a timeout and of each
+# block a server is behind the others
+FAILURE_PENALTY = 30.0
+TIMEOUT_PENALTY = 20.0
+LAG_PENALTY = 2.0
+# counts of connections are halved above this, so that old ones weigh less
+MAX_COUNT = 20
+# servers that are kept in the file, the most recently seen ones
+MAX_SERVERS = 200
+# a server is picked at random among the best ones
+PICK_AMONG = 3
+
+
+def moving_average(old, value):
+    return value if old is None else old + ALPHA * (value - old)
+
+
+class ServerStats(PrintError):
+    """Measurements of servers: connection time, round-trip time of
+    pings, failed connections, timeouts and lag behind the best tip.
+    They are saved in the 'server_stats' file of the electrum
+    directory, next to 'recent_servers', and used to rank servers.
+    """
+
+    def __init__(self, config_path):
+        self.path = os.path.join(config_path, 'server_stats') if config_path else None
+        self.stats = self.read()
+        # servers being connected to, with the start time
+        self.connecting = {}
+
+    def read(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                stats = json.loads(f.read())
+        except:
+            return {}
+        return stats if isinstance(stats, dict) else {}
+
+    def save(self):
+        if not self.path:
+            return
+        servers = sorted(self.stats, key=lambda s: self.stats[s].get('last_seen', 0))
+        for server in servers[:-MAX_SERVERS]:
+            self.stats.pop(server)
+        s = json.dumps(self.stats, indent=4, sort_keys=True)
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(s)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            self.print_error("cannot save server stats:", e)
+
+    def get(self, server):
+        return self.stats.setdefault(server, {
+            'connect_time': None,
+            'rtt': None,
+            'lag': None,
+            'connections': 0,
+            'failures': 0,
+            'timeouts': 0,
+            'last_seen': 0,
+        })
+
+    def count(self, s, key):
+        s[key] += 1
+        if s['connections'] + s['failures'] > MAX_COUNT:
+            for k in ['connections', 'failures', 'timeouts']:
+                s[k] /= 2
+
+    def start_connecting(self, server):
+        self.connecting[server] = time.time()
+
+    def connected(self, server):
+        t = self.connecting.pop(server, None)
+        s = self.get(server)
+        if t is not None:
+            s['connect_time'] = moving_average(s['connect_time'], time.time() - t)
+        s['last_seen'] = time.time()
+        self.count(s, 'connections')
+
+    def connection_failed(self, server):
+        if self.connecting.pop(server, None) is None:
+            return
+        self.count(self.get(server), 'failures')
+
+    def timed_out(self, server):
+        self.get(server)['timeouts'] += 1
+
+    def ping(self, server, rtt):
+        s = self.get(server)
+        s['rtt'] = moving_average(s['rtt'], rtt)
+
+    def lag(self, server, blocks):
+        s = self.get(server)
+        s['lag'] = moving_average(s['lag'], blocks)
+
+    def score(self, server):
+        '''Expected cost of using server, in seconds; lower is better'''
+        s = self.stats.get(server)
+        if s is None:
+            return DEFAULT_CONNECT_TIME + DEFAULT_RTT
+        attempts = s['connections'] + s['failures']
+        failure_rate = s['failures'] / attempts if attempts else 0
+        timeout_rate = min(1, s['timeouts'] / s['connections']) if s['connections'] else 0
+        connect_time = s['connect_time']
+        rtt = s['rtt']
+        return ((DEFAULT_CONNECT_TIME if connect_time is None else connect_time)
+                + (DEFAULT_RTT if rtt is None else rtt)
+                + FAILURE_PENALTY * failure_rate
+                + TIMEOUT_PENALTY * timeout_rate
+                + LAG_PENALTY * (s['lag'] or 0))
+
+    def rank(self, servers):
+        '''servers, best first.  Ties are in random order.'''
+        servers = list(servers)
+        random.shuffle(servers)
+        return sorted(servers, key=self.score)
+
+    def pick(self, servers):
+        '''One of the best servers, or None'''
+        servers = self.rank(servers)[:PICK_AMONG]
+        return random.choice(servers) if servers else None
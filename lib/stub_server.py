@@ -0,0 +1,296 @@
+# Electrum - Lightweight Bitcoin Client
+# Copyright (c) 2011-2016 Thomas Voegtlin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# A local server for benchmarks and tests.  It speaks the line-based
+# JSON-RPC protocol of Interface over TCP or SSL, and serves a synthetic
+# regtest chain: headers, and transactions paying to generated
+# addresses, with their histories and merkle branches.  Latency,
+# jitter, bandwidth and errors can be injected.
+
+import heapq
+import json
+import random
+import socketserver
+import threading
+import time
+
+from .bitcoin import (Hash, address_to_scripthash, address_to_script, hash160_to_p2pkh,
+                      hash_decode, hash_encode, int_to_hex, push_script, var_int)
+from .blockchain import hash_header, serialize_header
+from .synchronizer import history_status
+from .transaction import Transaction
+from .util import PrintError, bh2u
+from .version import ELECTRUM_VERSION, PROTOCOL_VERSION
+
+# the genesis block of regtest, see NetworkConstants.set_regtest
+GENESIS_HEADER = {
+    'version': 1,
+    'prev_block_hash': '00' * 32,
+    'merkle_root': '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b',
+    'timestamp': 1296688602,
+    'bits': 0x207fffff,
+    'nonce': 2,
+    'block_height': 0,
+}
+
+
+def merkle_branches(tx_hashes):
+    '''Merkle root of a block, and the branch of each transaction'''
+    level = [hash_decode(h) for h in tx_hashes]
+    branches = [[] for h in tx_hashes]
+    positions = list(range(len(tx_hashes)))
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        for i, pos in enumerate(positions):
+            branches[i].append(hash_encode(level[pos ^ 1]))
+            positions[i] = pos // 2
+        level = [Hash(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+    return hash_encode(level[0]), branches
+
+
+def make_addresses(count, seed=0):
+    '''The addresses of a Dataset, without building it'''
+    rnd = random.Random(seed)
+    return [hash160_to_p2pkh(bytes(rnd.getrandbits(8) for i in range(20))) for i in range(count)]
+
+
+class StubError(Exception):
+    pass
+
+
+class Dataset(object):
+    """A chain of num_blocks headers on top of the regtest genesis, and
+    txs_per_address transactions for each of num_addresses addresses,
+    in random blocks.  The same seed gives the same dataset.  Addresses
+    are those of the current network, set with set_regtest()."""
+
+    def __init__(self, num_blocks=2100, num_addresses=100, txs_per_address=2, seed=0):
+        self.addresses = make_addresses(num_addresses, seed)
+        rnd = random.Random(seed)
+        self.transactions = {}
+        # scripthash -> history, unspent outputs
+        self.histories = {}
+        self.unspent = {}
+        self.merkle = {}
+        blocks = [[] for i in range(num_blocks + 1)]
+        for n, address in enumerate(self.addresses):
+            sh = address_to_scripthash(address)
+            history = []
+            unspent = []
+            for i in range(txs_per_address):
+                value = rnd.randint(1000, 10**8)
+                raw = self.make_tx(address, value, n * txs_per_address + i)
+                tx_hash = Transaction(raw).txid()
+                height = rnd.randint(1, num_blocks) if num_blocks else 0
+                self.transactions[tx_hash] = raw
+                blocks[height].append(tx_hash)
+                history.append({'tx_hash': tx_hash, 'height': height})
+                unspent.append({'tx_hash': tx_hash, 'tx_pos': 0, 'height': height, 'value': value})
+            history.sort(key=lambda x: x['height'])
+            self.histories[sh] = history
+            self.unspent[sh] = unspent
+        self.headers = [GENESIS_HEADER]
+        for height in range(1, num_blocks + 1):
+            tx_hashes = blocks[height]
+            if tx_hashes:
+                merkle_root, branches = merkle_branches(tx_hashes)
+                for pos, (tx_hash, branch) in enumerate(zip(tx_hashes, branches)):
+                    self.merkle[tx_hash] = {'block_height': height, 'merkle': branch, 'pos': pos}
+            else:
+                merkle_root = '%064x' % height
+            self.headers.append({
+                'version': 1,
+                'prev_block_hash': hash_header(self.headers[-1]),
+                'merkle_root': merkle_root,
+                'timestamp': GENESIS_HEADER['timestamp'] + 600 * height,
+                'bits': GENESIS_HEADER['bits'],
+                'nonce': 0,
+                'block_height': height,
+            })
+        self.raw_headers = bytes.fromhex(''.join(serialize_header(h) for h in self.headers))
+
+    def make_tx(self, address, value, n):
+        '''A coinbase-like transaction paying value to address.  n
+        makes its hash unique.'''
+        script_sig = push_script(int_to_hex(n, 4))
+        script = address_to_script(address)
+        return ('01000000' + '01' + '00' * 32 + 'ffffffff'
+                + var_int(len(script_sig) // 2) + script_sig + 'ffffffff'
+                + '01' + int_to_hex(value, 8) + var_int(len(script) // 2) + script
+                + '00000000')
+
+    def height(self):
+        return len(self.headers) - 1
+
+    def respond(self, method, params):
+        if method == 'server.version':
+            return 'stub ' + ELECTRUM_VERSION, PROTOCOL_VERSION
+        elif method == 'server.banner':
+            return 'Electrum stub server'
+        elif method == 'server.donation_address':
+            return ''
+        elif method == 'server.peers.subscribe':
+            return []
+        elif method == 'blockchain.relayfee':
+            return 0.00001
+        elif method == 'blockchain.estimatefee':
+            return 0.0001
+        elif method == 'blockchain.headers.subscribe':
+            return self.headers[-1]
+        elif method == 'blockchain.block.get_header':
+            return self.headers[params[0]]
+        elif method == 'blockchain.block.get_chunk':
+            index = params[0]
+            return bh2u(self.raw_headers[index * 2016 * 80:(index + 1) * 2016 * 80])
+        elif method == 'blockchain.scripthash.subscribe':
+            history = self.histories.get(params[0], [])
+            return history_status([(x['tx_hash'], x['height']) for x in history])
+        elif method == 'blockchain.scripthash.get_history':
+            return self.histories.get(params[0], [])
+        elif method == 'blockchain.scripthash.listunspent':
+            return self.unspent.get(params[0], [])
+        elif method == 'blockchain.scripthash.get_balance':
+            confirmed = sum(x['value'] for x in self.unspent.get(params[0], []))
+            return {'confirmed': confirmed, 'unconfirmed': 0}
+        elif method == 'blockchain.transaction.get':
+            return self.transactions[params[0]]
+        elif method == 'blockchain.transaction.get_merkle':
+            return self.merkle[params[0]]
+        elif method == 'blockchain.transaction.broadcast':
+            return Transaction(params[0]).txid()
+        raise StubError('unknown method')
+
+
+class StubHandler(socketserver.StreamRequestHandler):
+    """One connection.  Requests are read as they come, and responses
+    are written by another thread once their delay has passed, so that
+    pipelined requests wait in parallel, as with a real server."""
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.cond = threading.Condition()
+        # (due time, sequence number, message)
+        self.responses = []
+        self.closed = False
+        self.writer = threading.Thread(target=self.write_responses, daemon=True)
+        self.writer.start()
+
+    def handle(self):
+        server = self.server
+        for n, line in enumerate(self.rfile):
+            try:
+                request = json.loads(line.decode('utf8'))
+            except ValueError:
+                break
+            if server.random.random() < server.disconnect_rate:
+                break
+            response = server.respond(request)
+            delay = server.latency + server.jitter * server.random.random()
+            message = (json.dumps(response) + '\n').encode('utf8')
+            with self.cond:
+                heapq.heappush(self.responses, (time.time() + delay, n, message))
+                self.cond.notify()
+
+    def write_responses(self):
+        while True:
+            with self.cond:
+                while not self.closed:
+                    if self.responses:
+                        wait = self.responses[0][0] - time.time()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self.cond.wait(wait)
+                if self.closed:
+                    return
+                due, n, message = heapq.heappop(self.responses)
+            try:
+                self.wfile.write(message)
+            except OSError:
+                return
+            if self.server.bandwidth:
+                time.sleep(len(message) / self.server.bandwidth)
+
+    def finish(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.writer.join()
+        socketserver.StreamRequestHandler.finish(self)
+
+
+class StubServer(socketserver.ThreadingTCPServer, PrintError):
+    """Serves dataset on address.  latency and jitter are in seconds,
+    bandwidth in bytes per second (0 for no limit).  error_rate and
+    disconnect_rate are the probabilities that a request gets an error,
+    or that the connection is closed instead of answering it.  If
+    error_methods is given, errors are only injected in the answers to
+    these methods.  With an ssl_context, connections use SSL."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, dataset, latency=0, jitter=0, bandwidth=0,
+                 error_rate=0, disconnect_rate=0, ssl_context=None, seed=None,
+                 error_methods=None):
+        socketserver.ThreadingTCPServer.__init__(self, address, StubHandler)
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_methods = error_methods
+        self.disconnect_rate = disconnect_rate
+        self.ssl_context = ssl_context
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+
+    def get_request(self):
+        sock, address = socketserver.ThreadingTCPServer.get_request(self)
+        if self.ssl_context:
+            sock = self.ssl_context.wrap_socket(sock, server_side=True)
+        return sock, address
+
+    def handle_error(self, request, client_address):
+        self.print_error("connection error", client_address)
+
+    def server_string(self, protocol='t'):
+        host, port = self.server_address[:2]
+        return '%s:%d:%s' % (host, port, protocol)
+
+    def respond(self, request):
+        self.requests += 1
+        message_id = request.get('id')
+        try:
+            method = request.get('method')
+            if self.error_methods is None or method in self.error_methods:
+                if self.random.random() < self.error_rate:
+                    raise StubError('injected error')
+            result = self.dataset.respond(method, request.get('params', []))
+        except (StubError, KeyError, IndexError, TypeError) as e:
+            self.errors += 1
+            return {'id': message_id, 'error': {'code': 1, 'message': str(e) or 'not found'}}
+        return {'id': message_id, 'result': result}
@@ -30,6 +30,17 @@ from .transaction import Transaction
 from .util import ThreadJob, bh2u
 
 
+def history_status(h):
+    '''The status of an address, as sent by servers, for its history
+    of (tx_hash, height) pairs'''
+    if not h:
+        return None
+    status = ''
+    for tx_hash, height in h:
+        status += tx_hash + ':%d:' % height
+    return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+
+
 class Synchronizer(ThreadJob):
     '''The synchronizer keeps the wallet up-to-date with its set of
     addresses and their transactions.  It subscribes over the network
@@ -69,6 +80,7 @@ class Synchronizer(ThreadJob):
         '''This can be called from the proxy or GUI threads.'''
         with self.lock:
             self.new_addresses.add(address)
+        self.network.wakeup()
 
     def subscribe_to_addresses(self, addresses):
         if addresses:
@@ -76,12 +88,7 @@ class Synchronizer(ThreadJob):
             self.network.subscribe_to_addresses(addresses, self.on_address_status)
 
     def get_status(self, h):
-        if not h:
-            return None
-        status = ''
-        for tx_hash, height in h:
-            status += tx_hash + ':%d:' % height
-        return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+        return history_status(h)
 
     def on_address_status(self, response):
         params, result = self.parse_response(response)
@@ -0,0 +1,503 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+from lib import blockchain
+from lib.bitcoin import NetworkConstants
+from lib.blockchain import hash_header, serialize_header, deserialize_header
+from lib.util import bfh, bh2u
+from lib.simple_config import SimpleConfig
+
+
+def make_headers(count, prev_hash='00'*32, start=0, salt=0):
+    headers = []
+    for height in range(start, start + count):
+        header = {
+            'version': 1,
+            'prev_block_hash': prev_hash,
+            'merkle_root': '%064x' % height,
+            'timestamp': 1500000000 + 600 * height,
+            'bits': 0x1d00ffff,
+            'nonce': height + salt,
+            'block_height': height,
+        }
+        headers.append(header)
+        # get_hash(0) always returns the genesis constant
+        prev_hash = hash_header(header) if height else NetworkConstants.GENESIS
+    return headers
+
+
+def mine_raw_headers(count, prev_hash, target):
+    '''Raw headers whose proof of work is valid for target'''
+    bits = blockchain.target_to_bits(target)
+    data = b''
+    for height in range(count):
+        header = {
+            'version': 1,
+            'prev_block_hash': prev_hash,
+            'merkle_root': '%064x' % height,
+            'timestamp': 1500000000 + 600 * height,
+            'bits': bits,
+            'nonce': 0,
+        }
+        while int(hash_header(header), 16) > target:
+            header['nonce'] += 1
+        data += bfh(serialize_header(header))
+        prev_hash = hash_header(header)
+    return data
+
+
+class BlockchainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(BlockchainTestCase, self).setUp()
+        # testnet skips proof of work, so synthetic headers connect
+        NetworkConstants.set_testnet()
+        self.addCleanup(NetworkConstants.set_mainnet)
+        NetworkConstants.CHECKPOINTS = []
+        self.electrum_dir = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_dir})
+        blockchain.blockchains.clear()
+        self.chain = blockchain.read_blockchains(self.config)[0]
+        open(self.chain.path(), 'w+').close()
+
+    def tearDown(self):
+        super(BlockchainTestCase, self).tearDown()
+        blockchain.blockchains.clear()
+        shutil.rmtree(self.electrum_dir)
+
+    def save_headers(self, chain, headers):
+        for header in headers:
+            # our synthetic genesis does not hash to the real one
+            if header['block_height'] > 0:
+                self.assertTrue(chain.can_connect(header))
+            chain.save_header(header)
+
+
+class TestHeaderStore(BlockchainTestCase):
+
+    def test_read_header(self):
+        headers = make_headers(10)
+        self.save_headers(self.chain, headers)
+        self.assertEqual(9, self.chain.height())
+        for header in headers:
+            self.assertEqual(header, self.chain.read_header(header['block_height']))
+        self.assertIsNone(self.chain.read_header(10))
+        self.assertIsNone(self.chain.read_header(-1))
+
+    def test_read_raw_headers(self):
+        headers = make_headers(5)
+        self.save_headers(self.chain, headers)
+        raw = self.chain.read_raw_headers(1, 3)
+        self.assertIsInstance(raw, bytes)
+        self.assertEqual(240, len(raw))
+        self.assertEqual(hash_header(headers[1]), blockchain.hash_encode(blockchain.Hash(bytes(raw[0:80]))))
+        # range is clipped at the tip
+        self.assertEqual(160, len(self.chain.read_raw_headers(3, 10)))
+        self.assertIsNone(self.chain.read_raw_headers(5))
+
+    def test_remap_after_truncate(self):
+        headers = make_headers(6)
+        self.save_headers(self.chain, headers)
+        self.assertEqual(headers[5], self.chain.read_header(5))
+        self.chain.write(b'', 3 * 80)
+        self.assertEqual(2, self.chain.height())
+        self.assertIsNone(self.chain.read_header(3))
+        other = make_headers(1, hash_header(headers[2]), start=3)
+        self.save_headers(self.chain, other)
+        self.assertEqual(other[0], self.chain.read_header(3))
+
+    def test_read_after_truncate(self):
+        raw = b''.join(bfh(serialize_header(h)) for h in make_headers(2 * 2016))
+        self.chain.write(raw, 0)
+        self.chain.flush()
+        data = self.chain.read_raw_headers(0, 2 * 2016)
+        self.chain.write(b'', 2016 * 80)
+        # a view of the map would fault on the pages past the new end
+        self.assertEqual(raw[-80:], data[-80:])
+
+    def test_fork_reads_parent_range(self):
+        headers = make_headers(8)
+        self.save_headers(self.chain, headers)
+        fork_header = make_headers(1, hash_header(headers[4]), start=5, salt=99)[0]
+        fork = self.chain.fork(fork_header)
+        blockchain.blockchains[fork.checkpoint] = fork
+        self.assertEqual(fork_header, fork.read_header(5))
+        self.assertEqual(headers[4], fork.read_header(4))
+        # a range starting below the fork point stops at the fork point
+        self.assertEqual(2 * 80, len(fork.read_raw_headers(3, 5)))
+
+
+class TestWriteBehind(BlockchainTestCase):
+
+    def file_size(self, chain):
+        return os.path.getsize(chain.path()) // 80
+
+    def test_pending_headers(self):
+        headers = make_headers(10)
+        self.save_headers(self.chain, headers)
+        self.assertEqual(9, self.chain.height())
+        self.assertEqual(0, self.file_size(self.chain))
+        self.assertEqual(headers[9], self.chain.read_header(9))
+        self.assertEqual(10 * 80, len(self.chain.read_raw_headers(0, 20)))
+        self.chain.flush(due_only=True)
+        self.assertEqual(0, self.file_size(self.chain))
+        self.chain.flush()
+        self.assertEqual(10, self.file_size(self.chain))
+        self.assertEqual(headers[9], self.chain.read_header(9))
+
+    def test_flush_policy(self):
+        headers = make_headers(2016 + 2)
+        self.save_headers(self.chain, headers[:2015])
+        self.assertEqual(0, self.file_size(self.chain))
+        # end of a chunk
+        self.save_headers(self.chain, headers[2015:2016])
+        self.assertEqual(2016, self.file_size(self.chain))
+        self.save_headers(self.chain, headers[2016:2017])
+        self.chain.fsync_delay = 0
+        self.chain.flush(due_only=True)
+        self.assertEqual(2017, self.file_size(self.chain))
+        self.chain.fsync_count = 1
+        self.save_headers(self.chain, headers[2017:])
+        self.assertEqual(2018, self.file_size(self.chain))
+
+    def test_overwrite_flushes_pending(self):
+        headers = make_headers(6)
+        self.save_headers(self.chain, headers)
+        self.chain.write(b'', 3 * 80)
+        self.assertEqual(3, self.file_size(self.chain))
+        self.assertEqual(2, self.chain.height())
+
+    def test_truncate_torn_tail(self):
+        headers = make_headers(5)
+        raw = b''.join(bfh(serialize_header(h)) for h in headers)
+        with open(self.chain.path(), 'wb') as f:
+            f.write(raw + bytes(2 * 80 + 30))
+        chain = blockchain.Blockchain(self.config, 0, None)
+        self.assertEqual(4, chain.height())
+        self.assertEqual(5, self.file_size(chain))
+
+
+class TestHeaderCache(BlockchainTestCase):
+
+    def test_lru_eviction(self):
+        cache = blockchain.HeaderCache(3)
+        for i in range(3):
+            cache.put(i, str(i))
+        self.assertEqual('0', cache.get(0))
+        cache.put(3, '3')
+        self.assertEqual(3, len(cache))
+        self.assertIsNone(cache.get(1))
+        self.assertEqual('0', cache.get(0))
+        cache.discard_from(2)
+        self.assertEqual(1, len(cache))
+
+    def test_get_hash_is_cached(self):
+        headers = make_headers(5)
+        self.save_headers(self.chain, headers)
+        self.assertEqual(hash_header(headers[3]), self.chain.get_hash(3))
+        self.assertEqual(hash_header(headers[3]), self.chain.hash_cache.get(3))
+        # missing headers are not cached
+        self.assertEqual('0' * 64, self.chain.get_hash(7))
+        self.assertIsNone(self.chain.hash_cache.get(7))
+
+    def test_truncate_invalidates(self):
+        headers = make_headers(5)
+        self.save_headers(self.chain, headers)
+        for height in range(1, 5):
+            self.chain.get_hash(height)
+        self.chain.write(b'', 3 * 80)
+        self.assertIsNotNone(self.chain.hash_cache.get(2))
+        self.assertIsNone(self.chain.hash_cache.get(3))
+        other = make_headers(1, hash_header(headers[2]), start=3, salt=7)
+        self.chain.save_header(other[0])
+        self.assertEqual(hash_header(other[0]), self.chain.get_hash(3))
+
+    def test_swap_invalidates(self):
+        headers = make_headers(6)
+        self.save_headers(self.chain, headers)
+        fork_headers = make_headers(4, hash_header(headers[3]), start=4, salt=1000)
+        self.assertEqual(hash_header(headers[5]), self.chain.get_hash(5))
+        fork = self.chain.fork(fork_headers[0])
+        blockchain.blockchains[fork.checkpoint] = fork
+        self.save_headers(fork, fork_headers[1:])
+        # the fork is longer than its parent and took its place
+        main = blockchain.blockchains[0]
+        self.assertIs(fork, main)
+        self.assertEqual(hash_header(fork_headers[1]), main.get_hash(5))
+        self.assertEqual(hash_header(headers[5]), blockchain.blockchains[4].get_hash(5))
+
+
+class TestForkSwap(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestForkSwap, self).setUp()
+        self.headers = make_headers(6)
+        self.save_headers(self.chain, self.headers)
+        self.fork_headers = make_headers(3, hash_header(self.headers[3]), start=4, salt=1000)
+        self.fork = self.chain.fork(self.fork_headers[0])
+        blockchain.blockchains[self.fork.checkpoint] = self.fork
+        self.save_headers(self.fork, self.fork_headers[1:2])
+        self.chain.flush()
+        self.fork.flush()
+
+    def read_headers(self):
+        chains = blockchain.read_blockchains(self.config)
+        return chains[0].height(), chains[0].read_header(6), chains[4].read_header(5)
+
+    def test_swap(self):
+        # the fork gets longer than its parent
+        self.save_headers(self.fork, self.fork_headers[2:3])
+        self.assertIs(self.fork, blockchain.blockchains[0])
+        self.assertEqual(['fork_0_4'], os.listdir(os.path.join(self.electrum_dir, 'forks')))
+        self.assertEqual((6, self.fork_headers[2], self.headers[5]), self.read_headers())
+
+    def test_recover_interrupted_swap(self):
+        complete_swap = blockchain.complete_swap
+        def crash(config, journal):
+            raise KeyboardInterrupt
+        blockchain.complete_swap = crash
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                self.save_headers(self.fork, self.fork_headers[2:3])
+        finally:
+            blockchain.complete_swap = complete_swap
+        self.assertTrue(os.path.exists(blockchain.swap_journal_path(self.config)))
+        self.assertEqual((6, self.fork_headers[2], self.headers[5]), self.read_headers())
+        self.assertFalse(os.path.exists(blockchain.swap_journal_path(self.config)))
+
+    def test_drop_swap_without_journal(self):
+        self.fork.flush()
+        with open(self.fork.path() + '.swap', 'wb') as f:
+            f.write(bytes(80))
+        chains = blockchain.read_blockchains(self.config)
+        self.assertFalse(os.path.exists(self.fork.path() + '.swap'))
+        self.assertEqual(5, chains[4].height())
+        self.assertEqual(5, chains[0].height())
+
+
+class TestChainwork(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestChainwork, self).setUp()
+        self.headers = make_headers(2 * 2016 + 5)
+        self.save_headers(self.chain, self.headers)
+
+    def test_target_to_work(self):
+        self.assertEqual(0x100010001, blockchain.target_to_work(blockchain.MAX_TARGET))
+
+    def test_chainwork(self):
+        # one per header on testnet
+        self.assertEqual(2 * 2016 + 5, self.chain.get_chainwork())
+        self.assertEqual(2016, self.chain.get_chainwork(2015))
+        self.assertEqual(2, len(self.chain._chainwork))
+        self.chain.flush()
+        chain = blockchain.Blockchain(self.config, 0, None)
+        self.assertEqual([2016, 2 * 2016], chain._chainwork)
+
+    def test_truncate(self):
+        self.chain.write(b'', (2016 + 3) * 80)
+        self.assertEqual([2016], self.chain._chainwork)
+        self.assertEqual(32, os.path.getsize(self.chain.chainwork_path()))
+        self.assertEqual(2016 + 3, self.chain.get_chainwork())
+
+    def test_fork(self):
+        fork_header = make_headers(1, hash_header(self.headers[2015]), start=2016, salt=99)[0]
+        fork = self.chain.fork(fork_header)
+        blockchain.blockchains[fork.checkpoint] = fork
+        self.assertEqual(2017, fork.get_chainwork())
+        self.assertEqual([], fork._chainwork)
+
+    def test_rewrite_invalidates_readers_only(self):
+        fork_header = make_headers(1, hash_header(self.headers[2015]), start=2016, salt=99)[0]
+        fork = self.chain.fork(fork_header)
+        blockchain.blockchains[fork.checkpoint] = fork
+        fork.get_chunk_work(1)
+        self.assertEqual(1, len(fork._chainwork))
+        # above the fork point: the fork does not read these headers
+        self.chain.write(b'', (2016 + 3) * 80)
+        self.assertEqual(1, len(fork._chainwork))
+        self.chain.write(b'', 3 * 80)
+        self.assertEqual([], fork._chainwork)
+
+    def test_headers_over_zeros(self):
+        raw = b''.join(bfh(serialize_header(h)) for h in self.headers[:2 * 2016])
+        # a pre-sized file, chunk 0 is not downloaded yet
+        self.chain.write(bytes(2016 * 80) + raw[2016 * 80:], 0)
+        self.chain.get_hash(2020)
+        work = self.chain.get_chainwork()
+        chainwork = list(self.chain._chainwork)
+        self.assertTrue(chainwork)
+        self.chain.write(raw[:2016 * 80], 0, False)
+        self.assertIsNotNone(self.chain.hash_cache.get(2020))
+        self.assertEqual(chainwork, self.chain._chainwork)
+        self.assertEqual(work, self.chain.get_chainwork())
+
+class TestVerifyRawHeaders(unittest.TestCase):
+
+    target = 2**248 - 1
+
+    def test_deserialize_roundtrip(self):
+        header = make_headers(1)[0]
+        raw = bfh(serialize_header(header))
+        self.assertEqual(header, deserialize_header(raw, 0))
+        self.assertEqual(hash_header(header), blockchain.hash_encode(blockchain.hash_raw_header(raw)))
+
+    def test_valid_chunk(self):
+        data = mine_raw_headers(20, '00' * 32, self.target)
+        last = deserialize_header(data[-80:], 19)
+        self.assertEqual(hash_header(last), blockchain.verify_raw_headers(data, '00' * 32, self.target))
+
+    def test_prev_hash_mismatch(self):
+        data = mine_raw_headers(3, '11' * 32, self.target)
+        with self.assertRaisesRegex(BaseException, "prev hash mismatch: %s vs %s" % ('00' * 32, '11' * 32)):
+            blockchain.verify_raw_headers(data, '00' * 32, self.target)
+        # linkage is checked inside the chunk too
+        data = bytearray(data)
+        data[84] ^= 1
+        with self.assertRaisesRegex(BaseException, "prev hash mismatch"):
+            blockchain.verify_raw_headers(data, '11' * 32, self.target)
+
+    def test_bits_mismatch(self):
+        data = mine_raw_headers(3, '00' * 32, self.target)
+        with self.assertRaisesRegex(BaseException, "bits mismatch"):
+            blockchain.verify_raw_headers(data, '00' * 32, self.target // 2)
+
+    def test_insufficient_proof_of_work(self):
+        target = self.target
+        header = make_headers(1)[0]
+        header['bits'] = blockchain.target_to_bits(target)
+        while int(hash_header(header), 16) <= target:
+            header['nonce'] += 1
+        data = bfh(serialize_header(header))
+        with self.assertRaisesRegex(BaseException, "insufficient proof of work"):
+            blockchain.verify_raw_headers(data, '00' * 32, target)
+        # proof of work is not checked without a target
+        self.assertEqual(hash_header(header), blockchain.verify_raw_headers(data, '00' * 32, None))
+
+
+class TestConnectChunks(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestConnectChunks, self).setUp()
+        self.headers = make_headers(4 * 2016)
+        raw = [bfh(serialize_header(h)) for h in self.headers]
+        self.chunks = [bh2u(b''.join(raw[i*2016:(i+1)*2016])) for i in range(4)]
+        self.chain.save_chunk(0, bfh(self.chunks[0]))
+
+    def test_connect_chunks(self):
+        self.assertEqual(3, self.chain.connect_chunks(1, self.chunks[1:]))
+        self.assertEqual(4 * 2016 - 1, self.chain.height())
+        self.assertEqual(self.headers[-1], self.chain.read_header(4 * 2016 - 1))
+
+    def test_connect_chunks_executor(self):
+        with ProcessPoolExecutor(2) as executor:
+            self.assertEqual(3, self.chain.connect_chunks(1, self.chunks[1:], executor))
+        self.assertEqual(self.headers[-1], self.chain.read_header(4 * 2016 - 1))
+
+    def test_partial_last_chunk(self):
+        partial = self.chunks[2][:100 * 160]
+        self.assertEqual(2, self.chain.connect_chunks(1, [self.chunks[1], partial, self.chunks[3]]))
+        self.assertEqual(2 * 2016 + 99, self.chain.height())
+
+    def test_stops_at_bad_chunk(self):
+        bad = bytearray(bfh(self.chunks[2]))
+        bad[80 * 10 + 4] ^= 1
+        chunks = [self.chunks[1], bh2u(bad), self.chunks[3]]
+        self.assertEqual(1, self.chain.connect_chunks(1, chunks))
+        self.assertEqual(2 * 2016 - 1, self.chain.height())
+        self.assertEqual(0, self.chain.connect_chunks(3, ['zz']))
+
+
+    def test_checkpoint_mismatch(self):
+        end = hash_header(self.headers[2015])
+        self.chain.checkpoints = [(end, 0), ('11' * 32, 0)]
+        self.assertEqual(0, self.chain.connect_chunks(1, self.chunks[1:]))
+        self.assertEqual(2016 - 1, self.chain.height())
+        self.chain.checkpoints = [(end, 0), (hash_header(self.headers[2 * 2016 - 1]), 0)]
+        self.assertEqual(3, self.chain.connect_chunks(1, self.chunks[1:]))
+
+
+class TestSnapshot(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestSnapshot, self).setUp()
+        # a genesis of our own, so that the snapshot starts with it
+        NetworkConstants.GENESIS = hash_header(make_headers(1)[0])
+        self.headers = make_headers(3 * 2016 + 5)
+        raw = b''.join(bfh(serialize_header(h)) for h in self.headers)
+        self.chain.save_chunk(0, raw)
+        self.chain.checkpoints = [(hash_header(self.headers[2015]), 0)]
+        self.snapshot = os.path.join(self.electrum_dir, 'snapshot')
+
+    def test_export_import(self):
+        self.assertEqual(3 * 2016 + 4, self.chain.export_headers(self.snapshot))
+        with open(self.snapshot + '.json') as f:
+            meta = json.loads(f.read())
+        self.assertEqual(hash_header(self.headers[-1]), meta['tip'])
+        self.assertEqual(3, len(meta['checkpoints']))
+        self.chain.write(b'', 0)
+        self.assertEqual(-1, self.chain.height())
+        self.assertEqual(3 * 2016 + 4, self.chain.import_headers(self.snapshot))
+        self.assertEqual(self.headers[-1], self.chain.read_header(3 * 2016 + 4))
+
+    def test_drop_orphan_forks(self):
+        def fork(parent, height):
+            prev_hash = parent.get_hash(height - 1)
+            b = parent.fork(make_headers(1, prev_hash, height, salt=99)[0])
+            blockchain.blockchains[b.checkpoint] = b
+            return b
+        kept = fork(self.chain, 2016 + 100)
+        orphan = fork(self.chain, 3 * 2016)
+        above = fork(orphan, 3 * 2016 + 1)
+        for b in [orphan, above]:
+            open(b.chainwork_path(), 'wb').close()
+        # the main chain of the snapshot forks from ours at 2 * 2016
+        prev_hash = hash_header(self.headers[2 * 2016 - 1])
+        headers = self.headers[:2 * 2016] + make_headers(2016 + 5, prev_hash, 2 * 2016, salt=7)
+        with open(self.snapshot, 'wb') as f:
+            f.write(b''.join(bfh(serialize_header(h)) for h in headers))
+        self.chain.import_headers(self.snapshot)
+        self.assertCountEqual([orphan.checkpoint, above.checkpoint], blockchain.drop_orphan_forks())
+        self.assertEqual({0: self.chain, kept.checkpoint: kept}, blockchain.blockchains)
+        self.assertFalse(os.path.exists(orphan.path()))
+        self.assertFalse(os.path.exists(orphan.chainwork_path()))
+        self.assertFalse(os.path.exists(above.chainwork_path()))
+        self.assertFalse(os.path.exists(above.path()))
+
+    def test_keeps_local_chunks_over_empty_ones(self):
+        data = bytearray(self.chain.read_raw_headers(0, 3 * 2016 + 5))
+        data[0:2016 * 80] = bytes(2016 * 80)
+        with open(self.snapshot, 'wb') as f:
+            f.write(data)
+        self.chain.import_headers(self.snapshot)
+        self.assertEqual(self.headers[100], self.chain.read_header(100))
+
+    def test_keeps_longer_local_chain(self):
+        with open(self.snapshot, 'wb') as f:
+            f.write(bytes(self.chain.read_raw_headers(0, 2 * 2016)))
+        self.chain.import_headers(self.snapshot)
+        self.assertEqual(3 * 2016 + 4, self.chain.height())
+
+    def test_empty_checkpoint_chunk(self):
+        data = bytearray(self.chain.read_raw_headers(0, 2 * 2016))
+        data[0:2016 * 80] = bytes(2016 * 80)
+        self.assertEqual(hash_header(self.headers[2 * 2016 - 1]), self.chain.verify_snapshot(data))
+
+    def test_rejects_checkpoint_mismatch(self):
+        self.chain.checkpoints = [('11' * 32, 0)]
+        data = self.chain.read_raw_headers(0, 2016)
+        with self.assertRaisesRegex(BaseException, "checkpoint mismatch"):
+            self.chain.verify_snapshot(data)
+
+    def test_rejects_bad_header(self):
+        data = bytearray(self.chain.read_raw_headers(0, 3 * 2016))
+        data[2500 * 80 + 4] ^= 1
+        with open(self.snapshot, 'wb') as f:
+            f.write(data)
+        with self.assertRaisesRegex(BaseException, "prev hash mismatch"):
+            self.chain.import_headers(self.snapshot)
+        self.assertEqual(3 * 2016 + 4, self.chain.height())
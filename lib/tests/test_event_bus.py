@@ -0,0 +1,77 @@
+import threading
+import time
+import unittest
+
+from lib.event_bus import EventBus
+
+
+class TestEventBus(unittest.TestCase):
+
+    def setUp(self):
+        super(TestEventBus, self).setUp()
+        self.bus = EventBus(coalesce_delay=0.05)
+        self.events = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        super(TestEventBus, self).tearDown()
+        self.bus.stop()
+
+    def on_event(self, event, *args):
+        self.events.append((event,) + args)
+        if event == 'done':
+            self.done.set()
+
+    def test_coalesced_events(self):
+        self.bus.register(self.on_event, ['updated', 'interfaces', 'verified', 'done'])
+        for i in range(10):
+            self.bus.trigger('updated')
+            self.bus.trigger('interfaces', i)
+            self.bus.trigger('verified', i)
+        self.bus.trigger('done')
+        self.assertTrue(self.done.wait(5))
+        # in the order of the first event of each burst
+        verified = [('verified', i) for i in range(10)]
+        self.assertEqual([('updated',), ('interfaces', 9)] + verified + [('done',)], self.events)
+        stats = self.bus.get_stats()
+        self.assertEqual((31, 18), (stats['triggered'], stats['coalesced']))
+        self.assertEqual(13, stats['subscribers']['TestEventBus.on_event']['calls'])
+
+    def test_slow_callback(self):
+        # the triggering thread does not wait for callbacks
+        self.bus.register(lambda event: time.sleep(0.5), ['new_transaction'])
+        self.bus.register(self.on_event, ['done'])
+        t = time.time()
+        self.bus.trigger('new_transaction')
+        self.bus.trigger('done')
+        self.assertLess(time.time() - t, 0.1)
+        self.assertTrue(self.done.wait(5))
+
+    def test_failing_callback(self):
+        def fail(event):
+            raise Exception('callback error')
+        self.bus.register(fail, ['new_transaction'])
+        self.bus.register(self.on_event, ['new_transaction', 'done'])
+        self.bus.trigger('new_transaction')
+        self.bus.trigger('done')
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual([('new_transaction',), ('done',)], self.events)
+        errors = [s['errors'] for s in self.bus.get_stats()['subscribers'].values()]
+        self.assertEqual([0, 1], sorted(errors))
+
+    def test_stop(self):
+        self.bus.register(self.on_event, ['updated'])
+        self.bus.trigger('updated')
+        self.bus.stop()
+        self.assertEqual([('updated',)], self.events)
+        # later events are delivered by trigger
+        self.bus.trigger('updated')
+        self.assertEqual([('updated',), ('updated',)], self.events)
+
+    def test_unregister(self):
+        self.bus = EventBus(False)
+        self.bus.register(self.on_event, ['updated'])
+        self.bus.trigger('updated')
+        self.bus.unregister(self.on_event)
+        self.bus.trigger('updated')
+        self.assertEqual([('updated',)], self.events)
@@ -1,4 +1,12 @@
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
 import unittest
+from unittest import mock
 
 from lib import interface
 
@@ -24,3 +32,178 @@ class TestInterface(unittest.TestCase):
         self.assertTrue(i.check_host_name(
             peercert={'subject': [('commonName', 'foo.bar.com')]},
             name='foo.bar.com'))
+
+
+class FakePipe(object):
+
+    def __init__(self):
+        self.sent = []
+        self.responses = []
+        self.recv_time = 0
+
+    def send_all(self, requests):
+        self.sent.extend(requests)
+
+    def get(self):
+        if not self.responses:
+            raise interface.util.timeout
+        return self.responses.pop(0)
+
+    def idle_time(self):
+        return 0
+
+
+class TestRequestWindow(unittest.TestCase):
+
+    def setUp(self):
+        self.pipe = FakePipe()
+        self.interface = interface.Interface('host:1:s', None, self.pipe)
+        self.message_id = 0
+
+    def queue(self, n):
+        for i in range(n):
+            self.interface.queue_request('server.version', [], self.message_id)
+            self.message_id += 1
+
+    def answer_all(self, error=None):
+        for request in self.pipe.sent:
+            response = {'id': request['id'], 'result': None}
+            if error:
+                response['error'] = error
+            self.pipe.responses.append(response)
+        self.pipe.sent = []
+        return self.interface.get_responses()
+
+    def test_window_limits_requests(self):
+        self.queue(100)
+        self.assertEqual(interface.INITIAL_WINDOW, self.interface.num_requests())
+        self.interface.send_requests()
+        self.assertEqual(0, self.interface.num_requests())
+
+    def test_window_grows_on_fast_responses(self):
+        self.queue(5000)
+        sizes = []
+        for i in range(5):
+            self.interface.send_requests()
+            self.answer_all()
+            sizes.append(self.interface.window_size())
+        self.assertEqual([20, 40, 80, 160, 320], sizes)
+
+    def test_window_shrinks_on_errors(self):
+        self.queue(100)
+        self.interface.send_requests()
+        self.answer_all(error='excessive resource usage')
+        # halved once, not once per error
+        self.assertEqual(interface.INITIAL_WINDOW // 2, self.interface.window_size())
+
+    def test_window_shrinks_on_slow_responses(self):
+        self.queue(100)
+        self.interface.send_requests()
+        self.answer_all()
+        self.interface.send_requests()
+        for wire_id in self.interface.sent_time:
+            self.interface.sent_time[wire_id] -= interface.QUEUE_DELAY + 1
+        self.interface.last_decrease = 0
+        self.answer_all()
+        self.assertEqual(interface.INITIAL_WINDOW, self.interface.window_size())
+
+    def answer_late(self, delay):
+        self.interface.send_requests()
+        for wire_id in self.interface.sent_time:
+            self.interface.sent_time[wire_id] -= delay
+        self.answer_all()
+
+    def test_fast_response_is_forgotten(self):
+        self.queue(1)
+        self.answer_late(0)
+        # a slower link, without queueing
+        for i in range(30):
+            self.queue(1)
+            self.answer_late(interface.QUEUE_DELAY + 1)
+        window = self.interface.window_size()
+        self.interface.last_decrease = 0
+        self.queue(10)
+        self.answer_late(interface.QUEUE_DELAY + 1)
+        self.assertEqual(window, self.interface.window_size())
+
+    def test_slow_chunks_do_not_shrink_the_window(self):
+        self.queue(1)
+        self.answer_late(0)
+        self.interface.queue_request('blockchain.block.get_chunk', [0], self.message_id)
+        self.interface.last_decrease = 0
+        self.answer_late(interface.QUEUE_DELAY + 5)
+        self.assertEqual(interface.INITIAL_WINDOW, self.interface.window_size())
+
+    def test_window_shrinks_on_timeout(self):
+        self.queue(100)
+        self.interface.send_requests()
+        self.pipe.idle_time = lambda: interface.WINDOW_TIMEOUT + 1
+        self.interface.has_timed_out()
+        self.interface.has_timed_out()
+        self.assertEqual(interface.INITIAL_WINDOW // 2, self.interface.window_size())
+
+
+@unittest.skipUnless(shutil.which('openssl'), 'needs openssl to make a certificate')
+class TestTLSResumption(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTLSResumption, self).setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.electrum_dir, 'certs'))
+        cert = os.path.join(self.electrum_dir, 'certs', '127.0.0.1')
+        key = os.path.join(self.electrum_dir, 'key.pem')
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                               '-subj', '/CN=127.0.0.1', '-days', '1',
+                               '-keyout', key, '-out', cert],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.server = '127.0.0.1:%d:s' % self.listener.getsockname()[1]
+        threading.Thread(target=self.serve, args=(context,), daemon=True).start()
+
+    def tearDown(self):
+        super(TestTLSResumption, self).tearDown()
+        self.listener.close()
+        interface.tls_sessions.clear()
+        interface.tls_contexts.clear()
+        shutil.rmtree(self.electrum_dir)
+
+    def serve(self, context):
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except OSError:
+                return
+            try:
+                with context.wrap_socket(conn, server_side=True) as s:
+                    s.sendall(b'hello\n')
+                    s.recv(1)
+            except OSError:
+                pass
+
+    def connect(self):
+        s = interface.TcpConnection(self.server, None, self.electrum_dir).get_socket()
+        self.assertEqual(b'hello\n', s.recv(6))
+        reused = s.session_reused
+        interface.save_tls_session(self.server, s)
+        s.close()
+        return reused
+
+    def test_session_is_resumed(self):
+        self.assertFalse(self.connect())
+        self.assertTrue(self.connect())
+
+    def test_without_resumption(self):
+        # Python < 3.6: wrap_socket has no session argument
+        wrap_socket = ssl.SSLContext.wrap_socket
+        def old_wrap_socket(context, sock, **kwargs):
+            if 'session' in kwargs:
+                raise TypeError("unexpected keyword argument 'session'")
+            return wrap_socket(context, sock, **kwargs)
+        with mock.patch.object(interface, 'TLS_RESUMPTION', False), \
+                mock.patch.object(ssl.SSLContext, 'wrap_socket', old_wrap_socket):
+            self.assertFalse(self.connect())
+            self.assertFalse(self.connect())
@@ -0,0 +1,647 @@
+import json
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+from collections import defaultdict
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from lib.aionetwork import AsyncNetwork
+from lib.bitcoin import NetworkConstants, hash160_to_p2pkh
+from lib.broadcast import Broadcaster
+from lib.event_bus import EventBus
+from lib.network import Network, Subscription, CHUNK_RETRY_DELAY, DEFAULT_SERVER_WAIT
+from lib.network_stats import NetworkStats
+from lib.response_cache import ResponseCache
+from lib.server_stats import ServerStats
+from lib.synchronizer import history_status
+from lib import blockchain
+from lib.blockchain import hash_header, serialize_header
+from lib.transaction import Transaction
+from lib.util import bfh, bh2u
+from lib.tests.test_blockchain import BlockchainTestCase, make_headers
+from lib.tests.test_transaction import signed_blob
+
+
+class FakeInterface(object):
+
+    def __init__(self, server, tip, blockchain):
+        self.server = server
+        self.tip = tip
+        self.blockchain = blockchain
+        self.mode = 'default'
+        self.request = None
+        self.probes = {}
+        self.requests = []
+        self.unsent_requests = []
+        self.unanswered_requests = {}
+        self.responses = []
+        self.pipe = SimpleNamespace(bytes_sent=0, bytes_received=0)
+
+    def queue_request(self, method, params, message_id):
+        self.requests.append((method, params))
+        self.unanswered_requests[message_id] = (method, params, message_id)
+
+    def window_size(self):
+        return 10
+
+    def ping_required(self):
+        return False
+
+    def get_responses(self):
+        responses, self.responses = self.responses, []
+        return responses
+
+    def respond(self, result, error=None, method=None):
+        message_id = max(k for k, v in self.unanswered_requests.items()
+                         if method in (None, v[0]))
+        request = self.unanswered_requests.pop(message_id)
+        if error:
+            self.responses.append((request, {'id': message_id, 'error': error}))
+        else:
+            self.responses.append((request, {'id': message_id, 'result': result}))
+
+    def close(self):
+        pass
+
+    def print_error(self, *msg):
+        pass
+
+
+def make_network(config, blockchains):
+    '''A Network that is not connected to anything'''
+    network = Network.__new__(Network)
+    attrs = {
+        'config': config,
+        'blockchains': blockchains,
+        'lock': threading.Lock(),
+        'event_bus': EventBus(False),
+        'message_id': 0,
+        'debug': False,
+        'interface': None,
+        'interfaces': {},
+        'default_server': None,
+        'default_server_time': 0,
+        'auto_connect': True,
+        'connecting': set(),
+        'recent_servers': [],
+        'disconnected_servers': set(),
+        'chunk_window': 4,
+        'requested_chunks': {},
+        'received_chunks': {},
+        'failed_chunks': defaultdict(dict),
+        'verify_processes': 0,
+        'chunk_executor': None,
+        'unanswered_requests': {},
+        'pending_sends': [],
+        'pending_calls': [],
+        'subscriptions': {},
+        'subscribed_addresses': set(),
+        'spread_requests': True,
+        'server_stats': ServerStats(None),
+        'response_cache': ResponseCache(None, 0),
+        'stats': NetworkStats(),
+        'wakeup': lambda: None,
+        'broadcaster': Broadcaster(None),
+        'broadcast_servers': 3,
+    }
+    network.__dict__.update(attrs)
+    return network
+
+
+class NetworkTestCase(BlockchainTestCase):
+
+    def setUp(self):
+        super(NetworkTestCase, self).setUp()
+        self.network = make_network(self.config, {0: self.chain})
+
+    def add_interface(self, server, tip):
+        interface = FakeInterface(server, tip, self.chain)
+        self.network.interfaces[server] = interface
+        return interface
+
+
+class TestMainServer(NetworkTestCase):
+
+    def setUp(self):
+        super(TestMainServer, self).setUp()
+        self.network.connect = lambda server: None
+        self.network.create_interface = lambda server, socket: FakeInterface(server, 0, self.chain)
+        self.network.switch_to_interface('default:1:s')
+
+    def test_default_server_first(self):
+        self.network.new_interface('other:1:s', None)
+        self.assertIsNone(self.network.interface)
+        self.network.connecting.remove('default:1:s')
+        self.network.new_interface('default:1:s', None)
+        self.assertEqual('default:1:s', self.network.interface.server)
+
+    def test_default_server_late(self):
+        self.network.default_server_time -= DEFAULT_SERVER_WAIT + 1
+        self.network.new_interface('other:1:s', None)
+        self.assertEqual('other:1:s', self.network.interface.server)
+
+    def test_default_server_failed(self):
+        self.network.connecting.remove('default:1:s')
+        self.network.connection_down('default:1:s')
+        self.network.new_interface('other:1:s', None)
+        self.assertEqual('other:1:s', self.network.interface.server)
+
+    def test_without_auto_connect(self):
+        self.network.auto_connect = False
+        self.network.default_server_time -= DEFAULT_SERVER_WAIT + 1
+        self.network.new_interface('other:1:s', None)
+        self.assertIsNone(self.network.interface)
+
+
+class TestChunkDownload(NetworkTestCase):
+
+    def setUp(self):
+        super(TestChunkDownload, self).setUp()
+        self.headers = make_headers(5 * 2016 + 10)
+        raw = b''.join(bfh(serialize_header(h)) for h in self.headers)
+        self.chunks = [bh2u(raw[i*2016*80:(i+1)*2016*80]) for i in range(6)]
+        self.chain.save_chunk(0, bfh(self.chunks[0]))
+        self.lead = self.add_interface('lead:1:s', 5 * 2016 + 9)
+        self.lead.mode = 'catch_up'
+        self.chain.catch_up = self.lead.server
+
+    def respond(self, interface, index, result=None):
+        if result is None:
+            result = self.chunks[index]
+        response = {'params': [index], 'result': result}
+        self.network.on_get_chunk(interface, response)
+
+    def requested(self, interface):
+        return [params[0] for method, params in interface.requests]
+
+    def test_window_spread_over_interfaces(self):
+        other = self.add_interface('other:1:s', 5 * 2016 + 9)
+        short = self.add_interface('short:1:s', 5 * 2016)
+        self.network.fill_chunk_window(self.lead)
+        self.assertEqual([1, 2, 3, 4], sorted(self.network.requested_chunks))
+        for interface in [self.lead, other, short]:
+            self.assertTrue(self.requested(interface))
+        # the last, partial chunk only from servers that have all of it
+        for index in [1, 2, 3, 4]:
+            self.respond(self.network.interfaces[self.network.requested_chunks[index][0]], index)
+        self.assertIn(5, self.network.requested_chunks)
+        self.assertNotEqual(short.server, self.network.requested_chunks[5][0])
+
+    def test_out_of_order_completion(self):
+        other = self.add_interface('other:1:s', 5 * 2016 + 9)
+        self.network.chunk_window = 2
+        self.network.fill_chunk_window(self.lead)
+        servers = {i: self.network.interfaces[s] for i, (s, b) in self.network.requested_chunks.items()}
+        self.respond(servers[2], 2)
+        self.assertEqual(2016 - 1, self.chain.height())
+        self.respond(servers[1], 1)
+        self.assertEqual(3 * 2016 - 1, self.chain.height())
+        # the window moved on
+        self.assertEqual([3, 4], sorted(self.network.requested_chunks))
+
+    def test_catch_up_done(self):
+        self.network.chunk_window = 10
+        self.network.fill_chunk_window(self.lead)
+        for index in range(1, 6):
+            self.respond(self.lead, index)
+        self.assertEqual(self.lead.tip, self.chain.height())
+        self.assertEqual('default', self.lead.mode)
+        self.assertIsNone(self.chain.catch_up)
+
+    def test_header_request_in_flight(self):
+        # the response to the header decides how to catch up
+        self.lead.request = 2016
+        self.lead.request_time = time.time()
+        self.network.maintain_requests()
+        self.assertEqual({}, self.network.requested_chunks)
+        self.lead.request = None
+        self.network.maintain_requests()
+        self.assertIn(1, self.network.requested_chunks)
+
+    def test_bad_chunk_is_requested_elsewhere(self):
+        other = self.add_interface('other:1:s', 5 * 2016 + 9)
+        self.network.chunk_window = 1
+        self.network.request_chunk(other, 1, self.chain)
+        bad = bytearray(bfh(self.chunks[1]))
+        bad[80 * 5 + 4] ^= 1
+        self.respond(other, 1, bh2u(bad))
+        self.assertEqual(2016 - 1, self.chain.height())
+        self.assertIn(other.server, self.network.interfaces)
+        self.assertEqual(self.lead.server, self.network.requested_chunks[1][0])
+        self.respond(self.lead, 1)
+        self.assertEqual(2 * 2016 - 1, self.chain.height())
+
+    def test_sources_follow_the_same_branch(self):
+        fork_header = make_headers(1, hash_header(self.headers[99]), 100, salt=99)[0]
+        other = self.add_interface('other:1:s', 5 * 2016 + 9)
+        other.blockchain = self.chain.fork(fork_header)
+        self.network.fill_chunk_window(self.lead)
+        self.assertEqual([1, 2, 3, 4], sorted(self.network.requested_chunks))
+        self.assertEqual({self.lead.server}, {s for s, b in self.network.requested_chunks.values()})
+        self.assertEqual([], other.requests)
+
+    def test_failed_chunk_is_retried(self):
+        # the lead is the only source
+        self.network.fill_chunk_window(self.lead)
+        self.network.on_get_chunk(self.lead, {'params': [1], 'error': 'busy'})
+        for index in range(2, 5):
+            self.respond(self.lead, index)
+        self.assertEqual(2016 - 1, self.chain.height())
+        self.network.maintain_requests()
+        self.assertNotIn(1, self.network.requested_chunks)
+        self.network.failed_chunks[1][self.lead.server] -= CHUNK_RETRY_DELAY + 1
+        self.network.maintain_requests()
+        self.assertEqual({}, self.network.failed_chunks)
+        self.assertEqual(self.lead.server, self.network.requested_chunks[1][0])
+        self.respond(self.lead, 1)
+        self.respond(self.lead, 5)
+        self.assertEqual(self.lead.tip, self.chain.height())
+        self.assertEqual('default', self.lead.mode)
+
+    def test_unsolicited_chunk(self):
+        other = self.add_interface('other:1:s', 5 * 2016 + 9)
+        self.network.request_chunk(self.lead, 1)
+        self.respond(other, 1)
+        self.assertEqual(2016 - 1, self.chain.height())
+        self.assertIn(1, self.network.requested_chunks)
+
+
+class TestForkSearch(NetworkTestCase):
+
+    def setUp(self):
+        super(TestForkSearch, self).setUp()
+        self.network.blockchains = blockchain.blockchains
+        self.network.blockchain_index = 0
+        self.network.auto_connect = False
+        self.headers = make_headers(200)
+        self.save_headers(self.chain, self.headers)
+
+    def server_headers(self, fork, tip, salt=1):
+        '''Headers of a server whose branch forks from ours at fork'''
+        prev_hash = hash_header(self.headers[fork - 1])
+        return self.headers[:fork] + make_headers(tip + 1 - fork, prev_hash, fork, salt)
+
+    def serve(self, interface, headers):
+        '''Answers the header requests of interface, and returns the
+        number of round trips of the fork search'''
+        self.network.interface = interface
+        self.network.on_notify_header(interface, headers[-1])
+        rounds = 0
+        while interface.request:
+            if interface.mode in ['backward', 'binary']:
+                rounds += 1
+            for height in list(interface.request):
+                self.network.on_get_header(interface, {'result': headers[height]})
+        return rounds
+
+    def test_catch_up(self):
+        interface = self.add_interface('server:1:s', 0)
+        self.assertEqual(1, self.serve(interface, self.server_headers(200, 205)))
+        self.assertEqual('default', interface.mode)
+        self.assertEqual(205, self.chain.height())
+
+    def check_reorg(self, fork, rounds):
+        interface = self.add_interface('server:1:s', 0)
+        headers = self.server_headers(fork, 204)
+        self.assertEqual(rounds, self.serve(interface, headers))
+        self.assertEqual('default', interface.mode)
+        self.assertIn(fork, self.network.blockchains)
+        self.assertEqual(204, interface.blockchain.height())
+        self.assertTrue(interface.blockchain.check_header(headers[-1]))
+
+    def test_conflict_with_existing_fork(self):
+        self.serve(self.add_interface('first:1:s', 0), self.server_headers(190, 195))
+        interface = self.add_interface('second:1:s', 0)
+        headers = self.server_headers(190, 197, salt=2)
+        self.serve(interface, headers)
+        # the branch at that checkpoint now follows the second server
+        branch = self.network.blockchains[190]
+        self.assertIs(branch, interface.blockchain)
+        self.assertEqual('default', interface.mode)
+        self.assertEqual(197, branch.height())
+        self.assertTrue(branch.check_header(headers[-1]))
+
+    def test_blockchains_heaviest_first(self):
+        main = self.add_interface('main:1:s', 0)
+        self.serve(main, self.headers)
+        # one header of this branch is saved before chunks take over
+        light = self.add_interface('light:1:s', 0)
+        self.serve(light, self.server_headers(150, 204))
+        heavy = self.add_interface('heavy:1:s', 0)
+        self.serve(heavy, self.server_headers(190, 195))
+        chains = self.network.get_blockchains()
+        self.assertEqual([0, 190, 150], list(chains))
+        self.assertEqual([[main], [heavy], [light]], list(chains.values()))
+
+    def test_reorg_one_block(self):
+        self.check_reorg(199, 1)
+
+    def test_reorg_two_blocks(self):
+        self.check_reorg(198, 2)
+
+    def test_deep_reorg(self):
+        self.check_reorg(180, 3)
+
+    def test_join_fork(self):
+        headers = self.server_headers(150, 204)
+        self.serve(self.add_interface('first:1:s', 0), headers)
+        interface = self.add_interface('second:1:s', 0)
+        self.assertEqual(3, self.serve(interface, headers))
+        self.assertIs(self.network.blockchains[150], interface.blockchain)
+
+
+class TestSpreadRequests(NetworkTestCase):
+
+    def setUp(self):
+        super(TestSpreadRequests, self).setUp()
+        self.main = self.add_interface('main:1:s', 0)
+        self.other = self.add_interface('other:1:s', 0)
+        self.network.interface = self.main
+        self.network.default_server = self.main.server
+        # busy with subscriptions
+        self.main.unsent_requests = [None] * 5
+        self.txid = Transaction(signed_blob).txid()
+        self.results = []
+
+    def send(self, method, params):
+        self.network.send([(method, params)], self.results.append)
+        self.network.process_pending_sends()
+
+    def test_least_loaded_interface(self):
+        self.send('blockchain.transaction.get', [self.txid])
+        self.assertEqual([('blockchain.transaction.get', [self.txid])], self.other.requests)
+        # not spread: other requests, and servers on another branch
+        self.send('blockchain.estimatefee', [2])
+        self.other.blockchain = None
+        self.send('blockchain.transaction.get', [self.txid])
+        self.assertEqual(1, len(self.other.requests))
+        self.assertEqual(2, len(self.main.requests))
+
+    def test_checked_response(self):
+        self.send('blockchain.transaction.get', [self.txid])
+        self.other.respond(signed_blob)
+        self.network.process_responses(self.other)
+        self.assertEqual([signed_blob], [r['result'] for r in self.results])
+
+    def test_verbose_transaction_is_sent_to_main(self):
+        self.send('blockchain.transaction.get', [self.txid, True])
+        self.assertEqual([], self.other.requests)
+        self.assertEqual([('blockchain.transaction.get', [self.txid, True])], self.main.requests)
+
+    def test_wrong_response_is_sent_to_main(self):
+        self.send('blockchain.transaction.get', [self.txid])
+        self.other.respond(signed_blob[:-2] + '01')
+        self.network.process_responses(self.other)
+        self.assertEqual([], self.results)
+        self.assertEqual([('blockchain.transaction.get', [self.txid])], self.main.requests)
+        self.main.respond(signed_blob)
+        self.network.process_responses(self.main)
+        self.assertEqual(1, len(self.results))
+
+    def test_history_checked_against_status(self):
+        h = 'ab' * 32
+        history = [{'tx_hash': self.txid, 'height': 5}]
+        k = self.network.get_index('blockchain.scripthash.subscribe', [h])
+        self.network.subscriptions[k] = Subscription()
+        self.network.subscriptions[k].response = {'result': history_status([(self.txid, 5)])}
+        self.send('blockchain.scripthash.get_history', [h])
+        self.other.respond(history[:0])
+        self.network.process_responses(self.other)
+        self.assertEqual([], self.results)
+        self.main.respond(history)
+        self.network.process_responses(self.main)
+        self.assertEqual([history], [r['result'] for r in self.results])
+
+    def test_cached_transaction(self):
+        self.network.response_cache = ResponseCache(os.path.join(self.electrum_dir, 'cache'), 2**20)
+        self.send('blockchain.transaction.get', [self.txid])
+        self.other.respond(signed_blob)
+        self.network.process_responses(self.other)
+        self.send('blockchain.transaction.get', [self.txid])
+        self.assertEqual(1, len(self.other.requests + self.main.requests))
+        self.assertEqual([signed_blob] * 2, [r['result'] for r in self.results])
+        self.assertEqual(1, self.network.get_cache_stats()['hits'])
+        self.network.response_cache.close()
+
+    def test_requests_of_lost_server_are_sent_again(self):
+        self.send('blockchain.transaction.get', [self.txid])
+        self.network.connection_down(self.other.server)
+        self.assertEqual(1, len(self.network.pending_sends))
+        self.network.process_pending_sends()
+        self.assertEqual([('blockchain.transaction.get', [self.txid])], self.main.requests)
+
+
+class TestBroadcast(NetworkTestCase):
+
+    def setUp(self):
+        super(TestBroadcast, self).setUp()
+        self.main = self.add_interface('main:1:s', 0)
+        self.others = [self.add_interface('other%d:1:s' % i, 0) for i in range(3)]
+        self.network.interface = self.main
+        self.network.default_server = self.main.server
+        self.network.broadcaster = Broadcaster(self.electrum_dir)
+        self.txid = Transaction(signed_blob).txid()
+
+    def submit(self):
+        future = Future()
+        self.network.broadcaster.submit(self.txid, signed_blob, future)
+        self.network.process_pending_sends()
+        return future
+
+    def sent_to(self):
+        return [i for i in [self.main] + self.others
+                if ('blockchain.transaction.broadcast', [signed_blob]) in i.requests]
+
+    def answer(self, interface, result, error=None):
+        interface.respond(result, error, 'blockchain.transaction.broadcast')
+        self.network.process_responses(interface)
+
+    def test_first_acceptance(self):
+        future = self.submit()
+        sent_to = self.sent_to()
+        self.assertEqual(3, len(sent_to))
+        self.assertIs(self.main, sent_to[0])
+        self.answer(sent_to[0], None, 'server busy')
+        self.assertFalse(future.done())
+        self.answer(sent_to[1], self.txid)
+        self.assertEqual((True, self.txid), future.result(0))
+        stats = self.network.get_network_stats()['broadcast']
+        self.assertEqual({'accepted': 0, 'errors': 1}, stats['servers'][self.main.server])
+        self.assertEqual('accepted', stats['recent'][self.txid][sent_to[1].server])
+
+    def test_all_refused(self):
+        self.network.broadcast_servers = 2
+        future = self.submit()
+        main, other = self.sent_to()
+        self.answer(other, None, 'server busy')
+        self.answer(main, None, 'missing inputs')
+        self.assertEqual((False, 'error: missing inputs'), future.result(0))
+        self.assertEqual({}, self.network.broadcaster.queue)
+
+    def test_lost_server(self):
+        self.network.broadcast_servers = 1
+        future = self.submit()
+        self.network.connection_down(self.main.server)
+        self.assertEqual((False, 'error: connection closed'), future.result(0))
+
+    def test_main_server_switch(self):
+        self.network.broadcast_servers = 2
+        future = self.submit()
+        main, other = self.sent_to()
+        self.network.switch_to_interface(other.server)
+        # not sent again to the new main server
+        self.assertEqual(1, other.requests.count(('blockchain.transaction.broadcast', [signed_blob])))
+        self.network.connection_down(main.server)
+        self.assertFalse(future.done())
+        self.answer(other, self.txid)
+        self.assertEqual((True, self.txid), future.result(0))
+        stats = self.network.get_network_stats()['broadcast']
+        self.assertEqual(1, stats['servers'][other.server]['accepted'])
+        self.assertEqual({'accepted': 0, 'errors': 1}, stats['servers'][main.server])
+
+    def test_retry_queue(self):
+        self.network.broadcaster.enqueue(self.txid, signed_blob)
+        # kept across restarts
+        broadcaster = self.network.broadcaster = Broadcaster(self.electrum_dir)
+        self.assertIn(self.txid, broadcaster.queue)
+        broadcaster.queue[self.txid]['next_try'] = 0
+        self.network.process_pending_sends()
+        for interface in self.sent_to():
+            self.answer(interface, None, 'server busy')
+        item = broadcaster.queue[self.txid]
+        self.assertEqual(1, item['attempts'])
+        self.assertGreater(item['next_try'], time.time())
+        # sent again once due, and dropped from the queue when accepted
+        item['next_try'] = 0
+        self.network.process_pending_sends()
+        self.answer(self.main, self.txid)
+        self.assertEqual({}, Broadcaster(self.electrum_dir).queue)
+
+
+class TestSubscriptions(NetworkTestCase):
+
+    def setUp(self):
+        super(TestSubscriptions, self).setUp()
+        self.main = self.add_interface('main:1:s', 0)
+        self.network.interface = self.main
+        self.addresses = [hash160_to_p2pkh(bytes([i]) * 20) for i in range(3)]
+        self.results = []
+
+    def subscribe(self, callback):
+        self.network.subscribe_to_addresses(self.addresses, callback)
+        self.network.process_pending_sends()
+
+    def test_address_subscriptions(self):
+        self.subscribe(self.results.append)
+        self.subscribe(self.results.append)
+        # no response yet to answer the second one
+        self.assertEqual(6, len(self.main.requests))
+        stats = self.network.get_subscription_stats()
+        self.assertEqual((3, 3), (stats['subscriptions'], stats['callbacks']))
+        self.main.respond('status')
+        self.network.process_responses(self.main)
+        self.assertEqual([[self.addresses[2]]], [r['params'] for r in self.results])
+        # answered from the cache
+        self.subscribe(self.results.append)
+        self.assertEqual(2, len(self.results))
+        self.assertEqual(1, self.network.get_subscription_stats()['cached_responses'])
+
+    def test_subscribing_wakes_up_the_network(self):
+        wakeups = []
+        self.network.wakeup = lambda: wakeups.append(1)
+        self.network.subscribe_to_addresses(self.addresses, self.results.append)
+        self.assertEqual(1, len(wakeups))
+
+    def test_unsubscribe_frees_subscriptions(self):
+        other = []
+        self.subscribe(self.results.append)
+        self.network.send([('blockchain.scripthash.subscribe', ['ab'])], other.append)
+        self.network.process_pending_sends()
+        for i in range(4):
+            self.main.respond('status')
+        self.network.process_responses(self.main)
+        self.assertEqual(4, len(self.network.subscribed_addresses))
+        self.network.unsubscribe(self.results.append)
+        self.assertEqual(['blockchain.scripthash.subscribe:ab'], list(self.network.subscriptions))
+        self.assertEqual({'ab'}, self.network.subscribed_addresses)
+        self.network.unsubscribe(other.append)
+        stats = self.network.get_subscription_stats()
+        self.assertEqual((0, 0, 0), (stats['subscriptions'], stats['callbacks'], stats['subscribed_addresses']))
+
+
+class FakeServerHandler(socketserver.StreamRequestHandler):
+
+    results = {
+        'server.banner': 'hello',
+        'blockchain.headers.subscribe': {'block_height': 0},
+        'server.peers.subscribe': [],
+        'blockchain.estimatefee': -1,
+        'blockchain.relayfee': 0.00001,
+    }
+
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line.decode('utf8'))
+            if request['method'] in self.results:
+                response = {'id': request['id'], 'result': self.results[request['method']]}
+            else:
+                response = {'id': request['id'], 'error': 'unknown method'}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf8'))
+
+
+class TestNetworkThread(unittest.TestCase):
+
+    network_class = Network
+
+    def setUp(self):
+        super(TestNetworkThread, self).setUp()
+        NetworkConstants.set_testnet()
+        self.addCleanup(NetworkConstants.set_mainnet)
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakeServerHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.electrum_dir = tempfile.mkdtemp()
+        server = '127.0.0.1:%d:t' % self.server.server_address[1]
+        self.network = self.network_class({'electrum_path': self.electrum_dir, 'server': server,
+                                     'oneserver': True, 'auto_connect': False})
+        self.network.start()
+
+    def tearDown(self):
+        super(TestNetworkThread, self).tearDown()
+        self.network.stop()
+        self.network.join()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.electrum_dir)
+
+    def test_request(self):
+        self.assertEqual('hello', self.network.synchronous_get(('server.banner', []), timeout=5))
+        self.assertTrue(self.network.is_connected())
+        stats = self.network.get_network_stats()
+        self.assertGreaterEqual(stats['methods']['server.banner']['latency']['count'], 1)
+        self.assertGreater(stats['bytes_received'], 0)
+
+    def test_gather(self):
+        requests = [('server.banner', []), ('blockchain.relayfee', []), ('server.features', [])]
+        with self.assertRaises(BaseException):
+            self.network.gather(requests, timeout=5)
+        results = self.network.gather(requests, timeout=5, return_exceptions=True)
+        self.assertEqual(['hello', 0.00001], results[:2])
+        self.assertIsInstance(results[2], BaseException)
+        future = self.network.async_get(('server.banner', []))
+        self.assertEqual('hello', future.result(5))
+
+    def test_run_in_network_thread(self):
+        self.assertIs(self.network, self.network.run_in_network_thread(threading.current_thread, 5))
+        with self.assertRaises(ZeroDivisionError):
+            self.network.run_in_network_thread(lambda: 1 / 0, 5)
+
+
+class TestAsyncNetwork(TestNetworkThread):
+
+    network_class = AsyncNetwork
@@ -0,0 +1,33 @@
+import unittest
+
+from lib.network_stats import Histogram, NetworkStats
+
+
+class TestNetworkStats(unittest.TestCase):
+
+    def test_histogram(self):
+        h = Histogram()
+        for ms in [0.5, 3, 3, 40, 20000]:
+            h.add(ms)
+        stats = h.get_stats()
+        self.assertEqual(5, stats['count'])
+        self.assertEqual({'<=1': 1, '<=5': 2, '<=50': 1, '>10000': 1}, stats['buckets'])
+        self.assertEqual(5, stats['p50_ms'])
+        self.assertEqual(20000, stats['p99_ms'])
+        self.assertEqual(20000, stats['max_ms'])
+
+    def test_empty_histogram(self):
+        stats = Histogram().get_stats()
+        self.assertEqual((0, 0, 0), (stats['count'], stats['mean_ms'], stats['p90_ms']))
+
+    def test_methods(self):
+        stats = NetworkStats()
+        stats.request_sent('server.version')
+        stats.request_sent('server.version')
+        stats.response_received('server.version', 0.02, None)
+        stats.response_received('server.version', 0.2, {'message': 'error'})
+        stats.callback_done('server.version', 0.001)
+        m = stats.get_stats()['methods']['server.version']
+        self.assertEqual((2, 1), (m['sent'], m['errors']))
+        self.assertEqual(2, m['latency']['count'])
+        self.assertEqual(1, m['callbacks']['count'])
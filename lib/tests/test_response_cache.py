@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.response_cache import ResponseCache
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        super(TestResponseCache, self).setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.electrum_dir, 'response_cache')
+        self.cache = ResponseCache(self.path, 1000)
+
+    def tearDown(self):
+        super(TestResponseCache, self).tearDown()
+        self.cache.close()
+        shutil.rmtree(self.electrum_dir)
+
+    def test_get(self):
+        self.assertIsNone(self.cache.get('m', ['a']))
+        self.cache.put('m', ['a'], {'x': 1})
+        self.assertEqual({'x': 1}, self.cache.get('m', ['a']))
+        self.assertIsNone(self.cache.get('m', ['b']))
+        stats = self.cache.get_stats()
+        self.assertEqual((1, 2, 1), (stats['hits'], stats['misses'], stats['count']))
+
+    def test_lru_eviction(self):
+        value = 'x' * 298  # 300 bytes as json
+        for key in ['a', 'b', 'c']:
+            self.cache.put('m', [key], value)
+        self.cache.get('m', ['a'])
+        self.cache.put('m', ['d'], value)
+        self.assertIsNone(self.cache.get('m', ['b']))
+        for key in ['a', 'c', 'd']:
+            self.assertEqual(value, self.cache.get('m', [key]))
+        self.assertEqual(900, self.cache.get_stats()['size'])
+
+    def test_reorg(self):
+        self.cache.put('m', ['a'], 1, 100, 'hash100')
+        self.cache.put('m', ['b'], 2, 200, 'hash200')
+        self.cache.put('m', ['c'], 3, 50, 'hash50')
+        self.cache.put('t', ['d'], 4)
+        chain = {50: 'hash50', 100: 'other'}
+        is_valid = lambda height, block_hash: chain.get(height) == block_hash
+        self.assertIsNone(self.cache.get('m', ['a'], is_valid))
+        # the blocks above it are dropped too
+        self.assertEqual(2, self.cache.get_stats()['count'])
+        self.assertEqual(3, self.cache.get('m', ['c'], is_valid))
+        self.assertEqual(4, self.cache.get('t', ['d'], is_valid))
+
+    def test_persistence(self):
+        self.cache.put('m', ['a'], [1, 2])
+        self.cache.close()
+        self.cache = ResponseCache(self.path, 1000)
+        self.assertEqual([1, 2], self.cache.get('m', ['a']))
+        self.assertEqual(6, self.cache.get_stats()['size'])
+
+    def test_corrupt_file_is_replaced(self):
+        self.cache.close()
+        with open(self.path, 'wb') as f:
+            f.write(b'garbage' * 100)
+        self.cache = ResponseCache(self.path, 1000)
+        self.cache.put('m', ['a'], 1)
+        self.assertEqual(1, self.cache.get('m', ['a']))
+
+    def test_disabled(self):
+        cache = ResponseCache(None, 0)
+        cache.put('m', ['a'], 1)
+        self.assertIsNone(cache.get('m', ['a']))
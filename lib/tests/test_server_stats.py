@@ -0,0 +1,60 @@
+import shutil
+import tempfile
+import unittest
+
+from lib import server_stats
+from lib.server_stats import ServerStats
+
+
+class TestServerStats(unittest.TestCase):
+
+    def setUp(self):
+        super(TestServerStats, self).setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+        self.stats = ServerStats(self.electrum_dir)
+
+    def tearDown(self):
+        super(TestServerStats, self).tearDown()
+        shutil.rmtree(self.electrum_dir)
+
+    def connect(self, server, ok=True):
+        self.stats.start_connecting(server)
+        if ok:
+            self.stats.connected(server)
+        else:
+            self.stats.connection_failed(server)
+
+    def test_rank(self):
+        for server in ['fast:1:s', 'slow:1:s', 'failing:1:s', 'lagging:1:s', 'timeout:1:s']:
+            self.connect(server)
+            self.stats.ping(server, 0.1)
+        self.stats.ping('slow:1:s', 3)
+        self.connect('failing:1:s', False)
+        self.stats.lag('lagging:1:s', 5)
+        self.stats.timed_out('timeout:1:s')
+        ranked = self.stats.rank(self.stats.stats)
+        self.assertEqual('fast:1:s', ranked[0])
+        self.assertEqual(['failing:1:s', 'timeout:1:s'], sorted(ranked[3:]))
+        # unknown servers come before bad ones
+        ranked = self.stats.rank(['failing:1:s', 'new:1:s'])
+        self.assertEqual(['new:1:s', 'failing:1:s'], ranked)
+
+    def test_pick_among_the_best(self):
+        servers = ['s%d:1:s' % i for i in range(10)]
+        for server in servers[server_stats.PICK_AMONG:]:
+            self.connect(server, False)
+        for i in range(20):
+            self.assertIn(self.stats.pick(servers), servers[:server_stats.PICK_AMONG])
+        self.assertIsNone(self.stats.pick([]))
+
+    def test_failure_without_connect_is_ignored(self):
+        self.stats.connection_failed('a:1:s')
+        self.assertNotIn('a:1:s', self.stats.stats)
+
+    def test_persistence(self):
+        self.connect('a:1:s')
+        self.stats.ping('a:1:s', 0.5)
+        self.stats.save()
+        stats = ServerStats(self.electrum_dir)
+        self.assertEqual(0.5, stats.stats['a:1:s']['rtt'])
+        self.assertEqual(self.stats.score('a:1:s'), stats.score('a:1:s'))
@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+import threading
+import unittest
+
+from lib.bitcoin import NetworkConstants, address_to_scripthash
+from lib.network import Network
+from lib.storage import WalletStorage
+from lib.stub_server import Dataset, StubServer
+from lib.synchronizer import history_status
+from lib.wallet import Imported_Wallet
+
+
+class TestStubServer(unittest.TestCase):
+
+    def setUp(self):
+        super(TestStubServer, self).setUp()
+        NetworkConstants.set_regtest()
+        self.addCleanup(NetworkConstants.set_mainnet)
+        self.dataset = Dataset(num_blocks=2100, num_addresses=3, txs_per_address=2)
+
+    def start_server(self, **kwargs):
+        server = StubServer(('127.0.0.1', 0), self.dataset, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def request(self, sock, f, method, params, message_id=0):
+        sock.sendall((json.dumps({'id': message_id, 'method': method, 'params': params}) + '\n').encode('utf8'))
+        return json.loads(f.readline().decode('utf8'))
+
+    def test_responses(self):
+        server = self.start_server()
+        sock = socket.create_connection(server.server_address)
+        self.addCleanup(sock.close)
+        f = sock.makefile('rb')
+        sh = address_to_scripthash(self.dataset.addresses[0])
+        status = self.request(sock, f, 'blockchain.scripthash.subscribe', [sh])['result']
+        history = self.request(sock, f, 'blockchain.scripthash.get_history', [sh])['result']
+        self.assertEqual(2, len(history))
+        self.assertEqual(history_status([(x['tx_hash'], x['height']) for x in history]), status)
+        chunk = self.request(sock, f, 'blockchain.block.get_chunk', [1])['result']
+        self.assertEqual(85 * 80 * 2, len(chunk))
+        response = self.request(sock, f, 'blockchain.transaction.get', ['00' * 32], 7)
+        self.assertEqual(7, response['id'])
+        self.assertIn('error', response)
+
+    def test_latency_and_errors(self):
+        server = self.start_server(latency=0.1, error_rate=1)
+        sock = socket.create_connection(server.server_address)
+        self.addCleanup(sock.close)
+        f = sock.makefile('rb')
+        t = time.time()
+        response = self.request(sock, f, 'server.banner', [])
+        self.assertGreaterEqual(time.time() - t, 0.1)
+        self.assertEqual('injected error', response['error']['message'])
+
+    def test_error_methods(self):
+        server = self.start_server(error_rate=1, error_methods=['server.banner'])
+        sock = socket.create_connection(server.server_address)
+        self.addCleanup(sock.close)
+        f = sock.makefile('rb')
+        self.assertIn('error', self.request(sock, f, 'server.banner', []))
+        self.assertEqual(0.00001, self.request(sock, f, 'blockchain.relayfee', [])['result'])
+
+    def test_synchronize_wallet(self):
+        server = self.start_server(latency=0.005, jitter=0.005)
+        electrum_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, electrum_dir)
+        network = Network({'electrum_path': electrum_dir, 'server': server.server_string(),
+                           'oneserver': True, 'auto_connect': False})
+        network.start()
+        self.addCleanup(network.join)
+        self.addCleanup(network.stop)
+        wallet = Imported_Wallet(WalletStorage(os.path.join(electrum_dir, 'wallet')))
+        for address in self.dataset.addresses:
+            wallet.import_address(address)
+        wallet.start_threads(network)
+        self.addCleanup(wallet.stop_threads)
+        deadline = time.time() + 20
+        while time.time() < deadline:
+            if (network.get_local_height() == self.dataset.height() and wallet.is_up_to_date()
+                    and len(wallet.verified_tx) == len(self.dataset.transactions)):
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.dataset.height(), network.get_local_height())
+        self.assertEqual(set(self.dataset.transactions), set(wallet.verified_tx))
+        total = sum(x['value'] for u in self.dataset.unspent.values() for x in u)
+        self.assertEqual(total, sum(wallet.get_balance()))
@@ -1,5 +1,9 @@
+import json
+import select
+import socket
+import threading
 import unittest
-from lib.util import format_satoshis, parse_URI
+from lib.util import Wakeup, format_satoshis, parse_URI, JSONLineDecoder, SocketPipe
 
 class TestUtil(unittest.TestCase):
 
@@ -68,3 +72,66 @@ class TestUtil(unittest.TestCase):
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoin:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
 
+
+
+class TestJSONLineDecoder(unittest.TestCase):
+
+    def decode(self, decoder):
+        messages = []
+        while True:
+            message = decoder.next()
+            if message is None:
+                return messages
+            messages.append(message)
+
+    def test_split_messages(self):
+        decoder = JSONLineDecoder()
+        decoder.feed(b'{"id": 1}\n{"id"')
+        self.assertEqual([{'id': 1}], self.decode(decoder))
+        decoder.feed(b': 2}')
+        self.assertEqual([], self.decode(decoder))
+        decoder.feed(b'\n[3]\n')
+        self.assertEqual([{'id': 2}, [3]], self.decode(decoder))
+        self.assertEqual(0, decoder.pending())
+
+    def test_invalid_line_is_skipped(self):
+        decoder = JSONLineDecoder()
+        decoder.feed(b'{"id": 1\nnull\n{"id": 2}\n')
+        self.assertEqual([{'id': 2}], self.decode(decoder))
+
+    def test_buffer_is_reused(self):
+        decoder = JSONLineDecoder()
+        decoder.feed(b'[1]\n' * 1000 + b'[2')
+        self.assertEqual(1000, len(self.decode(decoder)))
+        size = len(decoder.buf)
+        decoder.feed(b'0]\n' + b'[3]\n' * 999)
+        self.assertEqual([[20]] + [[3]] * 999, self.decode(decoder))
+        self.assertEqual(size, len(decoder.buf))
+
+    def test_socket_pipe(self):
+        a, b = socket.socketpair()
+        result = ['%064x' % i for i in range(20000)]
+        data = json.dumps({'id': 1, 'result': result}).encode() + b'\n[2]\n'
+        def send():
+            a.sendall(data)
+            a.close()
+        threading.Thread(target=send).start()
+        pipe = SocketPipe(b)
+        pipe.set_timeout(5)
+        self.assertEqual(result, pipe.get()['result'])
+        self.assertEqual([2], pipe.get())
+        self.assertIsNone(pipe.get())
+        b.close()
+
+
+class TestWakeup(unittest.TestCase):
+
+    def test_wakeup(self):
+        w = Wakeup()
+        self.assertEqual(([], [], []), select.select([w], [], [], 0))
+        w.set()
+        w.set()
+        self.assertEqual([w], select.select([w], [], [], 1)[0])
+        w.clear()
+        self.assertEqual(([], [], []), select.select([w], [], [], 0))
+        w.close()
@@ -6,7 +6,9 @@ import os
 import json
 
 from io import StringIO
+from lib.bitcoin import serialize_privkey
 from lib.storage import WalletStorage, FINAL_SEED_VERSION
+from lib.wallet import sweep_preparations
 
 
 class FakeSynchronizer(object):
@@ -67,3 +69,28 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.gathered = []
+
+    def gather(self, requests):
+        self.gathered.append(requests)
+        return [[{'tx_hash': '%064x' % i, 'tx_pos': 0, 'height': 1, 'value': 1000}]
+                for i in range(len(requests))]
+
+
+class TestSweepPreparations(unittest.TestCase):
+
+    def test_lookups_in_one_round_trip(self):
+        network = FakeNetwork()
+        privkeys = [serialize_privkey(bytes([i]) * 32, True, 'p2pkh') for i in [1, 2]]
+        inputs, keypairs = sweep_preparations(privkeys, network, imax=3)
+        # p2pkh and p2pk outputs of each key
+        self.assertEqual(1, len(network.gathered))
+        self.assertEqual(4, len(network.gathered[0]))
+        self.assertEqual(3, len(inputs))
+        self.assertEqual(['p2pkh', 'p2pk', 'p2pkh'], [i['type'] for i in inputs])
+        self.assertEqual(2, len(keypairs))
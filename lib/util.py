@@ -120,6 +120,42 @@ class DebugMem(ThreadJob):
             self.mem_stats()
             self.next_time = time.time() + self.interval
 
+# longest wait of a DaemonThread for an event, so that it notices when
+# its parent thread is gone
+DAEMON_WAIT_TIMEOUT = 1.0
+
+
+class Wakeup(object):
+    '''A socket pair, to wake up a thread that waits in select() from
+    other threads.  Pass it to select() with the sockets.'''
+
+    def __init__(self):
+        self.r, self.w = socket.socketpair()
+        self.r.setblocking(False)
+        self.w.setblocking(False)
+
+    def fileno(self):
+        return self.r.fileno()
+
+    def set(self):
+        try:
+            self.w.send(b'\0')
+        except OSError:
+            # the buffer is full: a wakeup is pending anyway
+            pass
+
+    def clear(self):
+        try:
+            while self.r.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        self.r.close()
+        self.w.close()
+
+
 class DaemonThread(threading.Thread, PrintError):
     """ daemon thread that terminates cleanly """
 
@@ -131,9 +167,15 @@ class DaemonThread(threading.Thread, PrintError):
         self.job_lock = threading.Lock()
         self.jobs = []
 
+    def wakeup(self):
+        '''Called when there is something to do, from any thread.
+        Threads that wait for events override it.'''
+        pass
+
     def add_jobs(self, jobs):
         with self.job_lock:
             self.jobs.extend(jobs)
+        self.wakeup()
 
     def run_jobs(self):
         # Don't let a throwing job disrupt the thread, future runs of
@@ -163,6 +205,7 @@ class DaemonThread(threading.Thread, PrintError):
     def stop(self):
         with self.running_lock:
             self.running = False
+        self.wakeup()
 
     def on_stop(self):
         if 'ANDROID_DATA' in os.environ:
@@ -597,6 +640,72 @@ def parse_json(message):
     return j, message[n+1:]
 
 
+class JSONLineDecoder:
+    """Incremental decoder of a stream of JSON messages, one per line.
+
+    Data is received into a reusable buffer, either with feed() or by
+    writing to the view returned by reserve() and calling commit().
+    Only bytes that were not scanned before are searched for the end
+    of a line, and consumed bytes are dropped only when the buffer is
+    full.  Lines that are not valid JSON are skipped, as in parse_json.
+    """
+
+    # size of the buffer kept between messages
+    max_idle_size = 2**20
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.start = 0    # first byte of the next message
+        self.scanned = 0  # bytes searched for a newline
+        self.end = 0      # end of the received data
+
+    def pending(self):
+        return self.end - self.start
+
+    def reserve(self, size):
+        """Returns a writable memoryview of at least size bytes after the
+        data.  It must be released before the next call."""
+        if len(self.buf) - self.end < size:
+            if self.start:
+                # move the incomplete message to the front
+                n = self.end - self.start
+                self.buf[:n] = self.buf[self.start:self.end]
+                self.scanned -= self.start
+                self.start, self.end = 0, n
+            if len(self.buf) - self.end < size:
+                self.buf.extend(bytes(max(size, len(self.buf))))
+        return memoryview(self.buf)[self.end:]
+
+    def commit(self, n):
+        self.end += n
+
+    def feed(self, data):
+        with self.reserve(len(data)) as view:
+            view[:len(data)] = data
+        self.commit(len(data))
+
+    def next(self):
+        """Returns the next complete message, or None"""
+        while True:
+            n = self.buf.find(b'\n', self.scanned, self.end)
+            if n == -1:
+                self.scanned = self.end
+                if self.start == self.end:
+                    self.start = self.scanned = self.end = 0
+                    if len(self.buf) > self.max_idle_size:
+                        # free the space of a large message
+                        self.buf = bytearray()
+                return None
+            with memoryview(self.buf)[self.start:n] as line:
+                try:
+                    message = json.loads(str(line, 'utf8'))
+                except ValueError:
+                    message = None
+            self.start = self.scanned = n + 1
+            if message is not None:
+                return message
+
+
 class timeout(Exception):
     pass
 
@@ -607,11 +716,17 @@ import time
 
 
 class SocketPipe:
+
+    # bytes read from the socket at once
+    recv_size = 65536
+
     def __init__(self, socket):
         self.socket = socket
-        self.message = b''
+        self.decoder = JSONLineDecoder()
         self.set_timeout(0.1)
         self.recv_time = time.time()
+        self.bytes_sent = 0
+        self.bytes_received = 0
 
     def set_timeout(self, t):
         self.socket.settimeout(t)
@@ -621,11 +736,12 @@ class SocketPipe:
 
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
+            response = self.decoder.next()
             if response is not None:
                 return response
             try:
-                data = self.socket.recv(1024)
+                with self.decoder.reserve(self.recv_size) as buf:
+                    n = self.socket.recv_into(buf, self.recv_size)
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
@@ -634,19 +750,19 @@ class SocketPipe:
                 if err.errno == 60:
                     raise timeout
                 elif err.errno in [11, 35, 10035]:
-                    print_error("socket errno %d (resource temporarily unavailable)"% err.errno)
-                    time.sleep(0.2)
+                    # non-blocking socket with no more data
                     raise timeout
                 else:
                     print_error("pipe: socket error", err)
-                    data = b''
+                    n = 0
             except:
                 traceback.print_exc(file=sys.stderr)
-                data = b''
+                n = 0
 
-            if not data:  # Connection closed remotely
+            if not n:  # Connection closed remotely
                 return None
-            self.message += data
+            self.decoder.commit(n)
+            self.bytes_received += n
             self.recv_time = time.time()
 
     def send(self, request):
@@ -662,6 +778,7 @@ class SocketPipe:
         while out:
             try:
                 sent = self.socket.send(out)
+                self.bytes_sent += sent
                 out = out[sent:]
             except ssl.SSLError as e:
                 print_error("SSLError:", e)
@@ -24,6 +24,14 @@ from .util import ThreadJob
 from .bitcoin import *
 
 
+def hash_merkle_root(merkle_s, target_hash, pos):
+    h = hash_decode(target_hash)
+    for i in range(len(merkle_s)):
+        item = merkle_s[i]
+        h = Hash(hash_decode(item) + h) if ((pos >> i) & 1) else Hash(h + hash_decode(item))
+    return hash_encode(h)
+
+
 class SPV(ThreadJob):
     """ Simple Payment Verification """
 
@@ -81,11 +89,7 @@ class SPV(ThreadJob):
         self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
 
     def hash_merkle_root(self, merkle_s, target_hash, pos):
-        h = hash_decode(target_hash)
-        for i in range(len(merkle_s)):
-            item = merkle_s[i]
-            h = Hash(hash_decode(item) + h) if ((pos >> i) & 1) else Hash(h + hash_decode(item))
-        return hash_encode(h)
+        return hash_merkle_root(merkle_s, target_hash, pos)
 
     def undo_verifications(self):
         height = self.blockchain.get_checkpoint()
@@ -43,7 +43,7 @@ import sys
 
 from .i18n import _
 from .util import (NotEnoughFunds, PrintError, UserCancelled, profiler,
-                   format_satoshis, NoDynamicFeeEstimates)
+                   format_satoshis, NoDynamicFeeEstimates, DAEMON_WAIT_TIMEOUT)
 
 from .bitcoin import *
 from .version import *
@@ -88,7 +88,7 @@ def dust_threshold(network):
     return 182 * 3 * relayfee(network) / 1000
 
 
-def append_utxos_to_inputs(inputs, network, pubkey, txin_type, imax):
+def pubkey_to_scripthash(txin_type, pubkey):
     if txin_type != 'p2pk':
         address = bitcoin.pubkey_to_address(txin_type, pubkey)
         sh = bitcoin.address_to_scripthash(address)
@@ -96,8 +96,11 @@ def append_utxos_to_inputs(inputs, network, pubkey, txin_type, imax):
         script = bitcoin.public_key_to_p2pk_script(pubkey)
         sh = bitcoin.script_to_scripthash(script)
         address = '(pubkey)'
-    u = network.synchronous_get(('blockchain.scripthash.listunspent', [sh]))
-    for item in u:
+    return address, sh
+
+
+def append_utxos_to_inputs(inputs, utxos, address, pubkey, txin_type, imax):
+    for item in utxos:
         if len(inputs) >= imax:
             break
         item['address'] = address
@@ -114,10 +117,14 @@ def sweep_preparations(privkeys, network, imax=100):
 
     def find_utxos_for_privkey(txin_type, privkey, compressed):
         pubkey = bitcoin.public_key_from_private_key(privkey, compressed)
-        append_utxos_to_inputs(inputs, network, pubkey, txin_type, imax)
+        address, sh = pubkey_to_scripthash(txin_type, pubkey)
+        lookups.append((address, pubkey, txin_type))
+        requests.append(('blockchain.scripthash.listunspent', [sh]))
         keypairs[pubkey] = privkey, compressed
     inputs = []
     keypairs = {}
+    lookups = []
+    requests = []
     for sec in privkeys:
         txin_type, privkey, compressed = bitcoin.deserialize_privkey(sec)
         find_utxos_for_privkey(txin_type, privkey, compressed)
@@ -130,6 +137,9 @@ def sweep_preparations(privkeys, network, imax=100):
             # WIF serialization does not distinguish p2pkh and p2pk
             # we also search for pay-to-pubkey outputs
             find_utxos_for_privkey('p2pk', privkey, compressed)
+    # all the lookups in one round-trip
+    for (address, pubkey, txin_type), utxos in zip(lookups, network.gather(requests)):
+        append_utxos_to_inputs(inputs, utxos, address, pubkey, txin_type, imax)
     if not inputs:
         raise BaseException(_('No inputs found. (Note that inputs need to be confirmed)'))
     return inputs, keypairs
@@ -205,6 +215,7 @@ class Abstract_Wallet(PrintError):
         # interface.is_up_to_date() returns true when all requests have been answered and processed
         # wallet.up_to_date is true when the wallet is synchronized (stronger requirement)
         self.up_to_date = False
+        self.up_to_date_event = threading.Event()
         self.lock = threading.Lock()
         self.transaction_lock = threading.Lock()
 
@@ -320,6 +331,10 @@ class Abstract_Wallet(PrintError):
     def set_up_to_date(self, up_to_date):
         with self.lock:
             self.up_to_date = up_to_date
+            if up_to_date:
+                self.up_to_date_event.set()
+            else:
+                self.up_to_date_event.clear()
         if up_to_date:
             self.save_transactions(write=True)
 
@@ -1031,13 +1046,21 @@ class Abstract_Wallet(PrintError):
                         _("Addresses generated:"),
                         len(self.addresses(True)))
                     callback(msg)
-                time.sleep(0.1)
+                self.up_to_date_event.wait(DAEMON_WAIT_TIMEOUT)
         def wait_for_network():
-            while not self.network.is_connected():
-                if callback:
-                    msg = "%s \n" % (_("Connecting..."))
-                    callback(msg)
-                time.sleep(0.1)
+            connected = threading.Event()
+            def on_status(event):
+                if self.network.is_connected():
+                    connected.set()
+            self.network.register_callback(on_status, ['status'])
+            try:
+                while not self.network.is_connected():
+                    if callback:
+                        msg = "%s \n" % (_("Connecting..."))
+                        callback(msg)
+                    connected.wait(DAEMON_WAIT_TIMEOUT)
+            finally:
+                self.network.unregister_callback(on_status)
         # wait until we are connected, because the user
         # might have selected another server
         if self.network:
@@ -1151,20 +1174,27 @@ class Abstract_Wallet(PrintError):
         return False
 
     def get_input_tx(self, tx_hash):
-        # First look up an input transaction in the wallet where it
+        return self.get_input_txs([tx_hash])[0]
+
+    def get_input_txs(self, tx_hashes):
+        # First look up input transactions in the wallet where they
         # will likely be.  If co-signing a transaction it may not have
-        # all the input txs, in which case we ask the network.
-        tx = self.transactions.get(tx_hash)
-        if not tx and self.network:
-            request = ('blockchain.transaction.get', [tx_hash])
-            tx = Transaction(self.network.synchronous_get(request))
-        return tx
+        # all the input txs, in which case we ask the network, for all
+        # of them at once.
+        missing = [h for h in set(tx_hashes) if not self.transactions.get(h)]
+        fetched = {}
+        if missing and self.network:
+            requests = [('blockchain.transaction.get', [h]) for h in missing]
+            for tx_hash, raw in zip(missing, self.network.gather(requests)):
+                fetched[tx_hash] = Transaction(raw)
+        return [self.transactions.get(h) or fetched.get(h) for h in tx_hashes]
 
     def add_hw_info(self, tx):
         # add previous tx for hw wallets
-        for txin in tx.inputs():
-            tx_hash = txin['prevout_hash']
-            txin['prev_tx'] = self.get_input_tx(tx_hash)
+        txins = tx.inputs()
+        prev_txs = self.get_input_txs([txin['prevout_hash'] for txin in txins])
+        for txin, prev_tx in zip(txins, prev_txs):
+            txin['prev_tx'] = prev_tx
         # add output info for hw wallets
         info = {}
         xpubs = self.get_master_public_keys()
@@ -59,6 +59,7 @@ class WsClientThread(util.DaemonThread):
         self.config = config
         self.response_queue = queue.Queue()
         self.subscriptions = defaultdict(list)
+        self.h2addr = {}
 
     def make_request(self, request_id):
         # read json file
@@ -85,16 +86,23 @@ class WsClientThread(util.DaemonThread):
             l.append((ws, amount))
             self.subscriptions[addr] = l
             h = self.network.addr_to_scripthash(addr)
+            self.h2addr[h] = addr
             self.network.send([('blockchain.scripthash.subscribe', [h])], self.response_queue.put)
 
 
+    def wakeup(self):
+        self.response_queue.put(None)
+
     def run(self):
         threading.Thread(target=self.reading_thread).start()
         while self.is_running():
             try:
-                r = self.response_queue.get(timeout=0.1)
+                r = self.response_queue.get(timeout=util.DAEMON_WAIT_TIMEOUT)
             except queue.Empty:
                 continue
+            if r is None:
+                # stopped
+                continue
             util.print_error('response', r)
             method = r.get('method')
             params = r.get('params')
@@ -105,7 +113,7 @@ class WsClientThread(util.DaemonThread):
                 self.network.send([('blockchain.scripthash.get_balance', params)], self.response_queue.put)
             elif method == 'blockchain.scripthash.get_balance':
                 h = params[0]
-                addr = self.network.h2addr.get(h, None)
+                addr = self.h2addr.get(h, None)
                 if addr is None:
                     util.print_error("can't find address for scripthash: %s" % h)
                 l = self.subscriptions.get(addr, [])